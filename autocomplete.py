@@ -0,0 +1,48 @@
+# autocomplete.py
+from __future__ import annotations
+
+
+class PrefixTrie:
+    """
+    Префиксное дерево для автодополнения без запроса к БД.
+    Ключи сравниваются без учёта регистра, значения возвращаются в алфавитном порядке ключей.
+    """
+
+    def __init__(self):
+        self._root: dict = {}
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def insert(self, key: str, value) -> None:
+        node = self._root
+        for ch in key.lower():
+            node = node.setdefault(ch, {})
+        node.setdefault(None, []).append(value)
+        self._size += 1
+
+    def complete(self, prefix: str, limit: int | None = None) -> list:
+        node = self._root
+        for ch in prefix.lower():
+            node = node.get(ch)
+            if node is None:
+                return []
+
+        result: list = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            result.extend(node.get(None, ()))
+            if limit is not None and len(result) >= limit:
+                return result[:limit]
+            # обратный порядок, чтобы со стека первыми снимались меньшие символы
+            stack.extend(node[ch] for ch in sorted((k for k in node if k is not None), reverse=True))
+        return result
+
+    @classmethod
+    def from_rows(cls, rows: list[tuple], key_index: int) -> PrefixTrie:
+        trie = cls()
+        for row in rows:
+            trie.insert(str(row[key_index]), row)
+        return trie
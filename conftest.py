@@ -9,3 +9,36 @@ import os
 import sys
 
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from main import Main
+from dbconnection import DbConnection, DBConfig
+
+
+@pytest.fixture
+def db_connection():
+    """Фикстура для подключения к БД"""
+    config = DBConfig()
+    conn = DbConnection(config)
+    conn.connect()
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def app(db_connection):
+    """Фикстура для создания экземпляра приложения"""
+    main_app = Main()
+    main_app.connection = db_connection
+    main_app.stations.dbconn = db_connection
+    main_app.routes.dbconn = db_connection
+    return main_app
+
+
+@pytest.fixture
+def tables(app):
+    """Пересоздание таблиц станций и маршрутов (пустых)"""
+    app.connection.conn.rollback()
+    app.routes.drop()
+    app.stations.drop()
+    app.stations.create()
+    app.routes.create()
@@ -1,7 +1,19 @@
+import itertools
+import re
+import threading
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+
 import psycopg2
+from pydantic import field_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
+from psycopg2 import errors, extensions, sql
 from psycopg2.extensions import connection as PgConnection
 
+import tracing
+from pipeline import Pipeline
+
 class ServiceConfig(BaseSettings):
     model_config = SettingsConfigDict(
         env_file=".env",
@@ -9,6 +21,16 @@ class ServiceConfig(BaseSettings):
         extra="ignore",
     )
 
+_TENANT_NAME = re.compile(r"[a-z_][a-z0-9_]{0,62}")
+
+
+def check_tenant(name: str) -> str:
+    """Имя арендатора — имя схемы без кавычек: оно же попадает в options соединения."""
+    if not _TENANT_NAME.fullmatch(name) or name.startswith("pg_") or name in ("public", "information_schema"):
+        raise ValueError(f"Недопустимое имя арендатора {name!r}: строчные латинские буквы, цифры и _")
+    return name
+
+
 class DBConfig(ServiceConfig):
     host: str = "localhost"
     port: int = 5432
@@ -16,9 +38,23 @@ class DBConfig(ServiceConfig):
     password: str
     db: str
     table_prefix: str = ""
+    # схема арендатора: таблицы без префикса в этой схеме, она первой в search_path соединения
+    tenant: str = ""
+    statement_timeout_ms: int = 0  # таймаут запроса по умолчанию для всех соединений, 0 — без ограничения
+
+    # реплики только для чтения: DB_REPLICA_DSNS='["host=... port=5433 ...", ...]'
+    replica_dsns: list[str] = []
+    replica_routing: str = "round_robin"  # или "least_loaded"
+    replica_max_lag: float = 5.0  # секунд отставания, после которых реплика не используется
+    replica_sticky_seconds: float = 2.0  # сколько читать с primary после своей записи
 
     model_config = SettingsConfigDict(env_prefix="DB_")
 
+    @field_validator("tenant")
+    @classmethod
+    def _check_tenant(cls, v: str) -> str:
+        return check_tenant(v) if v else v
+
     @property
     def dsn(self) -> str:
         return (
@@ -30,24 +66,242 @@ class DBConfig(ServiceConfig):
         )
 
 
+class _Cursor(extensions.cursor):
+    """
+    Курсор, который внутри DbConnection.timeout() дописывает перед запросом
+    SET LOCAL statement_timeout — в том же execute, без лишнего обращения к серверу,
+    и учитывает запрос и число строк в текущем спане tracing.
+
+    QueryCanceled получает атрибут timed_out: таймаут это или отмена через cancel().
+    Причину определяем по своему состоянию — текст ошибки сервера зависит от lc_messages.
+    """
+
+    def execute(self, query, vars=None):
+        conn = self.connection
+        ms = conn.call_timeout()
+        if ms is not None:
+            prefix = f"SET LOCAL statement_timeout = {int(ms)}; "
+            if isinstance(query, sql.Composable):
+                query = sql.SQL(prefix) + query
+            elif isinstance(query, bytes):
+                query = prefix.encode() + query
+            else:
+                query = prefix + query
+        conn.cancel_requested = False
+        try:
+            result = super().execute(query, vars)
+        except errors.QueryCanceled as e:
+            e.timed_out = not conn.cancel_requested and bool(ms or conn.default_timeout_ms)
+            raise
+        finally:
+            conn.cancel_requested = False
+        tracing.record_query(self.rowcount)
+        return result
+
+
+class _Connection(extensions.connection):
+    call_timeout = staticmethod(lambda: None)
+    default_timeout_ms = 0  # statement_timeout_ms из конфигурации
+    cancel_requested = False  # выполняющийся запрос отменён через cancel()
+    pipeline_ready = False  # временная таблица результатов Pipeline уже создана
+
+    def cancel(self) -> None:
+        # сюда приходят и DbConnection.cancel(), и Ctrl-C в wait_select
+        self.cancel_requested = True
+        super().cancel()
+
+    def rollback(self) -> None:
+        # временная таблица Pipeline могла быть создана в откатываемой транзакции
+        self.pipeline_ready = False
+        super().rollback()
+
+
 class DbConnection:
-    def __init__(self, config: DBConfig):
+    """
+    Подключение к БД для DbTable.
+
+    В обычном режиме одно соединение на объект. С threadsafe=True у каждого потока
+    своё соединение (создаётся при первом обращении к conn), поэтому транзакции
+    и rollback одного потока не затрагивают другие, а DbTable можно делить между потоками.
+    """
+
+    def __init__(self, config: DBConfig, threadsafe: bool = False):
         self.config = config
-        self.conn: PgConnection | None = None
+        self.threadsafe = threadsafe
+        self._local = threading.local() if threadsafe else SimpleNamespace()
+        self._opened: list[PgConnection] = []
+        self._lock = threading.Lock()
+
+        self._rr = itertools.count()
+        self._replica_state: dict[str, tuple[float, float, int]] = {}  # dsn -> (проверено, лаг, активных)
+
+    @property
+    def conn(self) -> PgConnection | None:
+        conn = getattr(self._local, "conn", None)
+        if (conn is None or conn.closed) and self.threadsafe:
+            conn = self.connect()  # в том числе вместо закрытого после разрыва
+        return conn
 
     @property
     def prefix(self) -> str:
-        return self.config.table_prefix
+        # у арендатора своя схема: имена таблиц (и тексты запросов) одинаковы для всех арендаторов
+        return "" if self.config.tenant else self.config.table_prefix
+
+    @property
+    def tenant(self) -> str:
+        return self.config.tenant
+
+    def for_tenant(self, tenant: str) -> "DbConnection":
+        """Новый DbConnection с теми же настройками для схемы арендатора tenant."""
+        config = self.config.model_copy(update={"tenant": check_tenant(tenant)})
+        return DbConnection(config, threadsafe=self.threadsafe)
 
     def connect(self) -> PgConnection:
-        if not self.conn:
-            self.conn = psycopg2.connect(self.config.dsn)
+        conn = getattr(self._local, "conn", None)
+        if conn is None or conn.closed:
+            conn = self._open(self.config.dsn)
+            self._local.conn = conn
+        return conn
+
+    def _open(self, dsn: str) -> PgConnection:
+        # параметры сессии уходят в стартовом пакете соединения, без отдельных SET
+        options = []
+        if self.config.statement_timeout_ms:
+            options.append(f"-c statement_timeout={self.config.statement_timeout_ms}")
+        if self.config.tenant:
+            # только схема арендатора: без неё (или без таблицы в ней) запрос падает,
+            # а не уходит к одноимённой таблице в public; объекты расширений — через public.
+            options.append(f"-c search_path={self.config.tenant}")
+        kwargs = {"options": " ".join(options)} if options else {}
+        conn = psycopg2.connect(dsn, connection_factory=_Connection, cursor_factory=_Cursor, **kwargs)
+        conn.call_timeout = lambda: getattr(self._local, "timeout_ms", None)
+        conn.default_timeout_ms = self.config.statement_timeout_ms
+        with self._lock:
+            self._opened.append(conn)
+        return conn
+
+    # таймауты и отмена
+    @contextmanager
+    def timeout(self, ms: int):
+        """
+        Таймаут для запросов этого потока внутри блока (SET LOCAL statement_timeout),
+        поверх statement_timeout_ms по умолчанию. Превышение — errors.QueryCanceled.
+        """
+        prev = getattr(self._local, "timeout_ms", None)
+        self._local.timeout_ms = ms
+        try:
+            yield
+        finally:
+            self._local.timeout_ms = prev
+            conn = getattr(self._local, "conn", None)
+            if prev is None and conn is not None and not conn.closed \
+                    and conn.info.transaction_status == extensions.TRANSACTION_STATUS_INTRANS:
+                # SET LOCAL дожил бы до конца транзакции — возвращаем значение по умолчанию;
+                # во вложенном блоке прежний таймаут снова допишется к следующему запросу
+                with conn.cursor() as cur:
+                    cur.execute("SET LOCAL statement_timeout = DEFAULT")
+
+    def cancel(self) -> None:
+        """Прервать выполняющиеся запросы на всех соединениях; безопасно из другого потока."""
+        with self._lock:
+            opened = list(self._opened)
+        for conn in opened:
+            if not conn.closed:
+                conn.cancel()
+
+    # конвейер
+    def pipeline(self) -> Pipeline:
+        """Очередь запросов, которые уйдут на сервер одним обращением (см. pipeline.Pipeline)."""
+        return Pipeline(self)
+
+    # реплики
+    REPLICA_CHECK_INTERVAL = 1.0
+
+    def mark_write(self) -> None:
+        """
+        Отметить запись в текущем потоке (до её выполнения): пока транзакция с ней открыта
+        и ещё replica_sticky_seconds после её завершения чтения идут на primary (read-your-writes).
+        """
+        self._local.last_write = time.monotonic()
+        self._local.write_pending = True
+
+    def read_conn(self) -> PgConnection | None:
+        """
+        Соединение для чтения: реплика по DBConfig.replica_routing, если она не отстаёт
+        больше replica_max_lag; иначе, а также сразу после записи в этом потоке — primary.
+        """
+        dsns = self.config.replica_dsns
+        if not dsns:
+            return self.conn
+
+        if getattr(self._local, "write_pending", False):
+            conn = getattr(self._local, "conn", None)
+            if conn is not None and not conn.closed \
+                    and conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                # незафиксированную запись видит только это соединение
+                return conn
+            # транзакция с записью завершилась: окно отсчитывается от её конца
+            self._local.write_pending = False
+            self._local.last_write = time.monotonic()
+
+        last_write = getattr(self._local, "last_write", None)
+        if last_write is not None and time.monotonic() - last_write < self.config.replica_sticky_seconds:
+            return self.conn
+
+        for dsn in self._replica_order(dsns):
+            conn = self._replica_conn(dsn)
+            if conn is not None:
+                return conn
         return self.conn
 
+    def _replica_order(self, dsns: list[str]) -> list[str]:
+        if self.config.replica_routing == "least_loaded":
+            return sorted(dsns, key=lambda d: self._replica_state.get(d, (0, 0, 0))[2])
+        start = next(self._rr) % len(dsns)
+        return dsns[start:] + dsns[:start]
+
+    def _replica_conn(self, dsn: str) -> PgConnection | None:
+        replicas = getattr(self._local, "replicas", None)
+        if replicas is None:
+            replicas = self._local.replicas = {}
+
+        try:
+            conn = replicas.get(dsn)
+            if conn is None or conn.closed:
+                conn = self._open(dsn)
+                # autocommit: на реплике не держим открытых транзакций, они мешают применению WAL
+                conn.set_session(readonly=True, autocommit=True)
+                replicas[dsn] = conn
+
+            checked_at, lag, _ = self._replica_state.get(dsn, (0, 0, 0))
+            if time.monotonic() - checked_at > self.REPLICA_CHECK_INTERVAL:
+                lag = self._probe_replica(dsn, conn)
+        except psycopg2.Error:
+            replicas.pop(dsn, None)
+            return None
+
+        return conn if lag <= self.config.replica_max_lag else None
+
+    def _probe_replica(self, dsn: str, conn: PgConnection) -> float:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT CASE WHEN NOT pg_is_in_recovery() "
+                "OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END, "
+                "(SELECT count(*) FROM pg_stat_activity WHERE state = 'active')"
+            )
+            lag, active = cur.fetchone()
+        self._replica_state[dsn] = (time.monotonic(), float(lag), int(active))
+        return float(lag)
+
     def close(self) -> None:
-        if self.conn:
-            self.conn.close()
-            self.conn = None
+        """Закрыть все соединения, открытые через этот объект (во всех потоках)."""
+        with self._lock:
+            opened, self._opened = self._opened, []
+        for conn in opened:
+            if not conn.closed:
+                conn.close()
+        self._local = threading.local() if self.threadsafe else SimpleNamespace()
 
     def __enter__(self) -> PgConnection:
         return self.connect()
@@ -0,0 +1,80 @@
+# dberrors.py
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+
+import psycopg2
+from psycopg2 import errors
+
+# Сообщения для известных ограничений таблиц station/route
+CONSTRAINT_MESSAGES = {
+    "uq_station_name": "станция с таким названием уже существует.",
+    "uq_station_line_order": "станция с таким порядком на линии уже существует.",
+    "uq_route_start_end": "маршрут между этими станциями уже существует.",
+    "chk_station_tariff_zone": "тарифная зона должна быть >= 0.",
+    "chk_station_line_order": "порядок на линии должен быть > 0.",
+    "chk_route_start_end_not_same": "начальная и конечная станции маршрута должны быть разными.",
+}
+
+
+class DuplicateKeyError(ValueError):
+    """Дубликат UNIQUE-ключа найден до отправки запроса (UniqueIndex); SQL не выполнялся."""
+
+    def __init__(self, constraint: str):
+        super().__init__(CONSTRAINT_MESSAGES.get(constraint, f"нарушено уникальное ограничение ({constraint})."))
+        self.constraint = constraint
+
+
+def constraint_of(e: Exception) -> str | None:
+    """Имя нарушенного ограничения; для секции "uq_x__p0" — имя ограничения родителя "uq_x"."""
+    if isinstance(e, DuplicateKeyError):
+        return e.constraint
+    name = getattr(getattr(e, "diag", None), "constraint_name", None)
+    return name.split("__")[0] if name else name
+
+
+def describe_db_error(e: psycopg2.Error) -> str | None:
+    """Понятное сообщение для нарушения ограничения или отмены запроса; None — для прочих ошибок БД."""
+    if isinstance(e, DuplicateKeyError):
+        return str(e)
+    constraint_name = constraint_of(e)
+
+    if isinstance(e, errors.UniqueViolation):
+        return CONSTRAINT_MESSAGES.get(constraint_name, f"нарушено уникальное ограничение ({constraint_name}).")
+    if isinstance(e, errors.CheckViolation):
+        return CONSTRAINT_MESSAGES.get(constraint_name, f"нарушено ограничение CHECK ({constraint_name}).")
+    if isinstance(e, errors.ForeignKeyViolation):
+        return "есть связанные записи (нарушение внешнего ключа)."
+    if isinstance(e, errors.NotNullViolation):
+        return "обязательное поле не заполнено."
+    if isinstance(e, errors.QueryCanceled):
+        if getattr(e, "timed_out", False):
+            return "запрос выполнялся слишком долго и был прерван по таймауту."
+        return "запрос отменён."
+    return None
+
+
+@dataclass
+class RowError:
+    """Отклонённая операция пакета: её номер во входном списке, аргументы и причина."""
+    index: int
+    op: str
+    args: object
+    constraint: str | None
+    message: str
+    error: Exception = field(repr=False)
+
+
+@dataclass
+class BatchReport:
+    applied: int = 0
+    errors: list[RowError] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+    @staticmethod
+    def row_error(index: int, op: str, args, e: Exception) -> RowError:
+        message = describe_db_error(e) or str(e).strip().split("\n")[0]
+        return RowError(index, op, args, constraint_of(e), message, e)
@@ -0,0 +1,137 @@
+# dbquery.py
+from __future__ import annotations
+
+from psycopg2 import sql
+
+import tracing
+
+
+class Query:
+    """
+    Составной SELECT к таблице DbTable:
+        table.select("name").where("is_active", True).order_by("line_order").limit(10).all()
+
+    Фильтры, проекция и LIMIT уходят в Postgres. Отрендеренный текст запроса
+    кешируется по «форме» (таблица, колонки, условия, сортировка), значения
+    всегда передаются параметрами.
+    """
+
+    OPERATORS = ("=", "<>", "<", "<=", ">", ">=", "LIKE", "ILIKE", "IN")
+
+    _sql_cache: dict[tuple, str] = {}
+
+    def __init__(self, table, columns: tuple[str, ...] | list[str] = (), include_archived: bool = False):
+        self.table = table
+        self.include_archived = include_archived
+        self._columns = tuple(columns) or tuple(table.column_names())
+        self._where: list[tuple[str, str]] = []
+        self._params: list = []
+        self._order: list[tuple[str, bool]] = []
+        self._limit: int | None = None
+        self._offset: int | None = None
+
+        for c in self._columns:
+            self._check_column(c)
+
+    def _check_column(self, column: str) -> None:
+        if column not in self.table.columns() and column not in self.table.service_columns():
+            raise ValueError(f"Неизвестная колонка {column!r} в таблице {self.table.table_name()}")
+
+    def column_types(self) -> list[str]:
+        """SQL-типы выбираемых колонок в порядке выборки (как в columns() таблицы)."""
+        types = {**self.table.columns(), **self.table.service_columns()}
+        return [types[c][0] for c in self._columns]
+
+    # построение
+    def where(self, column: str, value, op: str = "=") -> Query:
+        op = op.upper()
+        if op not in self.OPERATORS:
+            raise ValueError(f"Неподдерживаемый оператор {op!r}")
+        self._check_column(column)
+        self._where.append((column, op))
+        self._params.append(list(value) if op == "IN" else value)
+        return self
+
+    def order_by(self, *columns: str, desc: bool = False) -> Query:
+        for c in columns:
+            self._check_column(c)
+            self._order.append((c, desc))
+        return self
+
+    def limit(self, n: int) -> Query:
+        self._limit = n
+        return self
+
+    def offset(self, n: int) -> Query:
+        self._offset = n
+        return self
+
+    # рендеринг
+    def shape(self) -> tuple:
+        return (
+            self.table.table_name(),
+            self._columns,
+            tuple(self._where),
+            tuple(self._order),
+            self._limit is not None,
+            self._offset is not None,
+            self.include_archived,
+        )
+
+    def compose(self) -> sql.Composed:
+        q = sql.SQL("SELECT {} FROM {}").format(
+            sql.SQL(", ").join(sql.Identifier(c) for c in self._columns),
+            self.table.source(self.include_archived),
+        )
+
+        if self._where:
+            conds = []
+            for column, op in self._where:
+                if op == "IN":
+                    conds.append(sql.SQL("{} = ANY({})").format(sql.Identifier(column), sql.Placeholder()))
+                else:
+                    conds.append(sql.SQL("{} " + op + " {}").format(sql.Identifier(column), sql.Placeholder()))
+            q += sql.SQL(" WHERE ") + sql.SQL(" AND ").join(conds)
+
+        if self._order:
+            q += sql.SQL(" ORDER BY ") + sql.SQL(", ").join(
+                sql.SQL("{} DESC").format(sql.Identifier(c)) if desc else sql.Identifier(c)
+                for c, desc in self._order
+            )
+
+        if self._limit is not None:
+            q += sql.SQL(" LIMIT {}").format(sql.Placeholder())
+        if self._offset is not None:
+            q += sql.SQL(" OFFSET {}").format(sql.Placeholder())
+        return q
+
+    def params(self) -> list:
+        params = list(self._params)
+        if self._limit is not None:
+            params.append(self._limit)
+        if self._offset is not None:
+            params.append(self._offset)
+        return params
+
+    def rendered(self, conn) -> str:
+        key = self.shape()
+        text = self._sql_cache.get(key)
+        if text is None:
+            text = self.compose().as_string(conn)
+            self._sql_cache[key] = text
+        return text
+
+    # выполнение
+    def all(self, conn=None) -> list[tuple]:
+        """Выполнить запрос; по умолчанию на соединении для чтения (реплика или primary)."""
+        with tracing.span("Query.all", table=self.table.table_name()):
+            conn = conn or self.table.dbconn.read_conn()
+            cur = conn.cursor()
+            cur.execute(self.rendered(conn), self.params())
+            return cur.fetchall()
+
+    def first(self) -> tuple | None:
+        if self._limit is None:
+            self._limit = 1
+        rows = self.all()
+        return rows[0] if rows else None
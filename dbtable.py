@@ -1,14 +1,34 @@
 # dbtable.py
 from __future__ import annotations
 
+import re
+
+import psycopg2
 from psycopg2 import sql
+from psycopg2.extras import execute_values
+
+import tracing
+from dberrors import BatchReport, DuplicateKeyError
+from dbquery import Query
+from unique_index import UniqueIndex
+
+_UNIQUE_CONSTRAINT = re.compile(r"\s*CONSTRAINT\s+(\w+)\s+UNIQUE\s*\(([^)]*)\)", re.IGNORECASE)
 
 
 class DbTable:
     dbconn = None
+    unique_index: UniqueIndex | None = None
+    # имя таблицы без префикса DB_TABLE_PREFIX (так она называется в схеме арендатора)
+    base_name = "table"
+
+    def __init__(self, dbconn=None):
+        # Таблица не хранит состояния кроме dbconn (и потокобезопасного unique_index):
+        # с DbConnection(threadsafe=True) один экземпляр можно использовать из нескольких потоков.
+        if dbconn is not None:
+            self.dbconn = dbconn
 
     def table_name(self) -> str:
-        return self.dbconn.prefix + "table"
+        return self.dbconn.prefix + self.base_name
 
     def columns(self) -> dict[str, list[str]]:
         return {"id": ["serial", "PRIMARY KEY"]}
@@ -19,6 +39,18 @@ class DbTable:
     def column_names(self) -> list[str]:
         return list(self.columns().keys())
 
+    def service_columns(self) -> dict[str, list[str]]:
+        """Служебные колонки: создаются в create(), заполняются БД и не входят в column_names()."""
+        return {
+            "updated_at": ["TIMESTAMPTZ", "NOT NULL", "DEFAULT now()"],
+            # id транзакции последнего изменения — водяной знак для changes_since()
+            "change_txid": ["BIGINT", "NOT NULL", "DEFAULT txid_current()"],
+        }
+
+    def tombstone_table_name(self) -> str:
+        """Таблица PK удалённых строк для changes_since(); заполняется триггером."""
+        return self.table_name() + "_tombstone"
+
     def column_names_without_pk(self) -> list[str]:
         cols = self.column_names()
         pk = self.primary_key()[0]
@@ -29,37 +61,321 @@ class DbTable:
     def table_constraints(self) -> list[str]:
         return []
 
-    # DDL 
-    def create(self) -> None:
+    def unique_keys(self) -> dict[str, list[str]]:
+        """UNIQUE-ограничения из table_constraints(): имя -> колонки."""
+        keys = {}
+        for constraint in self.table_constraints():
+            m = _UNIQUE_CONSTRAINT.match(constraint)
+            if m:
+                keys[m.group(1)] = [c.strip() for c in m.group(2).split(",")]
+        return keys
+
+    def enable_unique_precheck(self, max_age: float = 5.0) -> UniqueIndex:
+        """
+        Проверять UNIQUE-ключи по индексу в памяти до отправки INSERT/UPDATE:
+        явный дубликат (подтверждённый точечным SELECT) — DuplicateKeyError без отката транзакции.
+        """
+        self.unique_index = UniqueIndex(self, max_age)
+        return self.unique_index
+
+    def indexes(self) -> dict[str, str]:
+        """Суффикс имени индекса -> определение после "ON <таблица>"."""
+        return {}
+
+    def extensions(self) -> list[str]:
+        """Расширения Postgres, нужные индексам. Если расширение недоступно, такие индексы пропускаются."""
+        return []
+
+    def archive_table_name(self) -> str | None:
+        """Холодная таблица для archive_inactive(); None — архивирование не используется."""
+        return None
+
+    def partitioning(self) -> dict | None:
+        """
+        Секционирование таблицы, например:
+            {"method": "hash", "columns": ["a"], "partitions": 4}
+            {"method": "list", "columns": ["a"], "partitions": {"on": "TRUE", "off": "FALSE"}}
+            {"method": "range", "columns": ["a"], "partitions": {"y2024": ("'2024-01-01'", "'2025-01-01'")}}
+        None — обычная таблица.
+        """
+        return None
+
+    def partition_names(self) -> list[str]:
+        part = self.partitioning()
+        if not part:
+            return []
+        if part["method"] == "hash":
+            return [f"{self.table_name()}_p{i}" for i in range(part["partitions"])]
+        return [f"{self.table_name()}_{name}" for name in part["partitions"]]
+
+    def materialized_views(self) -> dict[str, dict]:
+        """
+        Суффикс имени -> материализованное представление над таблицей:
+            {"query": "SELECT a, count(*) AS n FROM {table} GROUP BY a", "unique": ["a"]}
+        По колонкам unique строится уникальный индекс — он нужен для REFRESH ... CONCURRENTLY.
+        """
+        return {}
+
+    def view_name(self, suffix: str) -> str:
+        return f"{self.table_name()}_{suffix}"
+
+    # DDL
+    @tracing.traced
+    def create(self, commit: bool = True) -> None:
+        part = self.partitioning()
+
         parts: list[str] = []
-        for k, v in self.columns().items():
+        for k, v in (self.columns() | self.service_columns()).items():
+            if part:
+                # PK секционированной таблицы обязан включать ключ секционирования
+                v = [t for t in v if t.upper() != "PRIMARY KEY"]
             parts.append(f"{k} {' '.join(v)}")
+        if part:
+            pk = self.primary_key() + [c for c in part["columns"] if c not in self.primary_key()]
+            parts.append(f"PRIMARY KEY ({', '.join(pk)})")
         parts += self.table_constraints()
 
-        q = sql.SQL("CREATE TABLE {} ({});").format(
+        q = sql.SQL("CREATE TABLE {} ({})").format(
             sql.Identifier(self.table_name()),
             sql.SQL(", ").join(sql.SQL(p) for p in parts),
         )
-        cur = self.dbconn.conn.cursor()
+        if part:
+            q += sql.SQL(" PARTITION BY {} ({})").format(
+                sql.SQL(part["method"].upper()),
+                sql.SQL(", ").join(sql.Identifier(c) for c in part["columns"]),
+            )
+        cur = self._write_cursor()
         cur.execute(q)
-        self.dbconn.conn.commit()
 
+        if part:
+            for name, bounds in zip(self.partition_names(), self._partition_bounds(part)):
+                cur.execute(sql.SQL("CREATE TABLE {} PARTITION OF {} FOR VALUES {}").format(
+                    sql.Identifier(name),
+                    sql.Identifier(self.table_name()),
+                    bounds,
+                ))
+            self._name_partition_constraints(cur)
+
+        self._create_service_objects(cur)
+
+        for ext in self.extensions():
+            # в public, а не в первую схему search_path: расширение общее для всех арендаторов,
+            # поэтому его объекты в indexes() указываются с public.
+            self._try_ddl(cur, sql.SQL("CREATE EXTENSION IF NOT EXISTS {} SCHEMA public").format(sql.Identifier(ext)))
+
+        for suffix, definition in self.indexes().items():
+            self._try_ddl(cur, sql.SQL("CREATE INDEX {} ON {} {}").format(
+                sql.Identifier(f"{self.table_name()}_{suffix}"),
+                sql.Identifier(self.table_name()),
+                sql.SQL(definition),
+            ))
+
+        for suffix, view in self.materialized_views().items():
+            name = sql.Identifier(self.view_name(suffix))
+            cur.execute(sql.SQL("DROP MATERIALIZED VIEW IF EXISTS {}").format(name))
+            cur.execute(sql.SQL("CREATE MATERIALIZED VIEW {} AS {}").format(
+                name, sql.SQL(view["query"]).format(table=sql.Identifier(self.table_name())),
+            ))
+            cur.execute(sql.SQL("CREATE UNIQUE INDEX {} ON {} ({})").format(
+                sql.Identifier(f"{self.view_name(suffix)}_key"),
+                name,
+                sql.SQL(", ").join(sql.Identifier(c) for c in view["unique"]),
+            ))
+        self._finish_write(commit)
+        if self.unique_index is not None:
+            self.unique_index.reset()
+
+    def _create_service_objects(self, cur) -> None:
+        """Триггеры служебных колонок, таблица удалений для changes_since() и холодная таблица архива."""
+        table = sql.Identifier(self.table_name())
+        tombstone = sql.Identifier(self.tombstone_table_name())
+        pk_cols = sql.SQL(", ").join(sql.Identifier(c) for c in self.primary_key())
+
+        cur.execute(
+            "CREATE OR REPLACE FUNCTION dbtable_touch() RETURNS trigger LANGUAGE plpgsql AS $$ "
+            "BEGIN NEW.updated_at := now(); NEW.change_txid := txid_current(); RETURN NEW; END $$"
+        )
+        cur.execute(sql.SQL(
+            "CREATE TRIGGER {} BEFORE INSERT OR UPDATE ON {} FOR EACH ROW EXECUTE FUNCTION dbtable_touch()"
+        ).format(sql.Identifier(f"{self.table_name()}_touch"), table))
+        cur.execute(sql.SQL("CREATE INDEX {} ON {} (change_txid)").format(
+            sql.Identifier(f"{self.table_name()}_change_txid"), table,
+        ))
+
+        # удаления от прежней таблицы с тем же именем не относятся к новой
+        pk_defs = [f"{c} {self.columns()[c][0]} NOT NULL" for c in self.primary_key()]
+        cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(tombstone))
+        cur.execute(sql.SQL(
+            "CREATE TABLE {} ({}, "
+            "change_txid BIGINT NOT NULL DEFAULT txid_current(), deleted_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+        ).format(tombstone, sql.SQL(", ").join(sql.SQL(d) for d in pk_defs)))
+        cur.execute(sql.SQL("CREATE INDEX {} ON {} (change_txid)").format(
+            sql.Identifier(f"{self.tombstone_table_name()}_change_txid"), tombstone,
+        ))
+        # счётчик версии data_version(): отложенный триггер увеличивает его один раз за
+        # транзакцию в момент COMMIT. Блокировка строки счётчика упорядочивает пишущие
+        # транзакции по фиксации, поэтому значение растёт с каждым commit — даже когда
+        # транзакция с меньшим txid фиксируется позже. Строка переживает drop(): после
+        # пересоздания таблицы прежние версии не повторяются.
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS dbtable_version "
+            "(table_name TEXT PRIMARY KEY, version BIGINT NOT NULL)"
+        )
+        cur.execute(
+            "CREATE OR REPLACE FUNCTION dbtable_bump_version() RETURNS trigger LANGUAGE plpgsql AS $$ "
+            "DECLARE flag TEXT := 'dbtable.version_' || md5(TG_TABLE_SCHEMA || '.' || TG_ARGV[0]); "
+            "BEGIN "
+            "IF current_setting(flag, true) = txid_current()::text THEN RETURN NULL; END IF; "
+            "PERFORM set_config(flag, txid_current()::text, true); "
+            "EXECUTE format('INSERT INTO %I.dbtable_version AS v VALUES ($1, 1) ON CONFLICT (table_name) "
+            "DO UPDATE SET version = v.version + 1', TG_TABLE_SCHEMA) USING TG_ARGV[0]; "
+            "RETURN NULL; END $$"
+        )
+        cur.execute(sql.SQL(
+            "CREATE CONSTRAINT TRIGGER {} AFTER INSERT OR UPDATE OR DELETE ON {} "
+            "DEFERRABLE INITIALLY DEFERRED FOR EACH ROW EXECUTE FUNCTION dbtable_bump_version({})"
+        ).format(sql.Identifier(f"{self.table_name()}_version"), table, sql.Literal(self.table_name())))
+        # пересоздание таблицы — тоже новая версия данных
+        cur.execute(
+            "INSERT INTO dbtable_version AS v VALUES (%s, 1) "
+            "ON CONFLICT (table_name) DO UPDATE SET version = v.version + 1",
+            (self.table_name(),),
+        )
+
+        tombstone_fn = sql.Identifier(f"{self.table_name()}_tombstone_fn")
+        body = sql.SQL("BEGIN INSERT INTO {} ({}) VALUES ({}); RETURN OLD; END").format(
+            tombstone,
+            pk_cols,
+            sql.SQL(", ").join(sql.SQL("OLD.{}").format(sql.Identifier(c)) for c in self.primary_key()),
+        )
+        cur.execute(sql.SQL("CREATE OR REPLACE FUNCTION {}() RETURNS trigger LANGUAGE plpgsql AS {}").format(
+            tombstone_fn, sql.Literal(body.as_string(cur)),
+        ))
+        cur.execute(sql.SQL("CREATE TRIGGER {} AFTER DELETE ON {} FOR EACH ROW EXECUTE FUNCTION {}()").format(
+            sql.Identifier(f"{self.table_name()}_tombstone"), table, tombstone_fn,
+        ))
+
+        archive = self.archive_table_name()
+        if archive:
+            cur.execute(sql.SQL(
+                "CREATE TABLE IF NOT EXISTS {} (LIKE {} INCLUDING DEFAULTS, "
+                "archived_at TIMESTAMPTZ NOT NULL DEFAULT now(), PRIMARY KEY ({}))"
+            ).format(
+                sql.Identifier(archive),
+                sql.Identifier(self.table_name()),
+                sql.SQL(", ").join(sql.Identifier(c) for c in self.primary_key()),
+            ))
+
+    def _name_partition_constraints(self, cur) -> None:
+        """
+        Секции получают UNIQUE-индексы с автоматическими именами, и нарушение ограничения
+        сообщает имя индекса секции. Переименовываем их в "<ограничение>__<секция>",
+        чтобы describe_db_error узнал исходное ограничение.
+        """
+        cur.execute(
+            "SELECT ci.relname, pc.conname, ct.relname "
+            "FROM pg_constraint pc "
+            "JOIN pg_inherits i ON i.inhparent = pc.conindid "
+            "JOIN pg_class ci ON ci.oid = i.inhrelid "
+            "JOIN pg_index x ON x.indexrelid = ci.oid "
+            "JOIN pg_class ct ON ct.oid = x.indrelid "
+            "WHERE pc.conrelid = %s::regclass AND pc.contype = 'u'",
+            (self.table_name(),),
+        )
+        for index_name, constraint, partition in cur.fetchall():
+            suffix = partition.removeprefix(self.table_name() + "_")
+            cur.execute(sql.SQL("ALTER INDEX {} RENAME TO {}").format(
+                sql.Identifier(index_name),
+                sql.Identifier(f"{constraint}__{suffix}"),
+            ))
+
+    def _partition_bounds(self, part: dict) -> list[sql.Composable]:
+        method = part["method"]
+        if method == "hash":
+            n = part["partitions"]
+            return [sql.SQL("WITH (MODULUS {}, REMAINDER {})").format(sql.Literal(n), sql.Literal(i)) for i in range(n)]
+        if method == "list":
+            return [sql.SQL(f"IN ({v})") for v in part["partitions"].values()]
+        if method == "range":
+            return [sql.SQL(f"FROM ({lo}) TO ({hi})") for lo, hi in part["partitions"].values()]
+        raise ValueError(f"Неизвестный метод секционирования {method!r}")
+
+    def _try_ddl(self, cur, q) -> bool:
+        """Выполнить необязательный DDL под savepoint: ошибка не ломает create()."""
+        cur.execute("SAVEPOINT optional_ddl")
+        try:
+            cur.execute(q)
+        except psycopg2.Error:
+            cur.execute("ROLLBACK TO SAVEPOINT optional_ddl")
+            return False
+        cur.execute("RELEASE SAVEPOINT optional_ddl")
+        return True
+
+    @tracing.traced
     def drop(self) -> None:
-        q = sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(self.table_name()))
-        cur = self.dbconn.conn.cursor()
+        names = [self.table_name(), self.tombstone_table_name()]
+        if self.archive_table_name():
+            names.append(self.archive_table_name())
+        q = sql.SQL("DROP TABLE IF EXISTS {}").format(sql.SQL(", ").join(sql.Identifier(n) for n in names))
+        cur = self._write_cursor()
+        for suffix in self.materialized_views():
+            # представления зависят от таблицы: без этого DROP TABLE не пройдёт
+            cur.execute(sql.SQL("DROP MATERIALIZED VIEW IF EXISTS {}").format(
+                sql.Identifier(self.view_name(suffix)),
+            ))
         cur.execute(q)
+        cur.execute(sql.SQL("DROP FUNCTION IF EXISTS {}()").format(
+            sql.Identifier(f"{self.table_name()}_tombstone_fn"),
+        ))
         self.dbconn.conn.commit()
+        if self.unique_index is not None:
+            self.unique_index.reset()
 
-    # SELECT 
-    def all(self) -> list[tuple]:
-        q = sql.SQL("SELECT * FROM {} ORDER BY {}").format(
-            sql.Identifier(self.table_name()),
+    @tracing.traced
+    def refresh_views(self, concurrently: bool = True) -> None:
+        """
+        Пересчитать materialized_views(). CONCURRENTLY не блокирует читателей представления,
+        но медленнее обычного REFRESH.
+        """
+        cur = self.dbconn.conn.cursor()
+        for suffix in self.materialized_views():
+            cur.execute(sql.SQL("REFRESH MATERIALIZED VIEW {}{}").format(
+                sql.SQL("CONCURRENTLY ") if concurrently else sql.SQL(""),
+                sql.Identifier(self.view_name(suffix)),
+            ))
+        self.dbconn.conn.commit()
+
+    # SELECT
+    def source(self, include_archived: bool = False) -> sql.Composable:
+        """Источник строк для FROM: сама таблица или она вместе с архивом (под тем же именем)."""
+        if not include_archived or not self.archive_table_name():
+            return sql.Identifier(self.table_name())
+
+        cols = sql.SQL(", ").join(
+            sql.Identifier(c) for c in self.column_names() + list(self.service_columns())
+        )
+        return sql.SQL("(SELECT {cols} FROM {hot} UNION ALL SELECT {cols} FROM {cold}) AS {hot}").format(
+            cols=cols,
+            hot=sql.Identifier(self.table_name()),
+            cold=sql.Identifier(self.archive_table_name()),
+        )
+
+    def select(self, *columns: str, include_archived: bool = False) -> Query:
+        """Построитель запроса: select(...).where(...).order_by(...).limit(...).all()"""
+        return Query(self, columns, include_archived=include_archived)
+
+    @tracing.traced
+    def all(self, include_archived: bool = False) -> list[tuple]:
+        q = sql.SQL("SELECT {} FROM {} ORDER BY {}").format(
+            sql.SQL(", ").join(sql.Identifier(c) for c in self.column_names()),
+            self.source(include_archived),
             sql.SQL(", ").join(sql.Identifier(c) for c in self.primary_key()),
         )
-        cur = self.dbconn.conn.cursor()
+        cur = self.dbconn.read_conn().cursor()
         cur.execute(q)
         return cur.fetchall()
 
+    @tracing.traced
     def find_by_position(self, num: int) -> tuple | None:
         """
         Возвращает 1 запись по порядковому номеру (1..N) в сортировке по PK.
@@ -68,77 +384,406 @@ class DbTable:
         if num < 1:
             return None
 
-        q = sql.SQL("SELECT * FROM {} ORDER BY {} LIMIT 1 OFFSET {}").format(
+        q = sql.SQL("SELECT {} FROM {} ORDER BY {} LIMIT 1 OFFSET {}").format(
+            sql.SQL(", ").join(sql.Identifier(c) for c in self.column_names()),
             sql.Identifier(self.table_name()),
             sql.SQL(", ").join(sql.Identifier(c) for c in self.primary_key()),
             sql.Placeholder("offset"),
         )
-        cur = self.dbconn.conn.cursor()
+        cur = self.dbconn.read_conn().cursor()
         cur.execute(q, {"offset": num - 1})
         return cur.fetchone()
 
-    def count(self) -> int:
-        q = sql.SQL("SELECT COUNT(*) FROM {}").format(sql.Identifier(self.table_name()))
-        cur = self.dbconn.conn.cursor()
+    @tracing.traced
+    def count(self, include_archived: bool = False) -> int:
+        q = sql.SQL("SELECT COUNT(*) FROM {}").format(self.source(include_archived))
+        cur = self.dbconn.read_conn().cursor()
         cur.execute(q)
         return int(cur.fetchone()[0])
 
-    # INSERT 
-    def insert_one(self, vals: list | tuple) -> bool:
-        cols = self.column_names_without_pk()
+    # CHANGE FEED
+    @tracing.traced
+    def changes_since(self, watermark: int = 0) -> tuple[list[tuple], list[tuple], int]:
+        """
+        Изменения с прошлой синхронизации: (вставленные/изменённые строки, PK удалённых, новый водяной знак).
+        Первый вызов — changes_since(0); дальше передаётся водяной знак из предыдущего ответа.
+
+        Водяной знак — xmin снимка: все транзакции младше него уже завершены, поэтому
+        ни одно изменение не теряется. Изменения транзакций, идущих во время вызова,
+        могут прийти повторно в следующий раз (доставка "хотя бы один раз").
+        """
+        # все три запроса на одном соединении: водяной знак и строки с одного сервера
+        conn = self.dbconn.conn
+        cur = conn.cursor()
+        cur.execute("SELECT txid_snapshot_xmin(txid_current_snapshot())")
+        new_watermark = int(cur.fetchone()[0])
+
+        changed = (
+            self.select()
+            .where("change_txid", watermark, ">=")
+            .order_by(*self.primary_key())
+            .all(conn)
+        )
+
+        q = sql.SQL("SELECT {} FROM {} WHERE change_txid >= {} ORDER BY change_txid").format(
+            sql.SQL(", ").join(sql.Identifier(c) for c in self.primary_key()),
+            sql.Identifier(self.tombstone_table_name()),
+            sql.Placeholder(),
+        )
+        cur.execute(q, (watermark,))
+        deleted = cur.fetchall()
+        return changed, deleted, new_watermark
+
+    @tracing.traced
+    def data_version(self, conn=None) -> str:
+        """
+        Дешёвая метка версии данных: меняется при каждом commit со вставкой, изменением
+        или удалением. Подходит для ETag и ключей кеша.
+
+        Читается из счётчика dbtable_version, который увеличивается при фиксации
+        транзакции (а не по txid), поэтому prune_tombstones() её не меняет, а прежняя
+        метка не повторяется. По умолчанию читается с соединения для чтения;
+        conn — в транзакции вызывающего.
+        """
+        cur = (conn or self.dbconn.read_conn()).cursor()
+        cur.execute("SELECT version FROM dbtable_version WHERE table_name = %s", (self.table_name(),))
+        row = cur.fetchone()
+        return str(row[0] if row else 0)
+
+    def read_versioned(self, fn, attempts: int = 3) -> tuple[str | None, object]:
+        """
+        (data_version(), fn(conn)) с одного соединения для чтения — результат соответствует
+        версии: версия читается до и после fn, при расхождении fn повторяется. Снимки
+        одного соединения не идут назад, поэтому равные версии значат, что между ними
+        никто не зафиксировал изменений таблицы. Версия None — результат кешировать нельзя:
+        таблица менялась на каждой попытке или в транзакции есть свои незафиксированные записи.
+        """
+        conn = self.dbconn.read_conn()
+        version = self.data_version(conn)
+        for _ in range(attempts):
+            result = fn(conn)
+            after = self.data_version(conn)
+            if after == version:
+                break
+            version = after
+        else:
+            version = None
+        if version is not None and not conn.autocommit:
+            # свои записи видны запросу, но версию увеличит только commit
+            cur = conn.cursor()
+            cur.execute("SELECT txid_current_if_assigned()")
+            if cur.fetchone()[0] is not None:
+                version = None
+        return version, result
+
+    @tracing.traced
+    def prune_tombstones(self, watermark: int) -> int:
+        """Удалить записи об удалениях, которые все потребители уже получили (старше watermark)."""
+        cur = self._write_cursor()
+        cur.execute(sql.SQL("DELETE FROM {} WHERE change_txid < %s").format(
+            sql.Identifier(self.tombstone_table_name()),
+        ), (watermark,))
+        pruned = cur.rowcount
+        self.dbconn.conn.commit()
+        return pruned
+
+    # тексты запросов записи: (запрос, параметры) для execute или DbConnection.pipeline()
+    def _returning(self, returning: bool) -> sql.Composable:
+        if not returning:
+            return sql.SQL("")
+        return sql.SQL(" RETURNING {}").format(sql.Identifier(self.primary_key()[0]))
 
-        q = sql.SQL("INSERT INTO {} ({}) VALUES ({})").format(
+    def insert_statement(self, vals: list | tuple, returning: bool = False) -> tuple[sql.Composed, list]:
+        cols = self.column_names_without_pk()
+        q = sql.SQL("INSERT INTO {} ({}) VALUES ({}){}").format(
             sql.Identifier(self.table_name()),
             sql.SQL(", ").join(sql.Identifier(c) for c in cols),
             sql.SQL(", ").join(sql.Placeholder() for _ in cols),
+            self._returning(returning),
         )
-        cur = self.dbconn.conn.cursor()
-        cur.execute(q, vals)
-        self.dbconn.conn.commit()
-        return True
+        return q, list(vals)
 
-    # UPDATE
-    def update_by_pk(self, pk_value, vals_dict: dict) -> bool:
+    def update_statement(self, pk_value, vals_dict: dict, returning: bool = False) -> tuple[sql.Composed, dict]:
         pk = self.primary_key()[0]
-
-        if pk in vals_dict:
-            vals_dict = dict(vals_dict)
-            vals_dict.pop(pk)
-
-        if not vals_dict:
-            return True
-
         set_parts = [
             sql.SQL("{} = {}").format(sql.Identifier(k), sql.Placeholder(k))
             for k in vals_dict.keys()
         ]
-
-        q = sql.SQL("UPDATE {} SET {} WHERE {} = {}").format(
+        q = sql.SQL("UPDATE {} SET {} WHERE {} = {}{}").format(
             sql.Identifier(self.table_name()),
             sql.SQL(", ").join(set_parts),
             sql.Identifier(pk),
             sql.Placeholder("pk"),
+            self._returning(returning),
         )
-
         params = dict(vals_dict)
         params["pk"] = pk_value
+        return q, params
 
-        cur = self.dbconn.conn.cursor()
+    def delete_statement(self, pk_value, returning: bool = False) -> tuple[sql.Composed, list]:
+        q = sql.SQL("DELETE FROM {} WHERE {} = {}{}").format(
+            sql.Identifier(self.table_name()),
+            sql.Identifier(self.primary_key()[0]),
+            sql.Placeholder(),
+            self._returning(returning),
+        )
+        return q, [pk_value]
+
+    # INSERT 
+    @tracing.traced
+    def insert_one(self, vals: list | tuple, commit: bool = True) -> bool:
+        cols = self.column_names_without_pk()
+        index = self.unique_index
+        if index is not None:
+            index.check(dict(zip(cols, vals)))
+
+        q, params = self.insert_statement(vals, returning=index is not None)
+        cur = self._write_cursor()
         cur.execute(q, params)
-        self.dbconn.conn.commit()
+        pk = cur.fetchone()[0] if index is not None else None
+        self._finish_write(commit)
+        if index is not None and commit:
+            index.put(pk, dict(zip(cols, vals)))
         return True
 
-    # DELETE
-    def delete_by_pk(self, pk_value) -> bool:
-        pk = self.primary_key()[0]
-        q = sql.SQL("DELETE FROM {} WHERE {} = {}").format(
+    @tracing.traced
+    def insert_returning(self, vals_dict: dict, commit: bool = True) -> tuple:
+        """Вставить строку из переданных колонок (остальные — DEFAULT) и вернуть её целиком."""
+        if self.unique_index is not None:
+            self.unique_index.check(vals_dict)
+        q = sql.SQL("INSERT INTO {} ({}) VALUES ({}) RETURNING {}").format(
             sql.Identifier(self.table_name()),
-            sql.Identifier(pk),
-            sql.Placeholder(),
+            sql.SQL(", ").join(sql.Identifier(c) for c in vals_dict),
+            sql.SQL(", ").join(sql.Placeholder(c) for c in vals_dict),
+            sql.SQL(", ").join(sql.Identifier(c) for c in self.column_names()),
         )
-        cur = self.dbconn.conn.cursor()
-        cur.execute(q, (pk_value,))
-        self.dbconn.conn.commit()
+        cur = self._write_cursor()
+        cur.execute(q, vals_dict)
+        row = cur.fetchone()
+        self._finish_write(commit)
+        if self.unique_index is not None and commit:
+            self.unique_index.put(row[self.column_names().index(self.primary_key()[0])],
+                                  dict(zip(self.column_names(), row)))
+        return row
+
+    @tracing.traced
+    def insert_many(self, rows: list[list | tuple], commit: bool = True) -> int:
+        """Вставить много строк одним INSERT ... VALUES (...), (...)."""
+        if not rows:
+            return 0
+        cols = self.column_names_without_pk()
+        index = self.unique_index
+        if index is not None:
+            for error in index.check_many([dict(zip(cols, r)) for r in rows]):
+                if error is not None:
+                    raise error
+
+        q = sql.SQL("INSERT INTO {} ({}) VALUES %s").format(
+            sql.Identifier(self.table_name()),
+            sql.SQL(", ").join(sql.Identifier(c) for c in cols),
+        )
+        if index is not None:
+            q += sql.SQL(" RETURNING {}").format(sql.Identifier(self.primary_key()[0]))
+        cur = self._write_cursor()
+        pks = execute_values(cur, q, rows, page_size=len(rows), fetch=index is not None)
+        self._finish_write(commit)
+        if index is not None and commit:
+            for (pk,), r in zip(pks, rows):
+                index.put(pk, dict(zip(cols, r)))
+        return len(rows)
+
+    # BATCH
+    def insert_batch(self, rows: list[list | tuple], chunk_size: int = 500) -> BatchReport:
+        """Вставить строки пакетом; строки, нарушающие ограничения, отклоняются поштучно."""
+        return self.apply_batch([("insert", tuple(r)) for r in rows], chunk_size)
+
+    @tracing.traced
+    def apply_batch(self, ops: list[tuple[str, object]], chunk_size: int = 500) -> BatchReport:
+        """
+        Выполнить операции ("insert", vals) / ("update", (pk, vals_dict)) / ("delete", pk)
+        в одной транзакции. Каждый кусок по chunk_size идёт под своим savepoint; если кусок
+        падает, он делится пополам, пока не останутся отдельные сбойные операции.
+        Годные операции фиксируются, сбойные возвращаются в BatchReport.errors — в том числе
+        неверно составленные (см. check_op), их в БД не отправляем. Любая другая ошибка
+        не из БД откатывает весь пакет и пробрасывается.
+        """
+        report = BatchReport()
+        indexed = self._check_ops(list(enumerate(ops)), report)
+        cur = self._write_cursor()
+        try:
+            if self.unique_index is not None:
+                indexed = self._precheck_inserts(indexed, report)
+            for start in range(0, len(indexed), chunk_size):
+                self._apply_bisect(cur, indexed[start:start + chunk_size], report)
+        except BaseException:
+            self.dbconn.conn.rollback()
+            raise
+        self._finish_write(True)
+        if self.unique_index is not None:
+            self.unique_index.refresh()
+        report.errors.sort(key=lambda e: e.index)
+        return report
+
+    def check_op(self, op: str, args) -> None:
+        """ValueError, если операция для apply_batch составлена неверно."""
+        if op == "insert":
+            ok = isinstance(args, (list, tuple)) and len(args) == len(self.column_names_without_pk())
+        elif op == "update":
+            ok = isinstance(args, (list, tuple)) and len(args) == 2 and isinstance(args[1], dict)
+        elif op == "delete":
+            ok = not isinstance(args, (list, tuple, dict))
+        else:
+            raise ValueError(f"неизвестная операция {op!r}")
+        if not ok:
+            raise ValueError(f"неверные аргументы для {op!r}")
+
+    def _check_ops(self, indexed: list[tuple[int, object]], report: BatchReport) -> list[tuple[int, tuple]]:
+        """Отсеять неверно составленные операции: каждая — своя запись в report.errors."""
+        valid = []
+        for i, item in indexed:
+            op, args = item if isinstance(item, (list, tuple)) and len(item) == 2 else (None, item)
+            try:
+                self.check_op(op, args)
+            except ValueError as e:
+                report.errors.append(BatchReport.row_error(i, op, args, e))
+            else:
+                valid.append((i, item))
+        return valid
+
+    def _precheck_inserts(self, indexed: list[tuple[int, tuple]], report: BatchReport) -> list[tuple[int, tuple]]:
+        """Отсеять вставки-дубликаты по unique_index (и внутри пакета) до отправки INSERT."""
+        cols = self.column_names_without_pk()
+        inserts = [(i, args) for i, (op, args) in indexed if op == "insert"]
+        verdicts = self.unique_index.check_many([dict(zip(cols, args)) for _, args in inserts])
+        rejected = set()
+        for (i, args), error in zip(inserts, verdicts):
+            if error is not None:
+                rejected.add(i)
+                report.errors.append(BatchReport.row_error(i, "insert", args, error))
+        return [item for item in indexed if item[0] not in rejected]
+
+    def _apply_bisect(self, cur, items: list[tuple[int, tuple]], report: BatchReport) -> None:
+        cur.execute("SAVEPOINT batch_chunk")
+        try:
+            self._apply_ops([op for _, op in items])
+        except (psycopg2.Error, DuplicateKeyError) as e:
+            cur.execute("ROLLBACK TO SAVEPOINT batch_chunk")
+            cur.execute("RELEASE SAVEPOINT batch_chunk")
+            if len(items) == 1:
+                index, (op, args) = items[0]
+                report.errors.append(BatchReport.row_error(index, op, args, e))
+                return
+            mid = len(items) // 2
+            self._apply_bisect(cur, items[:mid], report)
+            self._apply_bisect(cur, items[mid:], report)
+            return
+        cur.execute("RELEASE SAVEPOINT batch_chunk")
+        report.applied += len(items)
+
+    def _apply_ops(self, ops: list[tuple[str, object]]) -> None:
+        """Выполнить операции без commit; подряд идущие вставки — одним INSERT."""
+        inserts: list[tuple] = []
+        for op, args in ops:
+            if op == "insert":
+                inserts.append(args)
+                continue
+            self.insert_many(inserts, commit=False)
+            inserts = []
+            if op == "update":
+                self.update_by_pk(*args, commit=False)
+            elif op == "delete":
+                self.delete_by_pk(args, commit=False)
+            else:
+                raise ValueError(f"Неизвестная операция {op!r}")
+        self.insert_many(inserts, commit=False)
+
+    def _write_cursor(self):
+        """
+        Курсор для записи. Запись отмечается до выполнения: пока её транзакция не завершена
+        (в том числе при commit=False), чтения этого потока идут на primary.
+        """
+        self.dbconn.mark_write()
+        return self.dbconn.conn.cursor()
+
+    def _finish_write(self, commit: bool) -> None:
+        """commit=False — запись остаётся в текущей транзакции, фиксирует вызывающий."""
+        if commit:
+            self.dbconn.conn.commit()
+
+    # UPDATE
+    @tracing.traced
+    def update_by_pk(self, pk_value, vals_dict: dict, commit: bool = True) -> bool:
+        pk = self.primary_key()[0]
+
+        if pk in vals_dict:
+            vals_dict = dict(vals_dict)
+            vals_dict.pop(pk)
+
+        if not vals_dict:
+            return True
+        if self.unique_index is not None:
+            self.unique_index.check(vals_dict, pk=pk_value)
+
+        q, params = self.update_statement(pk_value, vals_dict)
+        cur = self._write_cursor()
+        cur.execute(q, params)
+        self._finish_write(commit)
+        if self.unique_index is not None and commit and cur.rowcount:
+            self.unique_index.put(pk_value, vals_dict)
+        return True
+
+    # ARCHIVE
+    @tracing.traced
+    def archive_inactive(self, older_than: str = "30 days", batch_size: int = 1000) -> int:
+        """
+        Перенести неактивные строки, не менявшиеся дольше older_than (интервал Postgres),
+        в archive_table_name(). Каждая пачка — отдельная транзакция, поэтому прерванный
+        перенос ничего не теряет и продолжается следующим вызовом. Возвращает число строк.
+        """
+        archive = self.archive_table_name()
+        if not archive or "is_active" not in self.columns():
+            raise ValueError(f"Таблица {self.table_name()} не поддерживает архивирование")
+
+        pk = sql.SQL(", ").join(sql.Identifier(c) for c in self.primary_key())
+        cols = sql.SQL(", ").join(
+            sql.Identifier(c) for c in self.column_names() + list(self.service_columns())
+        )
+        q = sql.SQL(
+            "WITH moved AS ("
+            " DELETE FROM {hot} WHERE ({pk}) IN ("
+            "  SELECT {pk} FROM {hot} WHERE NOT is_active AND updated_at < now() - {age}::interval"
+            "  ORDER BY {pk} LIMIT {batch} FOR UPDATE SKIP LOCKED)"
+            " RETURNING {cols})"
+            " INSERT INTO {cold} ({cols}) SELECT {cols} FROM moved"
+        ).format(
+            hot=sql.Identifier(self.table_name()),
+            cold=sql.Identifier(archive),
+            pk=pk,
+            cols=cols,
+            age=sql.Placeholder("age"),
+            batch=sql.Placeholder("batch"),
+        )
+
+        total = 0
+        cur = self._write_cursor()
+        while True:
+            cur.execute(q, {"age": older_than, "batch": batch_size})
+            moved = cur.rowcount
+            self.dbconn.conn.commit()
+            total += moved
+            if moved < batch_size:
+                break
+        return total
+
+    # DELETE
+    @tracing.traced
+    def delete_by_pk(self, pk_value, commit: bool = True) -> bool:
+        q, params = self.delete_statement(pk_value)
+        cur = self._write_cursor()
+        cur.execute(q, params)
+        self._finish_write(commit)
+        if self.unique_index is not None and commit:
+            self.unique_index.discard(pk_value)
         return True
 
 
@@ -0,0 +1,265 @@
+# loadgen.py
+"""
+Нагрузочный генератор: N потоков или процессов выполняют смесь операций
+StationsTable/RoutesTable против локального Postgres и по окончании печатают
+пропускную способность, перцентили задержек, ошибки по ограничениям и
+ожидания блокировок (pg_stat_activity) по времени.
+
+    python loadgen.py --setup --stations 200 --routes 2000
+    python loadgen.py --workers 16 --mode process --duration 30 \\
+        --mix read=50,routes=20,insert=10,update=15,delete=5
+"""
+from __future__ import annotations
+
+import argparse
+import multiprocessing
+import queue
+import random
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+
+import psycopg2
+
+from dbconnection import DbConnection, DBConfig
+from dberrors import CONSTRAINT_MESSAGES, constraint_of
+from tables.routes_table import RoutesTable
+from tables.stations_table import StationsTable
+
+OPERATIONS = ("read", "routes", "insert", "update", "delete")
+DEFAULT_MIX = "read=50,routes=20,insert=10,update=15,delete=5"
+
+
+@dataclass
+class WorkerStats:
+    latencies: dict[str, list[float]] = field(default_factory=dict)  # операция -> секунды
+    errors: Counter = field(default_factory=Counter)  # (операция, ограничение или класс ошибки) -> число
+
+    def merge(self, other: WorkerStats) -> None:
+        for op, samples in other.latencies.items():
+            self.latencies.setdefault(op, []).extend(samples)
+        self.errors.update(other.errors)
+
+
+def parse_mix(text: str) -> dict[str, int]:
+    mix = {}
+    for part in text.split(","):
+        op, _, weight = part.partition("=")
+        op = op.strip()
+        if op not in OPERATIONS:
+            raise ValueError(f"Неизвестная операция {op!r}; доступны: {', '.join(OPERATIONS)}")
+        mix[op] = int(weight)
+    if sum(mix.values()) <= 0:
+        raise ValueError("Сумма весов должна быть > 0")
+    return mix
+
+
+def percentile(ordered: list[float], q: float) -> float:
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+# работа одного клиента
+class Client:
+    """Один нагрузочный клиент: своё соединение, свои таблицы, свой генератор случайных чисел."""
+
+    def __init__(self, worker_id: int, station_ids: tuple[int, int], seed: int):
+        self.worker_id = worker_id
+        self.lo, self.hi = station_ids
+        self.rnd = random.Random(seed + worker_id)
+        self.dbconn = DbConnection(DBConfig())
+        self.dbconn.connect()
+        self.stations = StationsTable(self.dbconn)
+        self.routes = RoutesTable(self.dbconn)
+        self._seq = 0
+
+    def station_id(self) -> int:
+        return self.rnd.randint(self.lo, self.hi)
+
+    def op_read(self) -> None:
+        self.stations.select().where("station_id", self.station_id()).first()
+
+    def op_routes(self) -> None:
+        self.routes.all_by_start_station(self.station_id())
+
+    def op_insert(self) -> None:
+        # случайные пары станций: дубликаты и петли дают живые нарушения ограничений
+        self._seq += 1
+        self.routes.insert_one([self.station_id(), self.station_id(), f"lg-{self.worker_id}-{self._seq}", True])
+
+    def op_update(self) -> None:
+        # горячие строки станций: конкурирующие UPDATE ждут друг друга на блокировках строк
+        self.stations.update_by_pk(self.station_id(), {"tariff_zone": self.rnd.randint(0, 5)})
+
+    def op_delete(self) -> None:
+        row = self.routes.select("route_id").where("start_station_id", self.station_id()).first()
+        if row is not None:
+            self.routes.delete_by_pk(row[0])
+
+    def run(self, mix: dict[str, int], deadline: float, done) -> WorkerStats:
+        ops = list(mix)
+        weights = [mix[op] for op in ops]
+        stats = WorkerStats()
+        try:
+            while time.monotonic() < deadline:
+                op = self.rnd.choices(ops, weights)[0]
+                started = time.perf_counter()
+                try:
+                    getattr(self, "op_" + op)()
+                except psycopg2.Error as e:
+                    self.dbconn.conn.rollback()
+                    reason = constraint_of(e) or type(e).__name__
+                    stats.errors[(op, reason)] += 1
+                stats.latencies.setdefault(op, []).append(time.perf_counter() - started)
+                with done.get_lock():
+                    done.value += 1
+        finally:
+            self.dbconn.close()
+        return stats
+
+
+def _worker(worker_id, station_ids, seed, mix, duration, done, results):
+    # в режиме process — дочерний процесс: срок отсчитывается на месте, после подключения
+    client = Client(worker_id, station_ids, seed)
+    results.put(client.run(mix, time.monotonic() + duration, done))
+
+
+# наблюдение
+def sample_lock_waits(dbconn: DbConnection) -> int:
+    with dbconn.conn.cursor() as cur:
+        cur.execute(
+            "SELECT count(*) FROM pg_stat_activity "
+            "WHERE datname = current_database() AND wait_event_type = 'Lock'"
+        )
+        return cur.fetchone()[0]
+
+
+def run_load(workers: int, mode: str, duration: float, mix: dict[str, int], seed: int = 0,
+             interval: float = 1.0) -> tuple[WorkerStats, list[tuple[float, float, int]], float]:
+    """
+    Запустить нагрузку и дождаться окончания.
+    Возвращает (сводная статистика, [(секунда, операций/с, ожидающих блокировку)], фактическая длительность).
+    """
+    monitor = DbConnection(DBConfig())
+    monitor.connect()
+    monitor.conn.autocommit = True
+    stations = StationsTable(monitor)
+    lo = stations.select("station_id").order_by("station_id").first()
+    hi = stations.select("station_id").order_by("station_id", desc=True).first()
+    if lo is None:
+        monitor.close()
+        raise RuntimeError("Таблица станций пуста — запустите с --setup")
+
+    ctx = multiprocessing.get_context("spawn") if mode == "process" else None
+    done = (ctx or multiprocessing).Value("q", 0)
+    results = ctx.Queue() if ctx else queue.Queue()
+    args = [(i, (lo[0], hi[0]), seed, mix, duration, done, results) for i in range(workers)]
+    if ctx:
+        runners = [ctx.Process(target=_worker, args=a, daemon=True) for a in args]
+    else:
+        runners = [threading.Thread(target=_worker, args=a, daemon=True) for a in args]
+
+    timeline = []
+    started = time.monotonic()
+    for r in runners:
+        r.start()
+    try:
+        # результаты забираем по ходу: процесс не завершится, пока его данные лежат в канале очереди
+        total, pending = WorkerStats(), len(runners)
+        last_done, last_t = 0, started
+        while pending:
+            try:
+                total.merge(results.get(timeout=max(0.0, last_t + interval - time.monotonic())))
+                pending -= 1
+                continue
+            except queue.Empty:
+                pass
+            if not any(r.is_alive() for r in runners):
+                raise RuntimeError("Клиент нагрузки завершился без результата (см. ошибку выше)")
+            now = time.monotonic()
+            current = done.value
+            timeline.append((round(now - started, 1), (current - last_done) / (now - last_t), sample_lock_waits(monitor)))
+            last_done, last_t = current, now
+        elapsed = time.monotonic() - started
+    finally:
+        for r in runners:
+            r.join()
+        monitor.close()
+    return total, timeline, elapsed
+
+
+# подготовка данных и отчёт
+def setup(stations_count: int, routes_count: int, seed: int = 0) -> None:
+    dbconn = DbConnection(DBConfig())
+    dbconn.connect()
+    try:
+        stations, routes = StationsTable(dbconn), RoutesTable(dbconn)
+        routes.drop()
+        stations.drop()
+        stations.create()
+        routes.create()
+
+        stations.insert_many([[f"Станция {i}", i % 5, i, True] for i in range(1, stations_count + 1)])
+        ids = [r[0] for r in stations.select("station_id").all()]
+        rnd = random.Random(seed)
+        rows = [[rnd.choice(ids), rnd.choice(ids), None, True] for _ in range(routes_count)]
+        report = routes.insert_batch(rows)
+        print(f"Создано станций: {len(ids)}, маршрутов: {report.applied} (отсеяно {len(report.errors)})")
+    finally:
+        dbconn.close()
+
+
+def format_report(stats: WorkerStats, timeline: list, elapsed: float) -> str:
+    total = sum(len(s) for s in stats.latencies.values())
+    failed = sum(stats.errors.values())
+    lines = [
+        f"Операций: {total} за {elapsed:.1f} с — {total / elapsed:.1f} оп/с, ошибок: {failed}"
+        f" ({100 * failed / max(total, 1):.2f}%)",
+        "",
+        f"{'операция':<10}{'число':>8}{'ошибок':>8}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}{'max мс':>10}",
+    ]
+    for op in OPERATIONS:
+        samples = sorted(stats.latencies.get(op, ()))
+        if not samples:
+            continue
+        op_errors = sum(n for (o, _), n in stats.errors.items() if o == op)
+        lines.append(
+            f"{op:<10}{len(samples):>8}{op_errors:>8}"
+            + "".join(f"{percentile(samples, q) * 1000:>10.2f}" for q in (0.50, 0.95, 0.99))
+            + f"{samples[-1] * 1000:>10.2f}"
+        )
+
+    if stats.errors:
+        lines += ["", "Ошибки по ограничениям:"]
+        for (op, reason), n in stats.errors.most_common():
+            hint = CONSTRAINT_MESSAGES.get(reason, "")
+            lines.append(f"  {op:<8} {reason:<32} {n:>7}  {hint}")
+
+    lines += ["", f"{'с':>6}{'оп/с':>10}{'ждут блокировку':>18}"]
+    lines += [f"{t:>6}{rate:>10.1f}{waits:>18}" for t, rate, waits in timeline]
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Нагрузочный генератор для станций и маршрутов")
+    parser.add_argument("--workers", type=int, default=8, help="число параллельных клиентов")
+    parser.add_argument("--mode", choices=("thread", "process"), default="thread")
+    parser.add_argument("--duration", type=float, default=10.0, help="секунд нагрузки")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"веса операций, по умолчанию {DEFAULT_MIX}")
+    parser.add_argument("--interval", type=float, default=1.0, help="период выборки pg_stat_activity, с")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--setup", action="store_true", help="пересоздать таблицы и заполнить данными")
+    parser.add_argument("--stations", type=int, default=200, help="станций при --setup")
+    parser.add_argument("--routes", type=int, default=2000, help="маршрутов при --setup")
+    args = parser.parse_args()
+
+    if args.setup:
+        setup(args.stations, args.routes, args.seed)
+    stats, timeline, elapsed = run_load(
+        args.workers, args.mode, args.duration, parse_mix(args.mix), args.seed, args.interval
+    )
+    print(format_report(stats, timeline, elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -8,18 +8,29 @@
 Таблицы поезда и станции без связей с другими таблицами. Интерфейс только для станции начала и конца.
 """
 import psycopg2
-from psycopg2 import errors
+import psycopg2.extras
 
 from dbconnection import DbConnection
 from dbconnection import DBConfig
+from dberrors import DuplicateKeyError, describe_db_error
+import tracing
 
 from tables.stations_table import StationsTable
 from tables.routes_table import RoutesTable
 
+import tenants
+from autocomplete import PrefixTrie
+from pager import KeysetPager
+
 
 class Main:
+    SEARCH_LIMIT = 20
+    PAGE_SIZE = 20
+    QUERY_TIMEOUT_MS = 5000  # ни один запрос из меню не держит интерфейс дольше
+
     def __init__(self):
-        self.connection = DbConnection(DBConfig())
+        # соединение на поток: фоновая подгрузка страниц не делит транзакцию с меню
+        self.connection = DbConnection(DBConfig(), threadsafe=True)
 
         self.stations = StationsTable()
         self.stations.dbconn = self.connection
@@ -27,7 +38,15 @@ class Main:
         self.routes = RoutesTable()
         self.routes.dbconn = self.connection
 
+        # явные дубликаты названий и маршрутов отклоняются без запроса к БД
+        self.stations.enable_unique_precheck()
+        self.routes.enable_unique_precheck()
+
+        self._station_trie: PrefixTrie | None = None
+        self._station_pager = KeysetPager(self.stations, page_size=self.PAGE_SIZE)
+
 
+    @tracing.traced
     def _input_nonempty(self, prompt: str, max_len: int | None = None) -> str:
         while True:
             s = input(prompt).strip()
@@ -39,6 +58,7 @@ class Main:
                 continue
             return s
 
+    @tracing.traced
     def _input_int(self, prompt: str, *, min_value: int | None = None, strict_gt: int | None = None) -> int:
         while True:
             s = input(prompt).strip()
@@ -55,6 +75,7 @@ class Main:
                 continue
             return v
 
+    @tracing.traced
     def _input_bool(self, prompt: str, default: bool | None = None) -> bool:
         while True:
             s = input(prompt).strip().lower()
@@ -66,6 +87,7 @@ class Main:
                 return False
             print("Ошибка: введите y/n (да/нет).")
 
+    @tracing.traced
     def _input_optional_str(self, prompt: str, max_len: int | None = None) -> str | None:
         s = input(prompt).strip()
         if not s:
@@ -75,43 +97,31 @@ class Main:
             return self._input_optional_str(prompt, max_len=max_len)
         return s
 
-    def _safe_exec(self, fn, context: str):
+    def _safe_exec(self, fn, context: str, timeout: bool = True):
         """
         Выполнить БД-операцию, перехватить ошибки, сделать rollback,
-        вывести понятное сообщение.
+        вывести понятное сообщение. С timeout=True запросы ограничены QUERY_TIMEOUT_MS.
         """
         try:
-            return fn()
+            if not timeout:
+                return fn()
+            with self.connection.timeout(self.QUERY_TIMEOUT_MS):
+                return fn()
+        except DuplicateKeyError as e:
+            # найден до отправки INSERT/UPDATE, но операция могла успеть записать другое —
+            # откатываем, как и при ошибке БД (заодно unique_index сможет синхронизироваться)
+            self.connection.conn.rollback()
+            print(f"Ошибка: {e} {context}")
+            return None
         except ValueError as e:
             print(f"Ошибка: {e}")
             return None
         except psycopg2.Error as e:
             self.connection.conn.rollback()
 
-            if isinstance(e, errors.UniqueViolation):
-                constraint_name = getattr(e.diag, 'constraint_name', None)
-                if constraint_name == 'uq_station_name':
-                    print(f"Ошибка: станция с таким названием уже существует. {context}")
-                elif constraint_name == 'uq_station_line_order':
-                    print(f"Ошибка: станция с таким порядком на линии уже существует. {context}")
-                elif constraint_name == 'uq_route_start_end':
-                    print(f"Ошибка: маршрут между этими станциями уже существует. {context}")
-                else:
-                    print(f"Ошибка: нарушено уникальное ограничение ({constraint_name}). {context}")
-            elif isinstance(e, errors.CheckViolation):
-                constraint_name = getattr(e.diag, 'constraint_name', None)
-                if constraint_name == 'chk_station_tariff_zone':
-                    print(f"Ошибка: тарифная зона должна быть >= 0. {context}")
-                elif constraint_name == 'chk_station_line_order':
-                    print(f"Ошибка: порядок на линии должен быть > 0. {context}")
-                elif constraint_name == 'chk_route_start_end_not_same':
-                    print(f"Ошибка: начальная и конечная станции маршрута должны быть разными. {context}")
-                else:
-                    print(f"Ошибка: нарушено ограничение CHECK ({constraint_name}). {context}")
-            elif isinstance(e, errors.ForeignKeyViolation):
-                print(f"Ошибка: есть связанные записи (нарушение внешнего ключа). {context}")
-            elif isinstance(e, errors.NotNullViolation):
-                print(f"Ошибка: обязательное поле не заполнено. {context}")
+            msg = describe_db_error(e)
+            if msg is not None:
+                print(f"Ошибка: {msg} {context}")
             else:
                 msg = str(e).strip().split("\n")[0]
                 print(f"Ошибка БД: {context}")
@@ -120,7 +130,8 @@ class Main:
 
 
     # UI: printing/choosing
-    def _print_stations(self, stations: list[tuple]):
+    @tracing.traced
+    def _print_stations(self, stations: list[tuple], start: int = 1):
         if not stations:
             print("Станций нет.")
             return
@@ -128,15 +139,47 @@ class Main:
         print("\nСтанции:")
         print("№ | Название | Тарифная зона | Порядок на линии | Активна")
         print("--+----------+--------------+------------------+--------")
-        for i, row in enumerate(stations, start=1):
+        for i, row in enumerate(stations, start=start):
             _, name, tz, lo, active = row
             print(f"{i} | {name} | {tz} | {lo} | {'да' if active else 'нет'}")
 
-    def _choose_station_row(self, prompt: str) -> tuple | None:
-        stations = self.stations.all()
-        self._print_stations(stations)
+    def _station_index(self) -> PrefixTrie:
+        """Кеш станций в виде префиксного дерева по названию; сбрасывается после изменений."""
+        if self._station_trie is None:
+            self._station_trie = PrefixTrie.from_rows(self.stations.all(), key_index=1)
+        return self._station_trie
+
+    def _invalidate_stations(self) -> None:
+        self._station_trie = None
+        self._station_pager.reset()
+
+    def _find_stations(self, text: str) -> list[tuple]:
+        """Сначала автодополнение по началу названия из кеша, иначе поиск по фрагменту в БД."""
+        rows = self._station_index().complete(text, limit=self.SEARCH_LIMIT)
+        if not rows and text:
+            rows = self.stations.search(text, limit=self.SEARCH_LIMIT)
+        return rows
+
+    def _choose_station_row(self, prompt: str, on_screen: bool = False) -> tuple | None:
+        if on_screen:
+            raw = input("№ станции на экране (Enter — поиск по названию): ").strip()
+            if raw:
+                try:
+                    num = int(raw)
+                except ValueError:
+                    print("Ошибка: нужно целое число.")
+                    return None
+                row = self._station_pager.row_by_number(num)
+                if row is None:
+                    print("Ошибка: такого номера нет на экране.")
+                return row
+
+        text = input("Поиск станции (начало или часть названия, Enter — первые по алфавиту): ").strip()
+        stations = self._safe_exec(lambda: self._find_stations(text), "Не удалось найти станции.")
         if not stations:
+            print("Станций не найдено.")
             return None
+        self._print_stations(stations)
 
         idx = self._input_int(prompt, min_value=1)
         if idx > len(stations):
@@ -144,7 +187,8 @@ class Main:
             return None
         return stations[idx - 1]
 
-    def _print_routes(self, routes: list[tuple], end_name_resolver):
+    @tracing.traced
+    def _print_routes(self, routes: list[tuple], end_names: dict[int, str]):
         if not routes:
             print("Маршрутов для выбранной станции начала нет.")
             return
@@ -154,18 +198,24 @@ class Main:
         print("--+--------------+-------------------+--------")
         for i, r in enumerate(routes, start=1):
             route_id, start_id, end_id, route_name, active = r
-            end_name = end_name_resolver(end_id) or f"(station_id={end_id})"
+            end_name = end_names.get(end_id) or f"(station_id={end_id})"
             rn = route_name if route_name and str(route_name).strip() else "-"
             print(f"{i} | {end_name} | {rn} | {'да' if active else 'нет'}")
 
     def _station_name_by_id(self, station_id: int) -> str | None:
-        cur = self.connection.conn.cursor()
-        cur.execute(f"SELECT name FROM {self.stations.table_name()} WHERE station_id=%s", (station_id,))
-        row = cur.fetchone()
+        row = self.stations.select("name").where("station_id", station_id).first()
         return row[0] if row else None
 
+    def _station_names(self, station_ids) -> dict[int, str]:
+        """Названия станций одним запросом (вместо _station_name_by_id на каждую)."""
+        ids = sorted(set(station_ids))
+        if not ids:
+            return {}
+        return dict(self.stations.select("station_id", "name").where("station_id", ids, "IN").all())
+
 
     # Stations: CRUD via DbTable
+    @tracing.traced
     def station_add(self):
         name = self._input_nonempty("Название станции: ", max_len=200)
         tariff_zone = self._input_int("Тарифная зона (целое >= 0): ", min_value=0)
@@ -173,14 +223,16 @@ class Main:
         is_active = self._input_bool("Активна? (y/n) [y]: ", default=True)
 
         def op():
-            self.stations.insert_one([name, tariff_zone, line_order, is_active])
+            return self.stations.insert_one([name, tariff_zone, line_order, is_active])
 
         result = self._safe_exec(op, "Не удалось добавить станцию")
         if result is not None:
+            self._invalidate_stations()
             print("Станция добавлена.")
 
-    def station_edit(self):
-        row = self._choose_station_row("Введите № станции для редактирования: ")
+    @tracing.traced
+    def station_edit(self, on_screen: bool = False):
+        row = self._choose_station_row("Введите № станции для редактирования: ", on_screen)
         if not row:
             return
 
@@ -221,7 +273,7 @@ class Main:
         )
 
         def op():
-            self.stations.update_by_pk(
+            return self.stations.update_by_pk(
                 station_id,
                 {
                     "name": name,
@@ -233,10 +285,12 @@ class Main:
 
         result = self._safe_exec(op, "Не удалось обновить станцию")
         if result is not None:
+            self._invalidate_stations()
             print("Станция обновлена.")
 
-    def station_delete(self):
-        row = self._choose_station_row("Введите № станции для удаления: ")
+    @tracing.traced
+    def station_delete(self, on_screen: bool = False):
+        row = self._choose_station_row("Введите № станции для удаления: ", on_screen)
         if not row:
             return
 
@@ -247,30 +301,41 @@ class Main:
             return
 
         def op():
-            self.stations.delete_by_pk(station_id)
+            return self.stations.delete_by_pk(station_id)
 
         result = self._safe_exec(op, "Не удалось удалить станцию")
         if result is not None:
+            self._invalidate_stations()
             print("Станция удалена.")
 
+    @tracing.traced
     def stations_menu(self):
+        pager = self._station_pager
         while True:
-            stations = self.stations.all()
-            self._print_stations(stations)
+            stations = self._safe_exec(pager.rows, "Не удалось получить список станций.")
+            self._print_stations(stations or [], start=pager.first_number())
 
             print("\nСтанции (CRUD):")
             print("1 — добавить")
             print("2 — изменить")
             print("3 — удалить")
+            print("n — следующая страница")
+            print("p — предыдущая страница")
             print("0 — назад")
             c = input("> ").strip()
 
             if c == "1":
                 self.station_add()
             elif c == "2":
-                self.station_edit()
+                self.station_edit(on_screen=True)
             elif c == "3":
-                self.station_delete()
+                self.station_delete(on_screen=True)
+            elif c == "n":
+                if not self._safe_exec(pager.next_page, "Не удалось получить страницу."):
+                    print("Это последняя страница.")
+            elif c == "p":
+                if not pager.prev_page():
+                    print("Это первая страница.")
             elif c == "0":
                 return
             else:
@@ -278,6 +343,7 @@ class Main:
 
 
     # Routes: list/add/delete per start station
+    @tracing.traced
     def routes_menu(self):
         start_row = self._choose_station_row("Выберите станцию НАЧАЛА (введите №): ")
         if not start_row:
@@ -295,8 +361,12 @@ class Main:
             )
             if routes is None:
                 routes = []
+            end_names = self._safe_exec(
+                lambda: self._station_names(r[2] for r in routes),
+                "Не удалось получить названия станций.",
+            ) or {}
 
-            self._print_routes(routes, self._station_name_by_id)
+            self._print_routes(routes, end_names)
 
             print("\nМаршруты:")
             print("1 — добавить маршрут (к этой станции начала)")
@@ -313,19 +383,17 @@ class Main:
             else:
                 print("Неизвестная команда.")
 
+    @tracing.traced
     def route_add(self, start_station_id: int):
-        all_stations = self.stations.all()
-        if len(all_stations) < 2:
+        if self.stations.count() < 2:
             print("Нужно минимум 2 станции, чтобы добавить маршрут.")
             return
 
-        self._print_stations(all_stations)
-        end_idx = self._input_int("Введите № станции конца: ", min_value=1)
-        if end_idx > len(all_stations):
-            print("Ошибка: такого номера нет.")
+        end_row = self._choose_station_row("Введите № станции конца: ")
+        if not end_row:
             return
 
-        end_station_id, end_name, *_ = all_stations[end_idx - 1]
+        end_station_id, end_name, *_ = end_row
 
         if end_station_id == start_station_id:
             print("Ошибка: станция начала и конца не должны совпадать.")
@@ -335,17 +403,25 @@ class Main:
         is_active = self._input_bool("Активен? (y/n) [y]: ", default=True)
 
         def op():
-            if self._station_name_by_id(start_station_id) is None:
-                raise ValueError("Станция начала не найдена.")
-            if self._station_name_by_id(end_station_id) is None:
-                raise ValueError("Станция конца не найдена.")
-
-            self.routes.insert_one([start_station_id, end_station_id, route_name, is_active])
+            # проверки и вставка — одним обращением к серверу
+            with self.connection.pipeline() as p:
+                start = p.query(self.stations.select("name").where("station_id", start_station_id))
+                end = p.query(self.stations.select("name").where("station_id", end_station_id))
+                added = p.insert(self.routes, [start_station_id, end_station_id, route_name, is_active])
+            missing = "Станция начала не найдена." if not start.get() else \
+                "Станция конца не найдена." if not end.get() else None
+            if missing:
+                self.connection.conn.rollback()
+                raise ValueError(missing)
+            added.get()
+            self.connection.conn.commit()
+            return True
 
         result = self._safe_exec(op, "Не удалось добавить маршрут")
         if result is not None:
             print(f"Маршрут добавлен (конец: {end_name}).")
 
+    @tracing.traced
     def route_delete(self, routes: list[tuple]):
         if not routes:
             print("Удалять нечего: список маршрутов пуст.")
@@ -365,7 +441,7 @@ class Main:
             return
 
         def op():
-            self.routes.delete_by_pk(route_id)
+            return self.routes.delete_by_pk(route_id)
 
         result = self._safe_exec(op, "Не удалось удалить маршрут")
         if result is not None:
@@ -373,22 +449,44 @@ class Main:
 
 
     # Init menu (DDL via DbTable.create/drop)
+    @tracing.traced
     def init_menu(self):
         while True:
             print("\nИнициализация:")
             print("1 — создать таблицы (station, route)")
             print("2 — удалить таблицы (station, route)")
+            print("3 — перенести неактивные записи в архив")
             print("0 — назад")
             c = input("> ").strip()
 
             if c == "1":
-                self._safe_exec(lambda: self.stations.create(), "Не удалось создать station.")
-                self._safe_exec(lambda: self.routes.create(), "Не удалось создать route.")
+                self._invalidate_stations()
+                if self.connection.tenant:
+                    self._safe_exec(
+                        lambda: tenants.ensure_schema(self.connection), "Не удалось создать схему.", timeout=False
+                    )
+                self._safe_exec(lambda: self.stations.create(), "Не удалось создать station.", timeout=False)
+                self._safe_exec(lambda: self.routes.create(), "Не удалось создать route.", timeout=False)
                 print("Операция создания выполнена.")
             elif c == "2":
-                self._safe_exec(lambda: self.routes.drop(), "Не удалось удалить route.")
-                self._safe_exec(lambda: self.stations.drop(), "Не удалось удалить station.")
+                self._safe_exec(lambda: self.routes.drop(), "Не удалось удалить route.", timeout=False)
+                self._safe_exec(lambda: self.stations.drop(), "Не удалось удалить station.", timeout=False)
+                self._invalidate_stations()
                 print("Операция удаления выполнена.")
+            elif c == "3":
+                days = self._input_int("Неактивны дольше (дней, >= 0): ", min_value=0)
+                age = f"{days} days"
+                moved = self._safe_exec(
+                    lambda: self.stations.archive_inactive(age), "Не удалось архивировать station.", timeout=False
+                )
+                if moved is not None:
+                    self._invalidate_stations()
+                    print(f"Станций перенесено в архив: {moved}.")
+                moved = self._safe_exec(
+                    lambda: self.routes.archive_inactive(age), "Не удалось архивировать route.", timeout=False
+                )
+                if moved is not None:
+                    print(f"Маршрутов перенесено в архив: {moved}.")
             elif c == "0":
                 return
             else:
@@ -397,6 +495,9 @@ class Main:
 
     # Main loop
     def run(self):
+        # запросы ждут ответа через select(): Ctrl-C во время запроса отменяет его (conn.cancel())
+        # и приходит как QueryCanceled, а не вешает меню до конца запроса
+        psycopg2.extensions.set_wait_callback(psycopg2.extras.wait_select)
         with self.connection: 
             while True:
                 print("\nГлавное меню:")
@@ -414,6 +515,7 @@ class Main:
                     self.init_menu()
                 elif c == "9":
                     print("Выход.")
+                    self._station_pager.close()
                     return
                 else:
                     print("Неизвестная команда.")
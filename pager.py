@@ -0,0 +1,118 @@
+# pager.py
+from __future__ import annotations
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+
+class KeysetPager:
+    """
+    Постраничный просмотр таблицы по PK без OFFSET и без загрузки всей таблицы.
+
+    Страница n выбирается как "PK > последний PK страницы n-1 LIMIT page_size".
+    Пока пользователь смотрит текущую страницу, следующая подгружается в фоне.
+    Номера на экране сквозные: строка i страницы n имеет номер n * page_size + i + 1.
+    С DbConnection(threadsafe=True) фоновая подгрузка идёт через соединение потока
+    подгрузки; его транзакция чтения закрывается сразу после запроса.
+    """
+
+    KEEP_PAGES = 3
+
+    def __init__(self, table, page_size: int = 20, prefetch: bool = True):
+        self.table = table
+        self.page_size = page_size
+        self.current = 0
+
+        self._key = table.primary_key()[0]
+        self._key_index = table.column_names().index(self._key)
+        self._pages: dict[int, list[tuple]] = {}
+        self._last_keys: dict[int, object] = {}
+        self._pending: dict[int, Future] = {}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pager") if prefetch else None
+
+    def _query(self, after) -> list[tuple]:
+        q = self.table.select().order_by(self._key).limit(self.page_size)
+        if after is not None:
+            q.where(self._key, after, ">")
+        return q.all()
+
+    def _fetch(self, after) -> list[tuple]:
+        """_query в потоке подгрузки: не оставляем его соединение "idle in transaction"."""
+        dbconn = self.table.dbconn
+        try:
+            return self._query(after)
+        finally:
+            # без threadsafe поток подгрузки делит соединение с вызывающим — транзакция его
+            conn = dbconn.conn if dbconn.threadsafe else None
+            if conn is not None and conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+
+    def _load(self, n: int) -> list[tuple]:
+        rows = self._pages.get(n)
+        if rows is not None:
+            return rows
+
+        fut = self._pending.pop(n, None)
+        rows = fut.result() if fut else self._query(self._last_keys.get(n - 1))
+        self._pages[n] = rows
+        if rows:
+            self._last_keys[n] = rows[-1][self._key_index]
+        return rows
+
+    def _prefetch(self, n: int) -> None:
+        if self._executor is None or n in self._pages or n in self._pending:
+            return
+        if len(self._pages.get(n - 1, ())) < self.page_size:
+            return  # предыдущая страница неполная — дальше строк нет
+        self._pending[n] = self._executor.submit(self._fetch, self._last_keys[n - 1])
+
+    def _evict(self) -> None:
+        for n in list(self._pages):
+            if abs(n - self.current) > self.KEEP_PAGES // 2:
+                del self._pages[n]
+
+    # навигация
+    def rows(self) -> list[tuple]:
+        rows = self._load(self.current)
+        self._evict()
+        self._prefetch(self.current + 1)
+        return rows
+
+    def next_page(self) -> bool:
+        if len(self._load(self.current)) < self.page_size:
+            return False
+        if not self._load(self.current + 1):
+            return False
+        self.current += 1
+        return True
+
+    def prev_page(self) -> bool:
+        if self.current == 0:
+            return False
+        self.current -= 1
+        return True
+
+    def first_number(self) -> int:
+        return self.current * self.page_size + 1
+
+    def row_by_number(self, num: int) -> tuple | None:
+        """Строка по номеру на экране — только в пределах текущей страницы."""
+        page, i = divmod(num - 1, self.page_size)
+        rows = self._pages.get(self.current, [])
+        if num < 1 or page != self.current or i >= len(rows):
+            return None
+        return rows[i]
+
+    def reset(self) -> None:
+        for fut in self._pending.values():
+            fut.cancel()
+        self._pending.clear()
+        self._pages.clear()
+        self._last_keys.clear()
+        self.current = 0
+
+    def close(self) -> None:
+        self.reset()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
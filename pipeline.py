@@ -0,0 +1,233 @@
+# pipeline.py
+from __future__ import annotations
+
+import functools
+import json
+from datetime import date, datetime, time
+from decimal import Decimal
+
+import psycopg2
+import psycopg2.extras
+from psycopg2.extensions import connection as PgConnection
+
+import tracing
+from dberrors import DuplicateKeyError
+
+RESULTS_TABLE = "dbtable_pipeline"
+
+# дробные числа из JSON — Decimal: без потери точности NUMERIC, float получаем приведением
+_json_loads = functools.partial(json.loads, parse_float=Decimal)
+
+
+def _cast(value, sql_type: str | None):
+    """Значение из JSON — к типу, который psycopg2 вернул бы для колонки sql_type."""
+    if value is None or isinstance(value, bool):
+        return value
+    t = (sql_type or "").upper()
+    if t.startswith(("NUMERIC", "DECIMAL")):
+        return Decimal(value) if isinstance(value, int) else value
+    if isinstance(value, Decimal):
+        return float(value)
+    if not isinstance(value, str):
+        return value
+    if t.startswith("TIMESTAMP"):
+        return datetime.fromisoformat(value)
+    if t.startswith("TIME"):
+        return time.fromisoformat(value)
+    if t == "DATE":
+        return date.fromisoformat(value)
+    return value
+
+
+class PipelineResult:
+    """Результат одного запроса конвейера: строки (для записи — RETURNING PK) или ошибка."""
+
+    def __init__(self):
+        self.rows: list[tuple] | None = None
+        self.error: Exception | None = None
+
+    @property
+    def rowcount(self) -> int:
+        return len(self.get())
+
+    def get(self) -> list[tuple]:
+        if self.error is not None:
+            raise self.error
+        if self.rows is None:
+            raise RuntimeError("Конвейер ещё не выполнен")
+        return self.rows
+
+    def first(self) -> tuple | None:
+        rows = self.get()
+        return rows[0] if rows else None
+
+
+class Pipeline:
+    """
+    Несколько независимых запросов DbTable за одно обращение к серверу:
+
+        with dbconn.pipeline() as p:
+            start = p.query(stations.select("name").where("station_id", 1))
+            added = p.insert(routes, [1, 2, None, True])
+        start.first(), added.rowcount
+
+    psycopg2 не поддерживает pipeline mode libpq, поэтому запросы уходят одной
+    строкой из нескольких команд. Каждый обёрнут в
+        WITH s AS (<запрос>) INSERT INTO pg_temp.dbtable_pipeline SELECT <номер>, json_agg(s) FROM s,
+    а последняя команда забирает все результаты. Запросы выполняются по порядку
+    и видят изменения предыдущих. Строки приходят через JSON и приводятся обратно
+    к типам колонок: у query() — колонок выборки, у записи — PK (даты и время —
+    datetime/date/time, NUMERIC — Decimal), как при обычном чтении DbTable.
+    У execute() типы колонок передаются в types; без них значения остаются
+    такими, как в JSON (даты — строками ISO, дробные — float).
+
+    Весь конвейер идёт под savepoint в текущей транзакции соединения и без commit.
+    Если какой-то запрос упал, конвейер откатывается к savepoint и повторяется по
+    одному запросу под своим savepoint: ошибка попадает в результат только этого
+    запроса, остальные выполняются. Дубликат по unique_index таблицы — ошибка запроса
+    без отправки INSERT/UPDATE. Выполненные записи сразу переносятся в unique_index:
+    ключ из транзакции, которую потом откатят, проверка перепроверит в БД.
+
+    Выполняется на primary (conn), не на реплике: нужна временная таблица результатов.
+    """
+
+    def __init__(self, dbconn):
+        self.dbconn = dbconn
+        # (запрос, SQL-типы колонок результата или None, результат)
+        self._items: list[tuple[bytes | None, list[str] | None, PipelineResult]] = []
+        self._writes = False
+        # (результат, индекс, значения): после run() — put в индекс, для удаления (None) — discard
+        self._index_updates: list[tuple[PipelineResult, object, dict | None]] = []
+
+    # постановка в очередь
+    def query(self, q) -> PipelineResult:
+        """Query из DbTable.select()."""
+        conn = self.dbconn.conn
+        return self._add(conn.cursor().mogrify(q.rendered(conn), q.params()), q.column_types())
+
+    def insert(self, table, vals: list | tuple) -> PipelineResult:
+        if table.unique_index is not None:
+            try:
+                table.unique_index.check(dict(zip(table.column_names_without_pk(), vals)))
+            except DuplicateKeyError as e:
+                return self._failed(e)
+        result = self.execute(*table.insert_statement(vals, returning=True), write=True, types=self._pk_types(table))
+        self._track(table, result, dict(zip(table.column_names_without_pk(), vals)))
+        return result
+
+    def update(self, table, pk_value, vals_dict: dict) -> PipelineResult:
+        if table.unique_index is not None:
+            try:
+                table.unique_index.check(vals_dict, pk=pk_value)
+            except DuplicateKeyError as e:
+                return self._failed(e)
+        result = self.execute(*table.update_statement(pk_value, vals_dict, returning=True), write=True, types=self._pk_types(table))
+        self._track(table, result, vals_dict)
+        return result
+
+    def delete(self, table, pk_value) -> PipelineResult:
+        result = self.execute(*table.delete_statement(pk_value, returning=True), write=True, types=self._pk_types(table))
+        self._track(table, result, None)
+        return result
+
+    def execute(self, statement, params=None, write: bool = False, types: list[str] | None = None) -> PipelineResult:
+        """
+        Произвольный запрос; он должен возвращать строки (для записи — с RETURNING).
+        types — SQL-типы колонок результата по порядку, для приведения значений из JSON.
+        """
+        self._writes = self._writes or write
+        return self._add(self.dbconn.conn.cursor().mogrify(statement, params), types)
+
+    def _add(self, statement: bytes, types: list[str] | None = None) -> PipelineResult:
+        result = PipelineResult()
+        self._items.append((statement, types, result))
+        return result
+
+    @staticmethod
+    def _pk_types(table) -> list[str]:
+        return [table.columns()[table.primary_key()[0]][0]]
+
+    def _track(self, table, result: PipelineResult, vals: dict | None) -> None:
+        if table.unique_index is not None:
+            self._index_updates.append((result, table.unique_index, vals))
+
+    def _failed(self, error: Exception) -> PipelineResult:
+        result = PipelineResult()
+        result.error = error
+        self._items.append((None, None, result))
+        return result
+
+    # выполнение
+    def run(self) -> list[PipelineResult]:
+        """Отправить накопленные запросы; вернуть результаты в порядке постановки."""
+        items, self._items = self._items, []
+        updates, self._index_updates = self._index_updates, []
+        pending = [(i, stmt, types, res) for i, (stmt, types, res) in enumerate(items) if stmt is not None]
+        if pending:
+            conn = self.dbconn.conn
+            if conn.autocommit:
+                raise ValueError("Конвейер выполняется в транзакции: соединение не должно быть в autocommit")
+            if self._writes:
+                self.dbconn.mark_write()
+            with tracing.span("Pipeline.run", statements=len(pending)):
+                cur = conn.cursor()
+                psycopg2.extras.register_default_json(cur, loads=_json_loads)
+                try:
+                    cur.execute(self._flight(conn, pending))
+                except psycopg2.Error:
+                    cur.execute("ROLLBACK TO SAVEPOINT pipeline; RELEASE SAVEPOINT pipeline")
+                    conn.pipeline_ready = False
+                    self._run_one_by_one(cur, pending)
+                else:
+                    conn.pipeline_ready = True
+                    got = dict(cur.fetchall())
+                    for i, _, types, res in pending:
+                        res.rows = self._decode(got[i], types)
+        self._writes = False
+        for res, index, vals in updates:
+            for (pk,) in res.rows or ():
+                if vals is None:
+                    index.discard(pk)
+                else:
+                    index.put(pk, vals)
+        return [res for _, _, res in items]
+
+    @staticmethod
+    def _flight(conn: PgConnection, pending: list[tuple[int, bytes, list[str] | None, PipelineResult]]) -> bytes:
+        parts = [b"SAVEPOINT pipeline"]
+        if not conn.pipeline_ready:
+            # временная таблица живёт до конца сессии; после отката создавшей транзакции
+            # её не станет — тогда конвейер один раз пройдёт по одному запросу и создаст её снова
+            parts.append(f"CREATE TEMP TABLE IF NOT EXISTS {RESULTS_TABLE} (i INTEGER, rows JSON)".encode())
+        for i, stmt, _, _ in pending:
+            parts.append(
+                b"WITH s AS (" + stmt + b") INSERT INTO pg_temp." + RESULTS_TABLE.encode()
+                + f" SELECT {i}, COALESCE(json_agg(s), '[]') FROM s".encode()
+            )
+        parts.append(b"RELEASE SAVEPOINT pipeline")
+        parts.append(f"DELETE FROM pg_temp.{RESULTS_TABLE} RETURNING i, rows".encode())
+        return b"; ".join(parts)
+
+    def _run_one_by_one(self, cur, pending: list[tuple[int, bytes, list[str] | None, PipelineResult]]) -> None:
+        for _, stmt, types, res in pending:
+            try:
+                cur.execute(b"SAVEPOINT pipeline; WITH s AS (" + stmt + b") SELECT COALESCE(json_agg(s), '[]') FROM s")
+            except psycopg2.Error as e:
+                cur.execute("ROLLBACK TO SAVEPOINT pipeline")
+                res.error = e
+            else:
+                res.rows = self._decode(cur.fetchone()[0], types)
+            cur.execute("RELEASE SAVEPOINT pipeline")
+
+    @staticmethod
+    def _decode(rows: list[dict], types: list[str] | None) -> list[tuple]:
+        if types is None:
+            return [tuple(_cast(v, None) for v in r.values()) for r in rows]
+        return [tuple(_cast(v, t) for v, t in zip(r.values(), types)) for r in rows]
+
+    def __enter__(self) -> Pipeline:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if exc_type is None:
+            self.run()
@@ -0,0 +1,399 @@
+# server.py
+"""
+HTTP/JSON-сервис для станций и маршрутов — вторая точка входа рядом с консольным Main.
+
+    python server.py --host 0.0.0.0 --port 8080 --pool 8
+
+Эндпоинты:
+    GET    /stations                     список станций (ETag / If-None-Match -> 304)
+    POST   /stations                     создать станцию, тело — {"колонка": значение}
+    GET    /stations/{id}                одна станция
+    PATCH  /stations/{id}                изменить переданные колонки
+    DELETE /stations/{id}                удалить
+    GET    /stations/{id}/routes         маршруты, начинающиеся на станции (all_by_start_station)
+    GET|POST /routes, GET|PATCH|DELETE /routes/{id} — то же для маршрутов
+    POST   /batch                        [{"method", "path", "body"}, ...] — несколько запросов за раз
+    GET    /metrics                      задержки по эндпоинтам (p50/p95/p99, мс)
+
+Сервер — asyncio, запросы к БД выполняются в пуле из pool потоков. DbConnection(threadsafe=True)
+держит у каждого потока своё соединение, так что пул потоков — это и пул соединений.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import functools
+import json
+import re
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import urlsplit
+
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+from dbconnection import DbConnection, DBConfig
+from dberrors import DuplicateKeyError, constraint_of, describe_db_error
+from tables.routes_table import RoutesTable
+from tables.stations_table import StationsTable
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class LatencyMetrics:
+    """Последние WINDOW замеров на эндпоинт; вызывается только из потока event loop."""
+
+    WINDOW = 1024
+
+    def __init__(self):
+        self._samples: dict[str, deque] = {}
+        self._counts: dict[str, list[int]] = {}  # эндпоинт -> [запросов, ошибок 5xx]
+
+    def record(self, key: str, seconds: float, status: int) -> None:
+        self._samples.setdefault(key, deque(maxlen=self.WINDOW)).append(seconds)
+        counts = self._counts.setdefault(key, [0, 0])
+        counts[0] += 1
+        if status >= 500:
+            counts[1] += 1
+
+    def snapshot(self) -> dict:
+        result = {}
+        for key, samples in self._samples.items():
+            ordered = sorted(samples)
+            requests, failed = self._counts[key]
+            result[key] = {
+                "requests": requests,
+                "errors": failed,
+                "p50_ms": _percentile(ordered, 0.50),
+                "p95_ms": _percentile(ordered, 0.95),
+                "p99_ms": _percentile(ordered, 0.99),
+                "max_ms": round(ordered[-1] * 1000, 3),
+            }
+        return result
+
+
+def _percentile(ordered: list[float], q: float) -> float:
+    i = min(len(ordered) - 1, int(q * len(ordered)))
+    return round(ordered[i] * 1000, 3)
+
+
+class Service:
+    """Маршрутизация HTTP-запросов на методы DbTable."""
+
+    ROUTES = [
+        ("GET", r"/stations", "list_stations"),
+        ("GET", r"/stations/(\d+)/routes", "station_routes"),
+        ("GET", r"/(stations|routes)", "list_rows"),
+        ("POST", r"/(stations|routes)", "create_row"),
+        ("GET", r"/(stations|routes)/(\d+)", "get_row"),
+        ("PATCH", r"/(stations|routes)/(\d+)", "update_row"),
+        ("DELETE", r"/(stations|routes)/(\d+)", "delete_row"),
+        ("POST", r"/batch", "batch"),
+        ("GET", r"/metrics", "metrics_handler"),
+    ]
+
+    MAX_BODY = 1 << 20
+    MAX_BATCH = 100
+
+    def __init__(self, dbconn: DbConnection, pool_size: int = 8):
+        if not dbconn.threadsafe:
+            raise ValueError("Service требует DbConnection(threadsafe=True)")
+        self.dbconn = dbconn
+        self.tables = {"stations": StationsTable(dbconn), "routes": RoutesTable(dbconn)}
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="db")
+        self.metrics = LatencyMetrics()
+
+        self._routes = [(m, re.compile(p + r"/?"), p, name) for m, p, name in self.ROUTES]
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._stations_body: tuple[str, bytes] | None = None  # (версия, готовый JSON списка)
+
+    # работа с БД в пуле
+    async def db(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._call, fn, args)
+
+    def _call(self, fn, args):
+        try:
+            return fn(*args)
+        finally:
+            # запись уже зафиксирована методом DbTable; чтение и сбойная транзакция
+            # закрываются откатом — соединение пула не остаётся "idle in transaction"
+            conn = self.dbconn.conn
+            if conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+
+    # маршрутизация
+    async def dispatch(self, method: str, target: str, headers: dict, body: bytes) -> tuple[int, bytes, dict]:
+        """Обработать запрос; вернуть (статус, тело, доп. заголовки). Задержка попадает в metrics."""
+        started = time.perf_counter()
+        path = urlsplit(target).path
+        key = f"{method} ?"
+        try:
+            handler, key, args = self._resolve(method, path)
+            if method == "GET" and handler != self.metrics_handler:
+                # одинаковые GET, пришедшие одновременно, делят один запрос к БД
+                status, payload, extra = await self._coalesced(f"{target}|{headers.get('if-none-match')}",
+                                                               handler, args, headers)
+            else:
+                status, payload, extra = await handler(*args, headers=headers, body=body)
+        except HttpError as e:
+            status, payload, extra = e.status, {"error": e.message}, {}
+        except psycopg2.DataError as e:
+            # значение из запроса не подходит колонке: неверный тип, выход за диапазон
+            status, payload, extra = 400, {"error": str(e).strip().split("\n")[0]}, {}
+        except (psycopg2.Error, DuplicateKeyError) as e:
+            message = describe_db_error(e)
+            if message is None:
+                status, payload = 500, {"error": str(e).strip().split("\n")[0]}
+            else:
+                status, payload = 409, {"error": message, "constraint": constraint_of(e)}
+            extra = {}
+        except Exception:
+            traceback.print_exc()
+            status, payload, extra = 500, {"error": "внутренняя ошибка сервера"}, {}
+
+        data = payload if isinstance(payload, bytes) else _dumps(payload) if payload is not None else b""
+        self.metrics.record(key, time.perf_counter() - started, status)
+        return status, data, extra
+
+    def _resolve(self, method: str, path: str):
+        allowed = False
+        for m, rx, pattern, name in self._routes:
+            match = rx.fullmatch(path)
+            if match is None:
+                continue
+            if m != method:
+                allowed = True
+                continue
+            return getattr(self, name), f"{method} {pattern}", match.groups()
+        if allowed:
+            raise HttpError(405, "метод не поддерживается")
+        raise HttpError(404, "не найдено")
+
+    async def _coalesced(self, key: str, handler, args, headers):
+        # общий запрос — отдельная задача: отмена пришедшего первым (клиент ушёл)
+        # не отменяет её для остальных ждущих
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(handler(*args, headers=headers, body=b""))
+            self._inflight[key] = task
+            task.add_done_callback(functools.partial(self._coalesced_done, key))
+        return await asyncio.shield(task)
+
+    def _coalesced_done(self, key: str, task: asyncio.Future) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # помечаем как полученное, если ждущих не осталось
+
+    # обработчики
+    async def list_stations(self, headers, body):
+        stations = self.tables["stations"]
+        version = await self.db(stations.data_version)
+        etag = f'"{version}"'
+        if etag in _etags(headers.get("if-none-match", "")):
+            return 304, None, {"ETag": etag}
+
+        cached = self._stations_body
+        if cached is None or cached[0] != version:
+            # версия и строки — с одного соединения: ETag описывает именно это тело
+            def read(conn):
+                return stations.select().order_by(*stations.primary_key()).all(conn)
+
+            version, rows = await self.db(stations.read_versioned, read)
+            body = _dumps(_as_dicts(stations, rows))
+            if version is None:
+                return 200, body, {}
+            cached = self._stations_body = (version, body)
+        return 200, cached[1], {"ETag": f'"{cached[0]}"'}
+
+    async def station_routes(self, station_id, headers, body):
+        routes = self.tables["routes"]
+        rows = await self.db(routes.all_by_start_station, int(station_id))
+        return 200, _as_dicts(routes, rows), {}
+
+    async def list_rows(self, resource, headers, body):
+        table = self.tables[resource]
+        return 200, _as_dicts(table, await self.db(table.all)), {}
+
+    async def get_row(self, resource, pk, headers, body):
+        table = self.tables[resource]
+        return 200, await self._fetch(table, int(pk)), {}
+
+    async def create_row(self, resource, headers, body):
+        table = self.tables[resource]
+        vals = self._columns_from(table, body)
+        row = await self.db(table.insert_returning, vals)
+        return 201, dict(zip(table.column_names(), row)), {}
+
+    async def update_row(self, resource, pk, headers, body):
+        table = self.tables[resource]
+        vals = self._columns_from(table, body)
+        await self._fetch(table, int(pk))
+        await self.db(table.update_by_pk, int(pk), vals)
+        return 200, await self._fetch(table, int(pk)), {}
+
+    async def delete_row(self, resource, pk, headers, body):
+        table = self.tables[resource]
+        await self._fetch(table, int(pk))
+        await self.db(table.delete_by_pk, int(pk))
+        return 204, None, {}
+
+    async def batch(self, headers, body):
+        items = _loads(body)
+        if not isinstance(items, list) or len(items) > self.MAX_BATCH:
+            raise HttpError(400, f"ожидается список не длиннее {self.MAX_BATCH} запросов")
+
+        async def one(item):
+            path = item.get("path") if isinstance(item, dict) else None
+            method = item.get("method", "GET") if isinstance(item, dict) else None
+            if not isinstance(path, str) or not isinstance(method, str) or path.startswith("/batch"):
+                return {"status": 400, "body": {"error": "неверный элемент пакета"}}
+            sub_body = json.dumps(item["body"]).encode() if "body" in item else b""
+            status, data, _ = await self.dispatch(method.upper(), path, {}, sub_body)
+            return {"status": status, "body": json.loads(data) if data else None}
+
+        return 200, await asyncio.gather(*(one(item) for item in items)), {}
+
+    async def metrics_handler(self, headers, body):
+        return 200, self.metrics.snapshot(), {}
+
+    # вспомогательное
+    async def _fetch(self, table, pk: int) -> dict:
+        row = await self.db(lambda: table.select().where(table.primary_key()[0], pk).first())
+        if row is None:
+            raise HttpError(404, "запись не найдена")
+        return dict(zip(table.column_names(), row))
+
+    @staticmethod
+    def _columns_from(table, body: bytes) -> dict:
+        vals = _loads(body)
+        if not isinstance(vals, dict) or not vals:
+            raise HttpError(400, "ожидается JSON-объект с колонками")
+        unknown = set(vals) - set(table.column_names_without_pk())
+        if unknown:
+            raise HttpError(400, f"неизвестные колонки: {', '.join(sorted(unknown))}")
+        return vals
+
+    # HTTP/1.1
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request = await _read_request(reader, self.MAX_BODY)
+                if request is None:
+                    break
+                method, target, version, headers, body = request
+                status, data, extra = await self.dispatch(method, target, headers, body)
+
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                writer.write(_response(status, data, extra, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except HttpError as e:
+            writer.write(_response(e.status, _dumps({"error": e.message}), {}, False))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8080) -> asyncio.Server:
+        return await asyncio.start_server(self.handle_client, host, port)
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+        self.dbconn.close()
+
+
+async def _read_request(reader: asyncio.StreamReader, max_body: int):
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, target, version = line.decode("latin-1").split()
+    except ValueError:
+        raise HttpError(400, "неверная строка запроса")
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+        if len(headers) > 100:
+            raise HttpError(431, "слишком много заголовков")
+
+    raw_length = headers.get("content-length") or "0"
+    if not raw_length.isdigit():
+        raise HttpError(400, "неверный Content-Length")
+    length = int(raw_length)
+    if length > max_body:
+        raise HttpError(413, "слишком большое тело запроса")
+    body = await reader.readexactly(length) if length else b""
+    return method.upper(), target, version, headers, body
+
+
+def _response(status: int, data: bytes, extra: dict, keep_alive: bool) -> bytes:
+    lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}"]
+    if data:
+        lines.append("Content-Type: application/json; charset=utf-8")
+    lines.append(f"Content-Length: {len(data)}")
+    lines.append("Connection: " + ("keep-alive" if keep_alive else "close"))
+    lines.extend(f"{k}: {v}" for k, v in extra.items())
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + data
+
+
+def _etags(header: str) -> set[str]:
+    return {t.strip().removeprefix("W/") for t in header.split(",") if t.strip()}
+
+
+def _as_dicts(table, rows: list[tuple]) -> list[dict]:
+    names = table.column_names()
+    return [dict(zip(names, row)) for row in rows]
+
+
+def _dumps(payload) -> bytes:
+    return json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+
+
+def _loads(body: bytes):
+    try:
+        return json.loads(body or b"null")
+    except ValueError:
+        raise HttpError(400, "тело запроса — не JSON")
+
+
+async def serve(host: str, port: int, pool_size: int) -> None:
+    service = Service(DbConnection(DBConfig(), threadsafe=True), pool_size=pool_size)
+    server = await service.start(host, port)
+    print(f"Сервис слушает http://{host}:{port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="HTTP/JSON-сервис станций и маршрутов")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--pool", type=int, default=8, help="потоков (и соединений с БД) в пуле")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, args.pool))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
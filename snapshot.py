@@ -0,0 +1,269 @@
+# snapshot.py
+"""
+Локальный снимок станций и маршрутов в бинарном файле для чтения через mmap.
+
+    python snapshot.py export snapshot.bin   # выгрузить из БД
+    python snapshot.py info snapshot.bin     # заголовок снимка
+
+Формат (little-endian):
+    заголовок   HEADER: сигнатура, версия формата, число записей, смещения секций
+    станции     STATION × N, по возрастанию station_id
+    маршруты    ROUTE × M, по (start_station_id, route_id) — двоичный поиск по станции начала
+    порядок     uint32 × M: номера записей маршрутов по возрастанию route_id
+    строки      пул UTF-8 названий; запись хранит (смещение, длина), NULL — длина NULL_LEN
+
+При открытии читается только заголовок: записи разбираются при обращении,
+страницы файла подгружает ОС.
+"""
+from __future__ import annotations
+
+import argparse
+import mmap
+import os
+import struct
+import time
+from abc import ABC, abstractmethod
+
+from tables.routes_table import RoutesTable
+from tables.stations_table import StationsTable
+
+MAGIC = b"METROSNP"
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct("<8sHHIIdQQQQQII")
+STATION = struct.Struct("<qIIiiB3x")  # station_id, name (смещение, длина), tariff_zone, line_order, is_active
+ROUTE = struct.Struct("<qqqIIB3x")  # route_id, start_station_id, end_station_id, route_name (смещение, длина), is_active
+NULL_LEN = 0xFFFFFFFF
+
+
+class _StringPool:
+    def __init__(self):
+        self.data = bytearray()
+        self._seen: dict[str, tuple[int, int]] = {}
+
+    def add(self, text: str | None) -> tuple[int, int]:
+        if text is None:
+            return 0, NULL_LEN
+        ref = self._seen.get(text)
+        if ref is None:
+            raw = text.encode("utf-8")
+            ref = self._seen[text] = (len(self.data), len(raw))
+            self.data += raw
+        return ref
+
+
+def write_snapshot(path: str, stations: list[tuple], routes: list[tuple], source_version: str = "") -> None:
+    """
+    Записать снимок из строк в порядке колонок StationsTable/RoutesTable.
+    Файл пишется рядом и подменяется атомарно: открытые читатели дочитывают старую версию.
+    """
+    stations = sorted(stations, key=lambda r: r[0])
+    routes = sorted(routes, key=lambda r: (r[1], r[0]))
+    order = sorted(range(len(routes)), key=lambda i: routes[i][0])
+
+    pool = _StringPool()
+    body = bytearray()
+    for station_id, name, tariff_zone, line_order, is_active in stations:
+        body += STATION.pack(station_id, *pool.add(name), tariff_zone, line_order, is_active)
+    routes_off = HEADER.size + len(body)
+    for route_id, start_id, end_id, route_name, is_active in routes:
+        body += ROUTE.pack(route_id, start_id, end_id, *pool.add(route_name), is_active)
+    order_off = HEADER.size + len(body)
+    body += struct.pack(f"<{len(order)}I", *order)
+    version_ref = pool.add(source_version)
+    pool_off = HEADER.size + len(body)
+
+    header = HEADER.pack(
+        MAGIC, FORMAT_VERSION, 0, len(stations), len(routes), time.time(),
+        HEADER.size, routes_off, order_off, pool_off, len(pool.data), *version_ref,
+    )
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(header)
+        f.write(body)
+        f.write(pool.data)
+    os.replace(tmp, path)
+
+
+def export(path: str, dbconn) -> None:
+    """
+    Выгрузить обе таблицы из БД одним согласованным снимком (REPEATABLE READ):
+    строки и версия данных читаются в одной транзакции. Открытая транзакция
+    соединения сначала фиксируется — снимок должен видеть её записи.
+    """
+    conn = dbconn.connect()
+    conn.commit()
+    conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+    try:
+        stations, routes = StationsTable(dbconn), RoutesTable(dbconn)
+        version = f"{stations.data_version(conn)}/{routes.data_version(conn)}"
+        write_snapshot(
+            path,
+            stations.select().order_by("station_id").all(conn),
+            routes.select().order_by("start_station_id", "route_id").all(conn),
+            source_version=version,
+        )
+    finally:
+        conn.rollback()
+        conn.set_session(isolation_level="DEFAULT", readonly="DEFAULT")
+
+
+class Snapshot:
+    """Открытый снимок: mmap файла и разобранный заголовок."""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mm) < HEADER.size:
+            self.close()
+            raise ValueError(f"{path}: не снимок (файл слишком короткий)")
+
+        (magic, version, _flags, self.station_count, self.route_count, self.created_at,
+         self._stations_off, self._routes_off, self._order_off, self._pool_off, pool_len,
+         version_off, version_len) = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"{path}: не снимок (неверная сигнатура)")
+        if version != FORMAT_VERSION:
+            self.close()
+            raise ValueError(f"{path}: версия формата {version}, поддерживается {FORMAT_VERSION}")
+        if self._pool_off + pool_len > len(self._mm):
+            self.close()
+            raise ValueError(f"{path}: файл обрезан")
+        self.source_version = self._str(version_off, version_len)
+
+    def close(self) -> None:
+        self._mm.close()
+
+    def __enter__(self) -> Snapshot:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def _str(self, off: int, length: int) -> str | None:
+        if length == NULL_LEN:
+            return None
+        start = self._pool_off + off
+        return self._mm[start:start + length].decode("utf-8")
+
+    def station(self, i: int) -> tuple:
+        station_id, name_off, name_len, tariff_zone, line_order, is_active = \
+            STATION.unpack_from(self._mm, self._stations_off + i * STATION.size)
+        return station_id, self._str(name_off, name_len), tariff_zone, line_order, bool(is_active)
+
+    def route(self, i: int) -> tuple:
+        route_id, start_id, end_id, name_off, name_len, is_active = \
+            ROUTE.unpack_from(self._mm, self._routes_off + i * ROUTE.size)
+        return route_id, start_id, end_id, self._str(name_off, name_len), bool(is_active)
+
+    def route_by_rank(self, rank: int) -> tuple:
+        """Маршрут номер rank (с 0) в порядке route_id."""
+        (i,) = struct.unpack_from("<I", self._mm, self._order_off + rank * 4)
+        return self.route(i)
+
+    def route_start(self, i: int) -> int:
+        (start_id,) = struct.unpack_from("<q", self._mm, self._routes_off + i * ROUTE.size + 8)
+        return start_id
+
+
+class _SnapshotTable(ABC):
+    """Только чтение: all/count/find_by_position с той же семантикой, что у DbTable."""
+
+    source_table = None
+
+    def __init__(self, snapshot: Snapshot):
+        self.snapshot = snapshot
+
+    def column_names(self) -> list[str]:
+        return self.source_table().column_names()
+
+    def primary_key(self) -> list[str]:
+        return self.source_table().primary_key()
+
+    @abstractmethod
+    def _len(self) -> int:
+        ...
+
+    @abstractmethod
+    def _row(self, rank: int) -> tuple:
+        """Строка номер rank (с 0) в порядке PK."""
+
+    @staticmethod
+    def _hot_only(include_archived: bool) -> None:
+        if include_archived:
+            raise ValueError("Архив в снимок не входит")
+
+    def all(self, include_archived: bool = False) -> list[tuple]:
+        self._hot_only(include_archived)
+        return [self._row(i) for i in range(self._len())]
+
+    def count(self, include_archived: bool = False) -> int:
+        self._hot_only(include_archived)
+        return self._len()
+
+    def find_by_position(self, num: int) -> tuple | None:
+        if num < 1 or num > self._len():
+            return None
+        return self._row(num - 1)
+
+
+class SnapshotStationsTable(_SnapshotTable):
+    source_table = StationsTable
+
+    def _len(self) -> int:
+        return self.snapshot.station_count
+
+    def _row(self, rank: int) -> tuple:
+        return self.snapshot.station(rank)
+
+
+class SnapshotRoutesTable(_SnapshotTable):
+    source_table = RoutesTable
+
+    def _len(self) -> int:
+        return self.snapshot.route_count
+
+    def _row(self, rank: int) -> tuple:
+        return self.snapshot.route_by_rank(rank)
+
+    def all_by_start_station(self, start_station_id: int, include_archived: bool = False) -> list[tuple]:
+        self._hot_only(include_archived)
+        snap = self.snapshot
+        lo, hi = 0, snap.route_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if snap.route_start(mid) < start_station_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        rows = []
+        while lo < snap.route_count and snap.route_start(lo) == start_station_id:
+            rows.append(snap.route(lo))
+            lo += 1
+        return rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Снимок станций и маршрутов для чтения без БД")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("export", help="выгрузить снимок из БД").add_argument("path")
+    sub.add_parser("info", help="показать заголовок снимка").add_argument("path")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        from dbconnection import DbConnection, DBConfig
+
+        dbconn = DbConnection(DBConfig())
+        try:
+            export(args.path, dbconn)
+        finally:
+            dbconn.close()
+    with Snapshot(args.path) as snap:
+        created = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(snap.created_at))
+        print(f"{args.path}: станций {snap.station_count}, маршрутов {snap.route_count}, "
+              f"создан {created}, версия данных {snap.source_version}")
+
+
+if __name__ == "__main__":
+    main()
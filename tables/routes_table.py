@@ -2,8 +2,10 @@
 from dbtable import *
 
 class RoutesTable(DbTable):
-    def table_name(self):
-        return self.dbconn.prefix + "route"
+    base_name = "route"
+
+    def archive_table_name(self):
+        return self.table_name() + "_archive"
 
     def columns(self):
         return {
@@ -23,8 +25,172 @@ class RoutesTable(DbTable):
             "CONSTRAINT uq_route_start_end UNIQUE (start_station_id, end_station_id)",
         ]
 
-    def all_by_start_station(self, start_station_id: int):
-        sql = "SELECT * FROM " + self.table_name() + " WHERE start_station_id = %(sid)s ORDER BY route_id"
-        cur = self.dbconn.conn.cursor()
-        cur.execute(sql, {"sid": start_station_id})
-        return cur.fetchall()
\ No newline at end of file
+    def partitioning(self):
+        # почти все запросы идут по станции начала: выборка затрагивает одну секцию
+        return {"method": "hash", "columns": ["start_station_id"], "partitions": 4}
+
+    def indexes(self):
+        return {
+            # кандидаты в архив: неактивные по давности изменения
+            "inactive_updated": "(updated_at) WHERE NOT is_active",
+            # обратный обход графа: uq_route_start_end покрывает только поиск по станции начала
+            "end_station": "(end_station_id)",
+        }
+
+    def materialized_views(self):
+        return {
+            # исходящие и входящие маршруты по станциям; станций без маршрутов здесь нет
+            "station_summary": {
+                "query": (
+                    "SELECT station_id, "
+                    "count(*) FILTER (WHERE outgoing) AS out_degree, "
+                    "count(*) FILTER (WHERE outgoing AND is_active) AS out_active, "
+                    "count(*) FILTER (WHERE NOT outgoing) AS in_degree, "
+                    "count(*) FILTER (WHERE NOT outgoing AND is_active) AS in_active "
+                    "FROM (SELECT start_station_id AS station_id, TRUE AS outgoing, is_active FROM {table} "
+                    "UNION ALL SELECT end_station_id, FALSE, is_active FROM {table}) r "
+                    "GROUP BY station_id"
+                ),
+                "unique": ["station_id"],
+            },
+        }
+
+    @tracing.traced
+    def summary(self, station_id: int | None = None) -> list[tuple]:
+        """
+        (station_id, out_degree, out_active, in_degree, in_active) из station_summary —
+        на момент последнего refresh_views().
+        """
+        q = sql.SQL(
+            "SELECT station_id, out_degree, out_active, in_degree, in_active FROM {}"
+        ).format(sql.Identifier(self.view_name("station_summary")))
+        params = []
+        if station_id is not None:
+            q += sql.SQL(" WHERE station_id = %s")
+            params.append(station_id)
+        q += sql.SQL(" ORDER BY station_id")
+        cur = self.dbconn.read_conn().cursor()
+        cur.execute(q, params)
+        return cur.fetchall()
+
+    @tracing.traced
+    def all_by_start_station(self, start_station_id: int, include_archived: bool = False):
+        return (
+            self.select(include_archived=include_archived)
+            .where("start_station_id", start_station_id)
+            .order_by("route_id")
+            .all()
+        )
+
+    # ГРАФ МАРШРУТОВ
+    # Обход выполняется в Postgres рекурсивными CTE: граф не загружается в память.
+    # Рекурсия с UNION (не UNION ALL) отбрасывает уже найденные строки — так обход
+    # завершается и на графах с циклами.
+    GRAPH_CACHE_SIZE = 256
+
+    def _cached(self, key: tuple, compute):
+        """
+        Результат запроса к графу, пока data_version() таблицы не изменилась.
+        compute(conn) выполняется на том же соединении, что и чтение версии (read_versioned).
+        """
+        cache = self.__dict__.setdefault("_graph_cache", {})
+        hit = cache.get(key)
+        if hit is not None and hit[0] == self.data_version():
+            return hit[1]
+        version, result = self.read_versioned(compute)
+        if version is None:
+            return result
+        if len(cache) >= self.GRAPH_CACHE_SIZE:
+            cache.clear()
+        cache[key] = (version, result)
+        return result
+
+    @staticmethod
+    def _graph_query(conn, q: sql.Composable, params: dict) -> list[tuple]:
+        cur = conn.cursor()
+        cur.execute(q, params)
+        return cur.fetchall()
+
+    @tracing.traced
+    def reachable_from(self, station_id: int, max_hops: int | None = None, active_only: bool = True) -> list[int]:
+        """Станции, до которых можно доехать от station_id (не более max_hops пересадок-маршрутов)."""
+        if max_hops is not None and max_hops < 1:
+            return []
+
+        if max_hops is None:
+            q = sql.SQL(
+                "WITH RECURSIVE r(station_id) AS ("
+                "SELECT %(start)s::bigint "
+                "UNION SELECT t.end_station_id FROM r JOIN {t} t ON t.start_station_id = r.station_id{active}"
+                ") SELECT station_id FROM r WHERE station_id <> %(start)s ORDER BY station_id"
+            )
+        else:
+            # глубина входит в строку, поэтому UNION ограничивает рекурсию по hops
+            q = sql.SQL(
+                "WITH RECURSIVE r(station_id, hops) AS ("
+                "SELECT %(start)s::bigint, 0 "
+                "UNION SELECT t.end_station_id, r.hops + 1 FROM r "
+                "JOIN {t} t ON t.start_station_id = r.station_id{active} WHERE r.hops < %(max_hops)s"
+                ") SELECT DISTINCT station_id FROM r WHERE station_id <> %(start)s ORDER BY station_id"
+            )
+        q = q.format(t=sql.Identifier(self.table_name()), active=self._active_filter(active_only))
+        params = {"start": station_id, "max_hops": max_hops}
+        return self._cached(
+            ("reachable_from", station_id, max_hops, active_only),
+            lambda conn: [r[0] for r in self._graph_query(conn, q, params)],
+        )
+
+    @tracing.traced
+    def path_exists(self, start_station_id: int, end_station_id: int, active_only: bool = True) -> bool:
+        """Есть ли путь по маршрутам; EXISTS останавливает обход на первой найденной станции."""
+        q = sql.SQL(
+            "WITH RECURSIVE r(station_id) AS ("
+            "SELECT t.end_station_id FROM {t} t WHERE t.start_station_id = %(start)s{active} "
+            "UNION SELECT t.end_station_id FROM r JOIN {t} t ON t.start_station_id = r.station_id{active}"
+            ") SELECT EXISTS (SELECT 1 FROM r WHERE station_id = %(end)s)"
+        ).format(t=sql.Identifier(self.table_name()), active=self._active_filter(active_only))
+        params = {"start": start_station_id, "end": end_station_id}
+        return self._cached(
+            ("path_exists", start_station_id, end_station_id, active_only),
+            lambda conn: self._graph_query(conn, q, params)[0][0],
+        )
+
+    @tracing.traced
+    def connected_components(self, active_only: bool = True) -> list[list[int]]:
+        """
+        Компоненты связности графа маршрутов без учёта направления; станции без маршрутов не входят.
+        Обход стартует только со станций, у которых нет соседа с меньшим id:
+        наименьшая станция компоненты всегда среди них и становится её меткой.
+        """
+        q = sql.SQL(
+            "WITH RECURSIVE seeds AS ("
+            "SELECT DISTINCT s.station_id FROM {t} e "
+            "CROSS JOIN LATERAL (VALUES (e.start_station_id), (e.end_station_id)) s(station_id) "
+            "WHERE TRUE{active_e} AND NOT EXISTS ("
+            "SELECT 1 FROM {t} t WHERE ((t.start_station_id = s.station_id AND t.end_station_id < s.station_id) "
+            "OR (t.end_station_id = s.station_id AND t.start_station_id < s.station_id)){active})"
+            "), r(root, station_id) AS ("
+            "SELECT station_id, station_id FROM seeds "
+            "UNION SELECT r.root, CASE WHEN t.start_station_id = r.station_id "
+            "THEN t.end_station_id ELSE t.start_station_id END "
+            "FROM r JOIN {t} t ON (t.start_station_id = r.station_id OR t.end_station_id = r.station_id){active}"
+            ") SELECT MIN(root) AS component, station_id FROM r GROUP BY station_id ORDER BY component, station_id"
+        ).format(
+            t=sql.Identifier(self.table_name()),
+            active=self._active_filter(active_only),
+            active_e=self._active_filter(active_only, "e"),
+        )
+
+        def compute(conn):
+            components: dict[int, list[int]] = {}
+            for component, station_id in self._graph_query(conn, q, {}):
+                components.setdefault(component, []).append(station_id)
+            return list(components.values())
+
+        return self._cached(("connected_components", active_only), compute)
+
+    @staticmethod
+    def _active_filter(active_only: bool, alias: str = "t") -> sql.Composable:
+        if not active_only:
+            return sql.SQL("")
+        return sql.SQL(" AND {}.is_active").format(sql.Identifier(alias))
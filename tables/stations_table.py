@@ -2,8 +2,10 @@
 from dbtable import *
 
 class StationsTable(DbTable):
-    def table_name(self):
-        return self.dbconn.prefix + "station"
+    base_name = "station"
+
+    def archive_table_name(self):
+        return self.table_name() + "_archive"
 
     def columns(self):
         return {
@@ -24,3 +26,37 @@ class StationsTable(DbTable):
             "CONSTRAINT uq_station_name UNIQUE (name)",
             "CONSTRAINT uq_station_line_order UNIQUE (line_order)",
         ]
+
+    def extensions(self):
+        return ["pg_trgm"]
+
+    def indexes(self):
+        return {
+            # префиксный поиск: lower(name) LIKE 'abc%'
+            "name_prefix": "(lower(name) text_pattern_ops)",
+            # поиск по фрагменту: lower(name) LIKE '%abc%'
+            "name_trgm": "USING gin (lower(name) public.gin_trgm_ops)",
+            # кандидаты в архив: неактивные по давности изменения
+            "inactive_updated": "(updated_at) WHERE NOT is_active",
+        }
+
+    @tracing.traced
+    def search(self, text: str, limit: int = 20) -> list[tuple]:
+        """
+        Станции, в названии которых есть text (без учёта регистра).
+        Сначала идут совпадения по началу названия, затем по фрагменту.
+        """
+        pattern = text.lower().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        q = sql.SQL(
+            "SELECT {} FROM {} WHERE lower(name) LIKE {} "
+            "ORDER BY lower(name) LIKE {} DESC, name LIMIT {}"
+        ).format(
+            sql.SQL(", ").join(sql.Identifier(c) for c in self.column_names()),
+            sql.Identifier(self.table_name()),
+            sql.Placeholder("fragment"),
+            sql.Placeholder("prefix"),
+            sql.Placeholder("limit"),
+        )
+        cur = self.dbconn.read_conn().cursor()
+        cur.execute(q, {"fragment": f"%{pattern}%", "prefix": f"{pattern}%", "limit": limit})
+        return cur.fetchall()
@@ -0,0 +1,103 @@
+# tenants.py
+"""
+Схема на арендатора: у каждого арендатора свои таблицы station/route (и служебные
+объекты DbTable) в схеме с его именем. Соединение с DB_TENANT=<имя> ставит
+search_path=<имя> при подключении, префикс DB_TABLE_PREFIX не используется,
+поэтому тексты запросов у всех арендаторов одинаковы.
+
+    python tenants.py create acme globex   # схемы и таблицы — одной транзакцией
+    python tenants.py drop globex          # DROP SCHEMA ... CASCADE
+    python tenants.py list
+"""
+from __future__ import annotations
+
+import argparse
+
+from psycopg2 import sql
+
+from dbconnection import DbConnection, DBConfig, check_tenant
+from tables.routes_table import RoutesTable
+from tables.stations_table import StationsTable
+
+TABLES = (StationsTable, RoutesTable)
+
+
+def provision(dbconn: DbConnection, tenants: list[str]) -> None:
+    """
+    Создать схемы арендаторов и их таблицы одной транзакцией: либо появятся все,
+    либо (при любой ошибке, в том числе если схема уже есть) ни одной.
+    """
+    tenants = [check_tenant(t) for t in tenants]
+    if not tenants:
+        return
+    # соединение в режиме арендатора — чтобы таблицы назывались без префикса;
+    # схему для каждого арендатора выбирает SET LOCAL search_path в той же транзакции
+    admin = dbconn.for_tenant(tenants[0])
+    conn = admin.connect()
+    try:
+        cur = conn.cursor()
+        for tenant in tenants:
+            cur.execute(sql.SQL("CREATE SCHEMA {}").format(sql.Identifier(tenant)))
+            cur.execute("SELECT set_config('search_path', %s, true)", (tenant,))
+            for table_cls in TABLES:
+                table_cls(admin).create(commit=False)
+        conn.commit()
+    finally:
+        admin.close()
+
+
+def ensure_schema(dbconn: DbConnection) -> None:
+    """Создать схему арендатора соединения, если её нет (таблицы — обычным create())."""
+    cur = dbconn.conn.cursor()
+    cur.execute(sql.SQL("CREATE SCHEMA IF NOT EXISTS {}").format(sql.Identifier(dbconn.tenant)))
+    dbconn.conn.commit()
+
+
+def teardown(dbconn: DbConnection, tenants: list[str]) -> None:
+    """Удалить схемы арендаторов со всем содержимым одним DROP SCHEMA."""
+    tenants = [check_tenant(t) for t in tenants]
+    if not tenants:
+        return
+    cur = dbconn.conn.cursor()
+    cur.execute(sql.SQL("DROP SCHEMA IF EXISTS {} CASCADE").format(
+        sql.SQL(", ").join(sql.Identifier(t) for t in tenants),
+    ))
+    dbconn.conn.commit()
+
+
+def list_tenants(dbconn: DbConnection) -> list[str]:
+    """Схемы, в которых есть таблица станций арендатора."""
+    cur = dbconn.conn.cursor()
+    cur.execute(
+        "SELECT n.nspname FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE c.relname = %s AND c.relkind IN ('r', 'p') AND n.nspname <> 'public' ORDER BY 1",
+        (StationsTable.base_name,),
+    )
+    rows = cur.fetchall()
+    dbconn.conn.commit()
+    return [r[0] for r in rows]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Схемы арендаторов")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("create", help="создать арендаторов").add_argument("tenants", nargs="+")
+    sub.add_parser("drop", help="удалить арендаторов").add_argument("tenants", nargs="+")
+    sub.add_parser("list", help="показать арендаторов")
+    args = parser.parse_args()
+
+    dbconn = DbConnection(DBConfig())
+    dbconn.connect()
+    try:
+        if args.command == "create":
+            provision(dbconn, args.tenants)
+        elif args.command == "drop":
+            teardown(dbconn, args.tenants)
+        for tenant in list_tenants(dbconn):
+            print(tenant)
+    finally:
+        dbconn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,30 @@
+import asyncio
+import datetime
+import http.client
+import json
+import queue
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
 import pytest
 import psycopg2
 from psycopg2 import errors
-from main import Main
 from dbconnection import DbConnection, DBConfig
-
-
-@pytest.fixture
-def db_connection():
-    """Фикстура для подключения к БД"""
-    config = DBConfig()
-    conn = DbConnection(config)
-    conn.connect()
-    yield conn
-    conn.close()
-
-
-@pytest.fixture
-def app(db_connection):
-    """Фикстура для создания экземпляра приложения"""
-    main_app = Main()
-    main_app.connection = db_connection
-    main_app.stations.dbconn = db_connection
-    main_app.routes.dbconn = db_connection
-    return main_app
+from autocomplete import PrefixTrie
+from pager import KeysetPager
+from pipeline import Pipeline
+from tables.stations_table import StationsTable
+from tables.routes_table import RoutesTable
+from write_behind import WriteBehindBuffer
+from view_refresher import ViewRefresher
+from server import Service
+from dberrors import DuplicateKeyError, constraint_of, describe_db_error
+import loadgen
+import snapshot
+import tenants
+import tracing
 
 
 class TestStationsCRUD:
@@ -339,6 +341,1290 @@ class TestRoutesOperations:
         assert len(routes_after) == len(routes_before) - 1, "Маршрут не был удален из списка"
 
 
+class TestQueryBuilder:
+    """Тесты для построителя запросов DbTable.select()"""
+
+    def test_where_order_limit(self, app, tables):
+        """Тест фильтрации, сортировки и LIMIT на стороне сервера"""
+        app.stations.insert_one(['А', 1, 3, True])
+        app.stations.insert_one(['Б', 2, 2, False])
+        app.stations.insert_one(['В', 1, 1, True])
+
+        rows = app.stations.select("name").where("is_active", True).order_by("line_order").all()
+        assert rows == [('В',), ('А',)]
+
+        rows = app.stations.select("name").order_by("line_order", desc=True).limit(1).all()
+        assert rows == [('А',)]
+
+        rows = app.stations.select("name").where("tariff_zone", [2, 3], op="IN").all()
+        assert rows == [('Б',)]
+
+    def test_sql_cached_per_shape(self, app, tables):
+        """Тест кеширования отрендеренного SQL по форме запроса"""
+        q1 = app.stations.select("name").where("station_id", 1)
+        q2 = app.stations.select("name").where("station_id", 2)
+        assert q1.shape() == q2.shape()
+
+        q1.all()
+        assert q2.rendered(app.connection.conn) is q1.rendered(app.connection.conn)
+
+    def test_unknown_column(self, app):
+        """Тест отказа на неизвестной колонке"""
+        with pytest.raises(ValueError):
+            app.stations.select("nope")
+        with pytest.raises(ValueError):
+            app.stations.select().where("name", "x", op="; DROP")
+
+
+class TestStationSearch:
+    """Тесты для поиска и автодополнения станций"""
+
+    def test_prefix_trie(self):
+        """Тест автодополнения по префиксу без учёта регистра"""
+        trie = PrefixTrie()
+        for name in ['Парк', 'Павелецкая', 'Арбат', 'Парк культуры']:
+            trie.insert(name, name)
+
+        assert trie.complete('па') == ['Павелецкая', 'Парк', 'Парк культуры']
+        assert trie.complete('ПАР', limit=1) == ['Парк']
+        assert trie.complete('х') == []
+        assert len(trie) == 4
+
+    def test_search_prefix_then_fragment(self, app, tables):
+        """Тест поиска в БД: сначала совпадения по началу, затем по фрагменту"""
+        app.stations.insert_one(['Новослободская', 1, 1, True])
+        app.stations.insert_one(['Слободка', 1, 2, True])
+        app.stations.insert_one(['Арбат', 1, 3, True])
+
+        rows = app.stations.search('слоб')
+        assert [r[1] for r in rows] == ['Слободка', 'Новослободская']
+        assert app.stations.search('%') == []
+
+    def test_find_stations_uses_cache(self, app, tables):
+        """Тест поиска станции для меню: кеш, затем БД"""
+        app.stations.insert_one(['Арбат', 1, 1, True])
+        app.stations.insert_one(['Смоленская', 1, 2, True])
+
+        assert [r[1] for r in app._find_stations('ар')] == ['Арбат']
+        assert [r[1] for r in app._find_stations('ленск')] == ['Смоленская']
+
+
+class TestKeysetPager:
+    """Тесты для постраничного просмотра станций"""
+
+    @pytest.fixture
+    def tables(self, tables, app):
+        """Пересоздание таблиц и 5 станций"""
+        for i in range(1, 6):
+            app.stations.insert_one([f'Станция{i}', 1, i, True])
+
+    def test_pages_and_numbers(self, app, tables):
+        """Тест перехода по страницам и сквозной нумерации"""
+        pager = KeysetPager(app.stations, page_size=2)
+        try:
+            assert [r[1] for r in pager.rows()] == ['Станция1', 'Станция2']
+            assert pager.next_page()
+            assert [r[1] for r in pager.rows()] == ['Станция3', 'Станция4']
+            assert pager.first_number() == 3
+            assert pager.row_by_number(4)[1] == 'Станция4'
+            assert pager.row_by_number(1) is None
+
+            assert pager.next_page()
+            assert [r[1] for r in pager.rows()] == ['Станция5']
+            assert not pager.next_page()
+
+            assert pager.prev_page()
+            assert pager.prev_page()
+            assert [r[1] for r in pager.rows()] == ['Станция1', 'Станция2']
+            assert not pager.prev_page()
+        finally:
+            pager.close()
+
+    def test_prefetch_does_not_block_drop(self, app, tables):
+        """Тест: после фоновой подгрузки DROP TABLE не ждёт соединение потока подгрузки"""
+        conn = DbConnection(DBConfig(), threadsafe=True)
+        stations = StationsTable(conn)
+        pager = KeysetPager(stations, page_size=2)
+        try:
+            pager.rows()
+            pager._pending[1].result()
+            conn.conn.cursor().execute("SET lock_timeout = 2000")
+            stations.drop()  # как в Main: через соединение, на котором читалась первая страница
+        finally:
+            pager.close()
+            conn.close()
+
+    def test_reset_after_changes(self, app, tables):
+        """Тест сброса страниц после изменения таблицы"""
+        pager = KeysetPager(app.stations, page_size=2, prefetch=False)
+        first = pager.rows()
+        app.stations.delete_by_pk(first[0][0])
+
+        pager.reset()
+        assert [r[1] for r in pager.rows()] == ['Станция2', 'Станция3']
+        pager.close()
+
+
+class TestThreadSafeConnection:
+    """Тесты для режима соединения на поток"""
+
+    def test_connection_per_thread(self):
+        """Тест: у каждого потока своё соединение, таблица общая"""
+        conn = DbConnection(DBConfig(), threadsafe=True)
+        stations = StationsTable(conn)
+
+        def backend_pid(_):
+            cur = stations.dbconn.conn.cursor()
+            cur.execute("SELECT pg_backend_pid()")
+            return cur.fetchone()[0]
+
+        try:
+            with ThreadPoolExecutor(max_workers=3) as pool:
+                pids = set(pool.map(backend_pid, range(3)))
+            assert len(pids) >= 2, "Потоки делят одно соединение"
+        finally:
+            conn.close()
+        assert conn._opened == []
+
+    def test_rollback_isolated(self):
+        """Тест: ошибка и rollback в одном потоке не обрывают транзакцию другого"""
+        conn = DbConnection(DBConfig(), threadsafe=True)
+        try:
+            cur = conn.conn.cursor()
+            cur.execute("CREATE TEMP TABLE tmp_threads(x integer)")
+            cur.execute("INSERT INTO tmp_threads VALUES (1)")
+
+            def failing():
+                try:
+                    conn.conn.cursor().execute("SELECT 1/0")
+                except psycopg2.Error:
+                    conn.conn.rollback()
+
+            t = threading.Thread(target=failing)
+            t.start()
+            t.join()
+
+            cur.execute("SELECT count(*) FROM tmp_threads")
+            assert cur.fetchone()[0] == 1
+        finally:
+            conn.close()
+
+
+class TestReplicaRouting:
+    """Тесты для маршрутизации чтений на реплики"""
+
+    def _replica_config(self, **kwargs):
+        """Две «реплики» — отдельные соединения к той же БД с разным application_name"""
+        config = DBConfig(**kwargs)
+        config.replica_dsns = [f"{config.dsn} application_name=replica{i}" for i in (1, 2)]
+        return config
+
+    def test_round_robin_and_sticky_after_write(self):
+        """Тест: чтения чередуются между репликами, после записи идут на primary"""
+        conn = DbConnection(self._replica_config())
+        try:
+            primary = conn.connect()
+            first, second = conn.read_conn(), conn.read_conn()
+            assert primary not in (first, second)
+            assert first is not second
+            assert first.readonly and first.autocommit
+
+            conn.mark_write()
+            assert conn.read_conn() is primary
+        finally:
+            conn.close()
+
+    def test_uncommitted_write_reads_primary(self, app):
+        """Тест: пока запись не зафиксирована, чтения идут на primary, даже после окна липкости"""
+        app.connection.conn.rollback()
+        app.routes.drop()
+        app.stations.drop()
+        app.stations.create()
+        conn = DbConnection(self._replica_config(replica_sticky_seconds=0))
+        try:
+            primary = conn.connect()
+            stations = StationsTable(conn)
+            stations.insert_one(['Арбатская', 1, 1, True], commit=False)
+
+            assert conn.read_conn() is primary
+            assert stations.count() == 1
+            primary.commit()
+            assert conn.read_conn() is not primary
+        finally:
+            conn.close()
+
+    def test_lagging_replicas_fall_back_to_primary(self):
+        """Тест: при отставании всех реплик читаем с primary"""
+        conn = DbConnection(self._replica_config(replica_max_lag=-1))
+        try:
+            primary = conn.connect()
+            assert conn.read_conn() is primary
+        finally:
+            conn.close()
+
+    def test_unreachable_replica_skipped(self):
+        """Тест: недоступная реплика пропускается"""
+        config = self._replica_config()
+        config.replica_dsns = [f"{config.dsn} port=1 connect_timeout=1", config.replica_dsns[0]]
+        conn = DbConnection(config)
+        try:
+            primary = conn.connect()
+            assert conn.read_conn() is not primary
+            assert conn.read_conn() is not primary
+        finally:
+            conn.close()
+
+
+class TestPartitioning:
+    """Тесты для секционированной таблицы маршрутов"""
+
+    def test_route_partitions_created(self, app, tables):
+        """Тест создания секций и вставки через родительскую таблицу"""
+        cur = app.connection.conn.cursor()
+        cur.execute(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = %s::regclass ORDER BY 1",
+            (app.routes.table_name(),),
+        )
+        assert [r[0] for r in cur.fetchall()] == app.routes.partition_names()
+
+        for end_id in range(2, 10):
+            app.routes.insert_one([1, end_id, None, True])
+        assert app.routes.count() == 8
+        assert len(app.routes.all_by_start_station(1)) == 8
+
+    def test_lookup_prunes_partitions(self, app, tables):
+        """Тест: выборка по станции начала читает одну секцию"""
+        cur = app.connection.conn.cursor()
+        cur.execute(
+            f"EXPLAIN SELECT * FROM {app.routes.table_name()} WHERE start_station_id = 1"
+        )
+        plan = "\n".join(r[0] for r in cur.fetchall())
+        touched = [name for name in app.routes.partition_names() if name in plan]
+        assert len(touched) == 1, plan
+
+    def test_partition_unique_violation_names_parent_constraint(self, app, tables):
+        """Тест: дубликат маршрута в секции сообщает ограничение родительской таблицы"""
+        routes = RoutesTable(app.connection)  # без предпроверки: ошибку должна вернуть БД
+        routes.insert_one([1, 2, None, True])
+        with pytest.raises(errors.UniqueViolation) as exc:
+            routes.insert_one([1, 2, None, True])
+        app.connection.conn.rollback()
+        assert constraint_of(exc.value) == "uq_route_start_end"
+        assert describe_db_error(exc.value) == "маршрут между этими станциями уже существует."
+
+
+class TestArchival:
+    """Тесты для переноса неактивных строк в архив"""
+
+    def test_updated_at_touched_on_update(self, app, tables):
+        """Тест: триггер обновляет updated_at"""
+        app.stations.insert_one(['Станция', 1, 1, True])
+        station_id, before = app.stations.select("station_id", "updated_at").first()
+
+        app.stations.update_by_pk(station_id, {"is_active": False})
+        after = app.stations.select("updated_at").first()[0]
+        assert after > before
+
+    def test_archive_inactive_in_batches(self, app, tables):
+        """Тест: неактивные строки уходят в архив пачками и видны через include_archived"""
+        app.stations.insert_one(['А', 1, 1, False])
+        app.stations.insert_one(['Б', 1, 2, True])
+        app.stations.insert_one(['В', 1, 3, False])
+
+        assert app.stations.archive_inactive("1 day") == 0
+        assert app.stations.archive_inactive("0 seconds", batch_size=1) == 2
+
+        assert [r[1] for r in app.stations.all()] == ['Б']
+        assert [r[1] for r in app.stations.all(include_archived=True)] == ['А', 'Б', 'В']
+        assert app.stations.count(include_archived=True) == 3
+
+        rows = app.stations.select("name", include_archived=True).where("is_active", False).order_by("name").all()
+        assert rows == [('А',), ('В',)]
+
+    def test_routes_by_start_station_with_archive(self, app, tables):
+        """Тест: маршруты станции с учётом архива"""
+        app.routes.insert_one([1, 2, 'активный', True])
+        app.routes.insert_one([1, 3, 'старый', False])
+        app.routes.archive_inactive("0 seconds")
+
+        assert len(app.routes.all_by_start_station(1)) == 1
+        assert len(app.routes.all_by_start_station(1, include_archived=True)) == 2
+
+
+class TestChangeFeed:
+    """Тесты для инкрементальной выборки изменений"""
+
+    def test_changes_since_watermark(self, app, tables):
+        """Тест: возвращаются только изменения после водяного знака"""
+        app.stations.insert_one(['А', 1, 1, True])
+        app.stations.insert_one(['Б', 1, 2, True])
+
+        changed, deleted, wm = app.stations.changes_since(0)
+        assert [r[1] for r in changed] == ['А', 'Б']
+        assert deleted == []
+
+        a_id, b_id = changed[0][0], changed[1][0]
+        app.stations.update_by_pk(a_id, {"tariff_zone": 5})
+        app.stations.delete_by_pk(b_id)
+        app.stations.insert_one(['В', 1, 3, True])
+
+        changed, deleted, wm2 = app.stations.changes_since(wm)
+        assert sorted(r[1] for r in changed) == ['А', 'В']
+        assert deleted == [(b_id,)]
+        assert wm2 > wm
+
+        changed, deleted, _ = app.stations.changes_since(wm2)
+        assert changed == [] and deleted == []
+
+    def test_prune_tombstones(self, app, tables):
+        """Тест очистки записей об удалениях"""
+        app.routes.insert_one([1, 2, None, True])
+        route_id = app.routes.all()[0][0]
+        app.routes.delete_by_pk(route_id)
+
+        _, deleted, wm = app.routes.changes_since(0)
+        assert deleted == [(route_id,)]
+
+        version = app.routes.data_version()
+        assert app.routes.prune_tombstones(wm) == 1
+        assert app.routes.changes_since(0)[1] == []
+        assert app.routes.data_version() == version
+
+
+class TestWriteBehind:
+    """Тесты для буфера отложенной записи"""
+
+    def test_batches_and_bad_rows(self, app, tables):
+        """Тест: пачка пишется, сбойная строка уходит в on_error, остальные сохраняются"""
+        conn = DbConnection(DBConfig(), threadsafe=True)
+        routes = RoutesTable(conn)
+        errors_seen = []
+
+        buf = WriteBehindBuffer(
+            routes, max_batch=10, flush_interval=0.05,
+            on_error=lambda op, args, e: errors_seen.append((op, args, type(e))),
+        )
+        try:
+            for end_id in range(2, 7):
+                buf.insert([1, end_id, None, True])
+            buf.insert([3, 3, None, True])  # chk_route_start_end_not_same
+            buf.flush()
+
+            rows = routes.all_by_start_station(1)
+            assert len(rows) == 5
+            assert errors_seen == [("insert", (3, 3, None, True), errors.CheckViolation)]
+
+            buf.update(rows[0][0], {"is_active": False})
+        finally:
+            buf.close()
+            conn.close()
+
+        assert app.routes.select("is_active").where("route_id", rows[0][0]).first() == (False,)
+
+    def test_malformed_ops_and_lost_connection(self, app, tables):
+        """Тест: неверная операция отклоняется сразу, после разрыва соединения запись продолжается"""
+        conn = DbConnection(DBConfig(), threadsafe=True)
+        errors_seen = []
+        buf = WriteBehindBuffer(RoutesTable(conn), flush_interval=0.05,
+                                on_error=lambda op, args, e: errors_seen.append((op, args, e)))
+        try:
+            with pytest.raises(ValueError):
+                buf.insert([1, 2])
+            with pytest.raises(ValueError):
+                buf.update(1, "x")
+            buf.insert([1, 2, None, True])
+            buf.flush()
+
+            cur = app.connection.conn.cursor()
+            for c in conn._opened:  # соединение фонового потока
+                cur.execute("SELECT pg_terminate_backend(%s)", (c.info.backend_pid,))
+            app.connection.conn.commit()
+
+            buf.insert([1, 3, None, True])
+            buf.flush()
+        finally:
+            buf.close()
+            conn.close()
+
+        assert errors_seen == []
+        assert app.routes.count() == 2
+
+    def test_backpressure(self, app, tables):
+        """Тест: при заполненной очереди put с таймаутом бросает queue.Full"""
+        # блокируем таблицу, чтобы фоновый поток завис на первой пачке
+        app.connection.conn.cursor().execute(f"LOCK TABLE {app.routes.table_name()} IN ACCESS EXCLUSIVE MODE")
+
+        conn = DbConnection(DBConfig(), threadsafe=True)
+        buf = WriteBehindBuffer(RoutesTable(conn), max_batch=1, max_pending=1, put_timeout=0.2)
+        try:
+            with pytest.raises(queue.Full):
+                for end_id in range(2, 10):
+                    buf.insert([1, end_id, None, True])
+        finally:
+            app.connection.conn.rollback()
+            buf.close()
+            conn.close()
+        assert app.routes.count() == 2
+
+    def test_requires_threadsafe_connection(self, app):
+        """Тест: без соединения на поток буфер не создаётся"""
+        with pytest.raises(ValueError):
+            WriteBehindBuffer(app.routes)
+
+
+class TestBatchWrites:
+    """Тесты для пакетной записи с отсевом сбойных строк"""
+
+    def test_insert_batch_rejects_only_bad_rows(self, app, tables):
+        """Тест: годные строки вставлены, сбойные перечислены в отчёте"""
+        rows = [[f'Станция{i}', 1, i, True] for i in range(1, 11)]
+        rows[3] = ['Станция1', 1, 40, True]   # uq_station_name
+        rows[6] = ['Станция7', -1, 7, True]   # chk_station_tariff_zone
+        rows[8] = ['Станция9', 1, 2, True]    # uq_station_line_order
+
+        report = app.stations.insert_batch(rows, chunk_size=4)
+
+        assert report.applied == 7
+        assert [(e.index, e.constraint) for e in report.errors] == [
+            (3, 'uq_station_name'),
+            (6, 'chk_station_tariff_zone'),
+            (8, 'uq_station_line_order'),
+        ]
+        assert report.errors[0].message == "станция с таким названием уже существует."
+        assert app.stations.count() == 7
+
+    def test_apply_batch_mixed_ops(self, app, tables):
+        """Тест: вставки, изменения и удаления в одном пакете"""
+        app.routes.insert_one([1, 2, None, True])
+        route_id = app.routes.all()[0][0]
+
+        report = app.routes.apply_batch([
+            ("insert", (1, 3, None, True)),
+            ("update", (route_id, {"route_name": "Главный"})),
+            ("insert", (2, 2, None, True)),   # chk_route_start_end_not_same
+            ("delete", route_id),
+        ])
+
+        assert report.applied == 3
+        assert [e.constraint for e in report.errors] == ['chk_route_start_end_not_same']
+        assert [(r[1], r[2]) for r in app.routes.all()] == [(1, 3)]
+
+    def test_malformed_ops_reported_per_op(self, app, tables):
+        """Тест: неверно составленные операции — отдельные ошибки, годные записаны"""
+        report = app.routes.apply_batch([
+            ("insert", (1, 2, None, True)),
+            ("upsert", (1, 3, None, True)),
+            ("update", (1, "x")),
+            ("insert", (1, 3)),
+            "delete",
+            ("insert", (2, 3, None, True)),
+        ])
+
+        assert report.applied == 2
+        assert [(e.index, e.constraint, e.message) for e in report.errors] == [
+            (1, None, "неизвестная операция 'upsert'"),
+            (2, None, "неверные аргументы для 'update'"),
+            (3, None, "неверные аргументы для 'insert'"),
+            (4, None, "неизвестная операция None"),
+        ]
+        assert app.connection.conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        assert [(r[1], r[2]) for r in app.routes.all()] == [(1, 2), (2, 3)]
+
+    def test_unexpected_error_rolls_back(self, app, tables, monkeypatch):
+        """Тест: ошибка не из БД посреди пакета откатывает уже выполненные куски"""
+        calls = []
+        real = app.routes.delete_by_pk
+
+        def flaky_delete(pk, commit=True):
+            calls.append(pk)
+            raise TypeError("сбой")
+
+        monkeypatch.setattr(app.routes, "delete_by_pk", flaky_delete)
+        with pytest.raises(TypeError):
+            app.routes.apply_batch([("insert", (1, 2, None, True)), ("delete", 1)], chunk_size=1)
+        monkeypatch.setattr(app.routes, "delete_by_pk", real)
+
+        assert calls == [1]
+        assert app.connection.conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        assert app.routes.count() == 0
+
+
+class TestUniquePrecheck:
+    """Тесты для проверки уникальных ключей до отправки запроса"""
+
+    @pytest.fixture
+    def tables(self, tables, app):
+        """Пересоздание таблиц"""
+        app.stations.insert_one(['Арбатская', 1, 1, True])
+
+    def test_duplicate_rejected_before_insert(self, app, tables):
+        """Тест: дубликат отклонён до INSERT, транзакция не прервана"""
+        app.connection.conn.cursor().execute("SELECT 1")  # открытая транзакция
+        with pytest.raises(DuplicateKeyError) as exc:
+            app.stations.insert_one(['Арбатская', 1, 2, True], commit=False)
+
+        assert constraint_of(exc.value) == "uq_station_name"
+        assert describe_db_error(exc.value) == "станция с таким названием уже существует."
+        app.stations.insert_one(['Смоленская', 1, 2, True])
+        assert app.stations.count() == 2
+
+    def test_update_own_key_allowed(self, app, tables):
+        """Тест: строка может сохранить свой ключ, но не занять чужой"""
+        app.stations.insert_one(['Смоленская', 1, 2, True])
+        first, second = (r[0] for r in app.stations.all())
+
+        app.stations.update_by_pk(first, {"name": "Арбатская", "tariff_zone": 2})
+        with pytest.raises(DuplicateKeyError):
+            app.stations.update_by_pk(second, {"line_order": 1})
+        app.stations.update_by_pk(first, {"name": "Арбатская-1"})
+        app.stations.update_by_pk(second, {"name": "Арбатская"})
+
+    def test_batch_prefilter(self, app, tables):
+        """Тест: дубликаты против таблицы и внутри пакета отсеяны до БД"""
+        report = app.stations.insert_batch([
+            ['Арбатская', 1, 10, True],
+            ['Киевская', 1, 11, True],
+            ['Киевская', 1, 12, True],
+            ['Парк культуры', -1, 13, True],  # CHECK — ловит только БД
+        ])
+
+        assert report.applied == 1
+        assert [(e.index, e.constraint) for e in report.errors] == [
+            (0, 'uq_station_name'),
+            (2, 'uq_station_name'),
+            (3, 'chk_station_tariff_zone'),
+        ]
+        with pytest.raises(DuplicateKeyError):
+            app.stations.insert_one(['Киевская', 1, 14, True])
+
+    def test_sees_changes_of_other_clients(self, app, tables):
+        """Тест: индекс догоняет чужие вставки и удаления"""
+        app.stations.unique_index.refresh()
+        other = StationsTable(app.connection)
+        other.insert_one(['Смоленская', 1, 2, True])
+        other.delete_by_pk(app.stations.all()[0][0])
+
+        app.stations.unique_index.refresh()
+        app.stations.insert_one(['Арбатская', 1, 1, True])
+        with pytest.raises(DuplicateKeyError):
+            app.stations.insert_one(['Смоленская', 1, 3, True])
+
+    def test_stale_hit_confirmed_in_transaction(self, app, tables):
+        """Тест: в открытой транзакции устаревший ключ индекса не мешает вставке"""
+        app.stations.unique_index.refresh()
+        app.connection.conn.cursor().execute("SELECT 1")  # транзакция Main; до max_age индекс не догоняет
+        other = DbConnection(DBConfig())
+        other.connect()
+        try:
+            station_id = StationsTable(other).all()[0][0]
+            StationsTable(other).update_by_pk(station_id, {"name": "Смоленская"})
+        finally:
+            other.close()
+
+        app.stations.insert_one(['Арбатская', 1, 2, True], commit=False)
+        app.connection.conn.commit()
+        assert sorted(r[1] for r in app.stations.all()) == ['Арбатская', 'Смоленская']
+        # устаревшая строка убрана из индекса целиком — и из ключей, и из копий строк
+        index = app.stations.unique_index
+        assert station_id not in index._rows
+        assert all(station_id not in keys.values() for keys in index._index.values())
+
+    def test_confirmed_owner_recorded_with_row(self, app, tables):
+        """Тест: ключ, занятый в БД другой строкой, попадает в индекс вместе с её значениями"""
+        index = app.stations.unique_index
+        index.refresh()
+        other = StationsTable(DbConnection(DBConfig()))
+        other.dbconn.connect()
+        try:
+            old_id = other.all()[0][0]
+            other.update_by_pk(old_id, {"name": "Смоленская"})
+            other.insert_one(['Арбатская', 1, 2, True])
+            new_id = other.select("station_id").where("name", 'Арбатская').first()[0]
+        finally:
+            other.dbconn.close()
+
+        with pytest.raises(DuplicateKeyError):
+            app.stations.insert_one(['Арбатская', 1, 3, True])
+        assert old_id not in index._rows
+        assert index._rows[new_id] == {"line_order": 2, "name": 'Арбатская'}
+        assert index._index["uq_station_line_order"][(2,)] == new_id
+
+    def test_loads_keys_inside_open_transaction(self, app, tables):
+        """Тест: индекс загружается и в транзакции чтения, которую держит Main"""
+        index = app.stations.unique_index
+        index.reset()
+        app.connection.conn.cursor().execute("SELECT 1")  # как после select() в Main
+        with pytest.raises(DuplicateKeyError):
+            app.stations.insert_one(['Арбатская', 1, 2, True], commit=False)
+
+        app.stations.insert_one(['Смоленская', 1, 2, True])  # транзакция цела
+        assert app.stations.count() == 2
+
+    def test_pipeline_insert_updates_index(self, app, tables):
+        """Тест: вставка через конвейер попадает в индекс"""
+        app.stations.unique_index.refresh()
+        with app.connection.pipeline() as p:
+            p.insert(app.stations, ['Смоленская', 1, 2, True])
+        app.connection.conn.commit()
+
+        with pytest.raises(DuplicateKeyError):
+            app.stations.insert_one(['Смоленская', 1, 3, True])
+
+    def test_recreate_resets_index(self, app, tables):
+        """Тест: после пересоздания таблицы старые ключи забыты"""
+        app.routes.insert_one([1, 2, None, True])
+        app.routes.drop()
+        app.routes.create()
+        app.routes.insert_one([1, 2, None, True])
+        assert app.routes.count() == 1
+
+
+class TestHttpService:
+    """Тесты для HTTP/JSON-сервиса"""
+
+    @pytest.fixture
+    def service(self, app, tables):
+        """Сервис в отдельном потоке со своим event loop; возвращает порт"""
+        loop = asyncio.new_event_loop()
+        svc = self.svc = Service(DbConnection(DBConfig(), threadsafe=True), pool_size=4)
+        server = loop.run_until_complete(svc.start("127.0.0.1", 0))
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        yield server.sockets[0].getsockname()[1]
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+        svc.close()
+
+    def _request(self, port, method, path, body=None, headers=None):
+        client = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+        client.request(method, path, json.dumps(body) if body is not None else None, headers or {})
+        resp = client.getresponse()
+        data = resp.read()
+        client.close()
+        return resp.status, json.loads(data) if data else None, resp
+
+    def test_crud_and_conflict(self, service):
+        """Тест: создание, чтение, изменение, удаление и 409 на нарушение ограничения"""
+        status, station, _ = self._request(service, "POST", "/stations",
+                                           {"name": "Сокол", "tariff_zone": 1, "line_order": 1})
+        assert status == 201 and station["is_active"] is True
+        sid = station["station_id"]
+
+        status, body, _ = self._request(service, "POST", "/stations",
+                                        {"name": "Сокол", "tariff_zone": 1, "line_order": 2})
+        assert status == 409
+        assert body == {"error": "станция с таким названием уже существует.", "constraint": "uq_station_name"}
+
+        status, body, _ = self._request(service, "PATCH", f"/stations/{sid}", {"tariff_zone": 2})
+        assert status == 200 and body["tariff_zone"] == 2
+
+        status, route, _ = self._request(service, "POST", "/routes",
+                                         {"start_station_id": sid, "end_station_id": 99})
+        assert status == 201
+        status, body, _ = self._request(service, "GET", f"/stations/{sid}/routes")
+        assert [r["route_id"] for r in body] == [route["route_id"]]
+
+        assert self._request(service, "DELETE", f"/stations/{sid}")[0] == 204
+        assert self._request(service, "GET", f"/stations/{sid}")[0] == 404
+        assert self._request(service, "POST", "/stations", {"bogus": 1})[0] == 400
+
+    def test_station_list_etag(self, service):
+        """Тест: повтор с If-None-Match даёт 304, после изменения — новый список"""
+        self._request(service, "POST", "/stations", {"name": "А", "tariff_zone": 1, "line_order": 1})
+        status, body, resp = self._request(service, "GET", "/stations")
+        etag = resp.getheader("ETag")
+        assert status == 200 and len(body) == 1 and etag
+
+        status, body, _ = self._request(service, "GET", "/stations", headers={"If-None-Match": etag})
+        assert status == 304 and body is None
+
+        self._request(service, "POST", "/stations", {"name": "Б", "tariff_zone": 1, "line_order": 2})
+        status, body, resp = self._request(service, "GET", "/stations", headers={"If-None-Match": etag})
+        assert status == 200 and len(body) == 2 and resp.getheader("ETag") != etag
+
+    def test_batch_and_metrics(self, service):
+        """Тест: пакет запросов выполняется целиком, задержки видны в /metrics"""
+        status, body, _ = self._request(service, "POST", "/batch", [
+            {"method": "POST", "path": "/stations", "body": {"name": "А", "tariff_zone": 1, "line_order": 1}},
+            {"method": "POST", "path": "/stations", "body": {"name": "Б", "tariff_zone": -1, "line_order": 2}},
+            {"method": "GET", "path": "/nowhere"},
+        ])
+        assert status == 200
+        assert [item["status"] for item in body] == [201, 409, 404]
+
+        status, metrics, _ = self._request(service, "GET", "/metrics")
+        assert metrics["POST /(stations|routes)"]["requests"] == 2
+        assert metrics["POST /batch"]["p99_ms"] >= metrics["POST /(stations|routes)"]["p50_ms"]
+
+    def test_unexpected_errors_get_responses(self, service, monkeypatch):
+        """Тест: неверный Content-Length — 400, непредвиденное исключение — 500, сервер жив"""
+        for length in ("abc", "-5"):
+            with socket.create_connection(("127.0.0.1", service), timeout=5) as sock:
+                sock.sendall(f"POST /stations HTTP/1.1\r\nContent-Length: {length}\r\n\r\n".encode())
+                assert sock.recv(1024).startswith(b"HTTP/1.1 400")
+
+        def broken():
+            raise TypeError("сбой")
+
+        monkeypatch.setattr(self.svc.tables["routes"], "all", broken)
+        status, body, _ = self._request(service, "GET", "/routes")
+        assert status == 500 and body == {"error": "внутренняя ошибка сервера"}
+        assert self._request(service, "GET", "/stations")[0] == 200
+
+    def test_bad_client_input_is_400(self, service):
+        """Тест: неверные элементы пакета и значения, не подходящие колонке, — 400, а не 500"""
+        status, body, _ = self._request(service, "POST", "/batch", [
+            {"method": "GET"},
+            {"method": "GET", "path": 5},
+            {"method": 3, "path": "/stations"},
+            {"method": "POST", "path": "/stations", "body": {"name": "А", "tariff_zone": "один", "line_order": 1}},
+            {"method": "POST", "path": "/stations", "body": {"name": "А", "tariff_zone": 1, "line_order": 10 ** 12}},
+        ])
+        assert status == 200
+        assert [item["status"] for item in body] == [400] * 5
+        assert self._request(service, "GET", "/stations")[1] == []
+
+    def test_coalesced_request_survives_leader_cancel(self):
+        """Тест: отмена первого из одинаковых GET не отменяет общий запрос для остальных"""
+        svc = Service(DbConnection(DBConfig(), threadsafe=True), pool_size=1)
+
+        async def scenario():
+            gate = asyncio.Event()
+
+            async def handler(headers, body):
+                await gate.wait()
+                return 200, {"ok": True}, {}
+
+            leader = asyncio.ensure_future(svc._coalesced("k", handler, (), {}))
+            await asyncio.sleep(0)
+            follower = asyncio.ensure_future(svc._coalesced("k", handler, (), {}))
+            await asyncio.sleep(0)
+            leader.cancel()
+            gate.set()
+            return await follower, svc._inflight
+
+        try:
+            assert asyncio.run(scenario()) == ((200, {"ok": True}, {}), {})
+        finally:
+            svc.close()
+
+    def test_reads_leave_no_open_transaction(self, service):
+        """Тест: после GET соединения пула не остаются в открытой транзакции"""
+        self._request(service, "POST", "/stations", {"name": "А", "tariff_zone": 1, "line_order": 1})
+        for path in ("/stations", "/routes", "/stations/1", "/stations/1/routes"):
+            assert self._request(service, "GET", path)[0] == 200
+        opened = self.svc.dbconn._opened
+        assert opened
+        assert all(c.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE for c in opened)
+
+
+class TestLoadGenerator:
+    """Тесты для нагрузочного генератора"""
+
+    def test_parse_mix(self):
+        """Тест разбора смеси операций"""
+        assert loadgen.parse_mix("read=3, insert=1") == {"read": 3, "insert": 1}
+        with pytest.raises(ValueError):
+            loadgen.parse_mix("drop=1")
+
+    def test_short_run_reports_constraints(self, app):
+        """Тест: короткий прогон в потоках собирает задержки и ошибки по ограничениям"""
+        app.connection.conn.rollback()
+        loadgen.setup(stations_count=3, routes_count=0)
+        stats, timeline, elapsed = loadgen.run_load(
+            workers=3, mode="thread", duration=0.5, mix={"read": 1, "insert": 3}, interval=0.25,
+        )
+        assert stats.latencies["read"] and stats.latencies["insert"]
+        # из трёх станций почти все пары быстро заняты или совпадают
+        reasons = {reason for _, reason in stats.errors}
+        assert reasons <= {"uq_route_start_end", "chk_route_start_end_not_same"} and reasons
+        assert timeline and elapsed >= 0.5
+        assert "оп/с" in loadgen.format_report(stats, timeline, elapsed)
+
+
+class TestStatementTimeouts:
+    """Тесты для таймаутов запросов и отмены"""
+
+    def test_call_timeout_is_scoped(self, db_connection):
+        """Тест: таймаут действует только внутри блока timeout()"""
+        conn = db_connection.conn
+        cur = conn.cursor()
+        with db_connection.timeout(50):
+            with pytest.raises(errors.QueryCanceled) as exc:
+                cur.execute("SELECT pg_sleep(1)")
+        conn.rollback()
+        assert describe_db_error(exc.value) == "запрос выполнялся слишком долго и был прерван по таймауту."
+
+        with db_connection.timeout(5000):
+            cur.execute("SELECT 1")
+        cur.execute("SHOW statement_timeout")
+        assert cur.fetchone() == ("0",)
+        conn.rollback()
+
+    def test_default_timeout_from_config(self):
+        """Тест: statement_timeout_ms из конфигурации задаётся при подключении"""
+        conn = DbConnection(DBConfig(statement_timeout_ms=250))
+        try:
+            cur = conn.connect().cursor()
+            cur.execute("SHOW statement_timeout")
+            assert cur.fetchone() == ("250ms",)
+        finally:
+            conn.close()
+
+    def test_cancel_from_other_thread(self, db_connection):
+        """Тест: cancel() прерывает выполняющийся запрос"""
+        timer = threading.Timer(0.2, db_connection.cancel)
+        timer.start()
+        with pytest.raises(errors.QueryCanceled) as exc:
+            db_connection.conn.cursor().execute("SELECT pg_sleep(5)")
+        timer.join()
+        db_connection.conn.rollback()
+        assert describe_db_error(exc.value) == "запрос отменён."
+
+    def test_cancel_inside_timeout_is_not_timeout(self, db_connection):
+        """Тест: отмена внутри блока timeout() — отмена, а не таймаут (без разбора текста ошибки)"""
+        timer = threading.Timer(0.2, db_connection.cancel)
+        timer.start()
+        with db_connection.timeout(5000):
+            with pytest.raises(errors.QueryCanceled) as exc:
+                db_connection.conn.cursor().execute("SELECT pg_sleep(5)")
+        timer.join()
+        db_connection.conn.rollback()
+        assert exc.value.timed_out is False
+        assert describe_db_error(exc.value) == "запрос отменён."
+
+    def test_default_timeout_detected(self):
+        """Тест: срабатывание statement_timeout_ms из конфигурации распознаётся как таймаут"""
+        conn = DbConnection(DBConfig(statement_timeout_ms=50))
+        try:
+            with pytest.raises(errors.QueryCanceled) as exc:
+                conn.connect().cursor().execute("SELECT pg_sleep(1)")
+            assert exc.value.timed_out is True
+        finally:
+            conn.close()
+
+    def test_safe_exec_reports_timeout(self, app, capsys):
+        """Тест: _safe_exec ограничивает запрос и выводит понятное сообщение"""
+        app.QUERY_TIMEOUT_MS = 50
+        result = app._safe_exec(
+            lambda: app.connection.conn.cursor().execute("SELECT pg_sleep(1)"),
+            "Не удалось получить список маршрутов.",
+        )
+        assert result is None
+        assert "прерван по таймауту" in capsys.readouterr().out
+
+
+class TestSnapshot:
+    """Тесты для локального снимка станций и маршрутов"""
+
+    def test_roundtrip_without_db(self, tmp_path):
+        """Тест: записанный снимок читается теми же методами, что и таблицы"""
+        path = str(tmp_path / "snap.bin")
+        stations = [(2, "Сокол", 1, 2, True), (1, "Аэропорт", 0, 1, False)]
+        routes = [(5, 2, 1, None, True), (3, 1, 2, "Прямой", True), (4, 1, 3, "Прямой", False)]
+        snapshot.write_snapshot(path, stations, routes, source_version="v1")
+
+        with snapshot.Snapshot(path) as snap:
+            st = snapshot.SnapshotStationsTable(snap)
+            rt = snapshot.SnapshotRoutesTable(snap)
+            assert snap.source_version == "v1"
+            assert st.all() == sorted(stations)
+            assert st.find_by_position(2) == (2, "Сокол", 1, 2, True)
+            assert st.find_by_position(3) is None
+            assert rt.count() == 3
+            assert [r[0] for r in rt.all()] == [3, 4, 5]
+            assert rt.all_by_start_station(1) == [(3, 1, 2, "Прямой", True), (4, 1, 3, "Прямой", False)]
+            assert rt.all_by_start_station(2) == [(5, 2, 1, None, True)]
+            assert rt.all_by_start_station(7) == []
+
+    def test_rejects_foreign_file(self, tmp_path):
+        """Тест: файл с чужой сигнатурой не открывается"""
+        path = tmp_path / "junk.bin"
+        path.write_bytes(b"x" * 200)
+        with pytest.raises(ValueError):
+            snapshot.Snapshot(str(path))
+
+    def test_export_matches_db(self, app, tmp_path):
+        """Тест: выгрузка из БД совпадает с чтением таблиц"""
+        conn = app.connection.conn
+        conn.rollback()
+        app.routes.drop()
+        app.stations.drop()
+        app.stations.create()
+        app.routes.create()
+        app.stations.insert_many([[f"Станция{i}", 1, i, True] for i in range(1, 6)])
+        app.routes.insert_many([[s, e, None, True] for s in range(1, 6) for e in range(1, 6) if s != e])
+
+        path = str(tmp_path / "snap.bin")
+        assert app.stations.count() == 5  # чтение оставляет транзакцию открытой, как в Main
+        snapshot.export(path, app.connection)
+
+        with snapshot.Snapshot(path) as snap:
+            rt = snapshot.SnapshotRoutesTable(snap)
+            assert snap.source_version == f"{app.stations.data_version()}/{app.routes.data_version()}"
+            assert snapshot.SnapshotStationsTable(snap).all() == app.stations.all()
+            assert rt.all() == app.routes.all()
+            assert rt.find_by_position(7) == app.routes.find_by_position(7)
+            assert rt.all_by_start_station(3) == app.routes.all_by_start_station(3)
+
+
+class TestTracing:
+    """Тесты для спанов и профилирования"""
+
+    @pytest.fixture
+    def trace_file(self, app, tmp_path, monkeypatch):
+        """Включённая трассировка в файл; после теста выключается"""
+        conn = app.connection.conn
+        conn.rollback()
+        app.routes.drop()
+        app.stations.drop()
+        app.stations.create()
+        app.routes.create()
+        monkeypatch.chdir(tmp_path)
+        path = tmp_path / "trace.jsonl"
+        yield path
+        tracing.configure()
+
+    def _records(self, path):
+        return [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+
+    def test_main_action_spans(self, app, trace_file, monkeypatch):
+        """Тест: действие Main разбито на ввод и вызовы DbTable с числом запросов"""
+        app.stations.unique_index.refresh()  # первичная загрузка индекса — не часть действия
+        tracing.configure(str(trace_file))
+        answers = iter(["Сокол", "1", "1", "y"])
+        monkeypatch.setattr("builtins.input", lambda prompt="": next(answers))
+        app.station_add()
+
+        records = {r["path"]: r for r in self._records(trace_file)}
+        action = records["Main.station_add"]
+        insert = records["Main.station_add;DbTable.insert_one"]
+        assert insert["queries"] == 1 and insert["rows"] == 1
+        assert action["queries"] == 1 and action["parent_id"] is None
+        assert "Main.station_add;Main._input_int" in records
+        assert action["duration_ms"] >= insert["duration_ms"]
+
+        folded = tracing.folded(trace_file.read_text(encoding="utf-8").splitlines())
+        assert set(folded) == set(records)
+
+    def test_profile_toggle(self, app, trace_file):
+        """Тест: спан из TRACE_PROFILE выполняется под cProfile"""
+        tracing.configure(profile="DbTable.count")
+        assert app.stations.count() == 0
+        assert len(list(trace_file.parent.glob("DbTable.count-*.prof"))) == 1
+
+    def test_disabled_by_default(self, app, trace_file):
+        """Тест: без настройки спаны не создаются"""
+        tracing.configure()
+        with tracing.span("x") as s:
+            app.stations.count()
+        assert s is None and not trace_file.exists()
+
+
+class TestRouteSummary:
+    """Тесты для материализованной сводки маршрутов по станциям"""
+
+    @pytest.fixture
+    def tables(self, tables, app):
+        """Пересоздание таблиц с маршрутами 1->2, 1->3 (неактивный), 2->1"""
+        app.routes.insert_many([[1, 2, None, True], [1, 3, None, False], [2, 1, None, True]])
+
+    def test_summary_after_refresh(self, app, tables):
+        """Тест: сводка читается из представления и обновляется refresh_views()"""
+        assert app.routes.summary() == []
+
+        app.routes.refresh_views()
+        assert app.routes.summary() == [(1, 2, 1, 1, 1), (2, 1, 1, 1, 1), (3, 0, 0, 1, 0)]
+        assert app.routes.summary(3) == [(3, 0, 0, 1, 0)]
+
+        app.routes.drop()
+        app.routes.create()
+        assert app.routes.summary() == []
+
+    def test_background_refresher(self, app, tables):
+        """Тест: фоновый пересчёт подхватывает изменения таблицы"""
+        conn = DbConnection(DBConfig(), threadsafe=True)
+        routes = RoutesTable(conn)
+        refresher = ViewRefresher([routes, StationsTable(conn)], interval=0.05)
+        try:
+            assert [t.table_name() for t in refresher.tables] == [routes.table_name()]
+            assert refresher.refresh_now() in (0, 1)
+            assert refresher.refresh_now() == 0  # таблица не менялась
+
+            app.routes.insert_one([3, 1, None, True])
+            for _ in range(100):
+                if routes.summary(3) == [(3, 1, 1, 1, 0)]:
+                    break
+                threading.Event().wait(0.02)
+            assert routes.summary(3) == [(3, 1, 1, 1, 0)]
+        finally:
+            refresher.close()
+            conn.close()
+
+
+class TestRouteGraph:
+    """Тесты для запросов связности по графу маршрутов"""
+
+    @pytest.fixture
+    def tables(self, tables, app):
+        """Граф: 1->2->3->1 (цикл), 3->4, 5->6 (неактивный), 7->8"""
+        app.routes.insert_many([
+            [1, 2, None, True], [2, 3, None, True], [3, 1, None, True], [3, 4, None, True],
+            [5, 6, None, False], [7, 8, None, True],
+        ])
+
+    def test_reachable_and_paths(self, app, tables):
+        """Тест: обход с циклом завершается, глубина и направление учитываются"""
+        assert app.routes.reachable_from(1) == [2, 3, 4]
+        assert app.routes.reachable_from(1, max_hops=1) == [2]
+        assert app.routes.reachable_from(1, max_hops=2) == [2, 3]
+        assert app.routes.reachable_from(4) == []
+        assert app.routes.path_exists(2, 4)
+        assert not app.routes.path_exists(4, 1)
+        assert app.routes.path_exists(1, 1)  # через цикл
+        assert not app.routes.path_exists(5, 6)
+        assert app.routes.path_exists(5, 6, active_only=False)
+
+    def test_components(self, app, tables):
+        """Тест: компоненты без учёта направления"""
+        assert app.routes.connected_components() == [[1, 2, 3, 4], [7, 8]]
+        assert app.routes.connected_components(active_only=False) == [[1, 2, 3, 4], [5, 6], [7, 8]]
+
+    def test_cache_follows_route_version(self, app, tables):
+        """Тест: кеш отдаёт прежний результат, пока маршруты не менялись"""
+        assert app.routes.reachable_from(4) == []
+        key = ("reachable_from", 4, None, True)
+        assert key in app.routes._graph_cache
+
+        app.routes.insert_one([4, 7, None, True])
+        assert app.routes.reachable_from(4) == [7, 8]
+        assert app.routes.connected_components() == [[1, 2, 3, 4, 7, 8]]
+
+        route_id = app.routes.select("route_id").where("start_station_id", 4).first()[0]
+        app.routes.delete_by_pk(route_id)
+        assert app.routes.reachable_from(4) == []
+
+    def test_version_follows_commit_order(self, app, tables):
+        """Тест: версия меняется, когда транзакция с меньшим txid фиксируется последней"""
+        other = DbConnection(DBConfig())
+        other.connect()
+        try:
+            other.conn.cursor().execute("SELECT txid_current()")  # старший txid у другой сессии
+
+            app.routes.insert_one([4, 7, None, True])
+            assert app.routes.reachable_from(4) == [7, 8]
+            version = app.routes.data_version()
+
+            RoutesTable(other).insert_one([8, 1, None, True])
+            assert app.routes.data_version() != version
+            assert app.routes.reachable_from(4) == [1, 2, 3, 7, 8]
+        finally:
+            other.close()
+
+    def test_uncommitted_result_not_cached(self, app, tables):
+        """Тест: результат со своей незафиксированной записью не остаётся в кеше после отката"""
+        app.routes.insert_one([4, 7, None, True], commit=False)
+        assert app.routes.reachable_from(4) == [7, 8]
+        app.connection.conn.rollback()
+        assert app.routes.reachable_from(4) == []
+
+    def test_version_read_with_result(self, app, tables):
+        """Тест: если таблица изменилась во время запроса, запрос повторяется под новой версией"""
+        other = DbConnection(DBConfig())
+        other.connect()
+        calls = []
+
+        def query(conn):
+            if not calls:
+                RoutesTable(other).insert_one([4, 7, None, True])  # фиксируется между чтениями версии
+            calls.append(conn)
+            cur = conn.cursor()
+            cur.execute(f"SELECT count(*) FROM {app.routes.table_name()}")
+            return cur.fetchone()[0]
+
+        try:
+            version, count = app.routes.read_versioned(query)
+        finally:
+            other.close()
+        assert len(calls) == 2 and calls[0] is calls[1]
+        assert (version, count) == (app.routes.data_version(), 7)
+
+    def test_end_station_index(self, app, tables):
+        """Тест: поиск по станции конца идёт по индексу"""
+        cur = app.connection.conn.cursor()
+        cur.execute("SET LOCAL enable_seqscan = off")
+        cur.execute(f"EXPLAIN SELECT 1 FROM {app.routes.table_name()} WHERE end_station_id = 1")
+        plan = "\n".join(r[0] for r in cur.fetchall())
+        app.connection.conn.rollback()
+        assert "end_station" in plan, plan
+
+
+class TestPipeline:
+    """Тесты для конвейера запросов за одно обращение к серверу"""
+
+    @pytest.fixture
+    def tables(self, tables, app):
+        """Пересоздание таблиц"""
+        app.stations.insert_many([['Арбатская', 1, 1, True], ['Смоленская', 1, 2, True]])
+
+    def test_reads_and_writes_in_one_flight(self, app, tables, tmp_path):
+        """Тест: запросы идут одной командой по порядку и видят изменения предыдущих"""
+        app.routes.unique_index.refresh()
+        app.stations.unique_index.refresh()
+        trace_file = tmp_path / "trace.jsonl"
+        tracing.configure(str(trace_file))
+        try:
+            with app.connection.pipeline() as p:
+                before = p.query(app.routes.select().where("start_station_id", 1))
+                added = p.insert(app.routes, [1, 2, 'Прямой', True])
+                after = p.query(app.routes.select("end_station_id", "route_name").where("start_station_id", 1))
+                renamed = p.update(app.stations, 999, {"tariff_zone": 2})
+        finally:
+            tracing.configure()
+        app.connection.conn.commit()
+
+        assert before.get() == []
+        assert added.rowcount == 1
+        assert after.get() == [(2, 'Прямой')]
+        assert renamed.rowcount == 0
+        flights = [json.loads(line) for line in trace_file.read_text(encoding="utf-8").splitlines()]
+        assert [(r["name"], r["queries"]) for r in flights] == [("Pipeline.run", 1)]
+
+    def test_failed_statement_isolated(self, app, tables):
+        """Тест: ошибка одного запроса не мешает остальным и не ломает транзакцию"""
+        with app.connection.pipeline() as p:
+            first = p.insert(app.routes, [1, 2, None, True])
+            loop = p.insert(app.routes, [2, 2, None, True])  # chk_route_start_end_not_same
+            second = p.insert(app.routes, [2, 1, None, True])
+            dup = p.insert(app.stations, ['Арбатская', 1, 3, True])  # отсеян unique_index
+        app.connection.conn.commit()
+
+        assert first.rowcount == 1 and second.rowcount == 1
+        assert constraint_of(loop.error) == "chk_route_start_end_not_same"
+        with pytest.raises(errors.CheckViolation):
+            loop.get()
+        assert isinstance(dup.error, DuplicateKeyError)
+        assert app.routes.count() == 2
+
+        # после отката временная таблица результатов пропала — конвейер восстанавливается
+        with app.connection.pipeline() as p:
+            p.query(app.stations.select())
+        app.connection.conn.rollback()
+        with app.connection.pipeline() as p:
+            names = p.query(app.stations.select("name").order_by("line_order"))
+        assert names.get() == [('Арбатская',), ('Смоленская',)]
+
+    def test_rows_have_column_types(self, app, tables):
+        """Тест: строки конвейера тех же типов, что и при обычном чтении"""
+        q = app.stations.select("station_id", "name", "updated_at", "change_txid").order_by("station_id")
+        with app.connection.pipeline() as p:
+            piped = p.query(q)
+            added = p.insert(app.routes, [1, 2, None, True])
+            typed = p.execute("SELECT 1.50::NUMERIC AS n, DATE '2026-01-02' AS d, 0.5::REAL AS r",
+                              types=["NUMERIC(10, 2)", "DATE", "REAL"])
+            raw = p.execute("SELECT 1.50::NUMERIC AS n, DATE '2026-01-02' AS d")
+        app.connection.conn.commit()
+
+        assert piped.get() == q.all()
+        assert isinstance(piped.first()[2], datetime.datetime)
+        assert added.get() == [(app.routes.all()[0][0],)]
+        assert typed.get() == [(Decimal("1.50"), datetime.date(2026, 1, 2), 0.5)]
+        assert isinstance(typed.first()[2], float)
+        assert raw.get() == [(1.5, '2026-01-02')]
+
+    def test_rollback_keeps_single_flight(self, app, tables, monkeypatch):
+        """Тест: после отката транзакции конвейер заново создаёт таблицу результатов, а не идёт по одному"""
+        with app.connection.pipeline() as p:
+            p.query(app.stations.select())
+        app.connection.conn.rollback()
+
+        def one_by_one(*args):
+            raise AssertionError("конвейер пошёл по одному запросу")
+
+        monkeypatch.setattr(Pipeline, "_run_one_by_one", one_by_one)
+        with app.connection.pipeline() as p:
+            names = p.query(app.stations.select("name").order_by("line_order"))
+        assert names.get() == [('Арбатская',), ('Смоленская',)]
+
+    def test_route_add_checks_and_inserts_in_one_flight(self, app, tables, monkeypatch):
+        """Тест: route_add проверяет станции и вставляет маршрут одним обращением"""
+        answers = iter(["Смол", "1", "", "y"])
+        monkeypatch.setattr("builtins.input", lambda prompt="": next(answers))
+        app.route_add(1)
+        assert [(r[1], r[2]) for r in app.routes.all()] == [(1, 2)]
+
+        answers = iter(["Смол", "1", "", "y"])
+        app.route_add(99)
+        assert app.routes.count() == 1
+        assert app._station_names([2, 1, 2, 99]) == {1: 'Арбатская', 2: 'Смоленская'}
+
+
+class TestTenants:
+    """Тесты для схемы на арендатора"""
+
+    TENANTS = ["test_tenant_a", "test_tenant_b"]
+
+    @pytest.fixture
+    def tenant_conns(self, db_connection):
+        tenants.teardown(db_connection, self.TENANTS)
+        tenants.provision(db_connection, self.TENANTS)
+        conns = [db_connection.for_tenant(t) for t in self.TENANTS]
+        for c in conns:
+            c.connect()
+        yield conns
+        for c in conns:
+            c.close()
+        tenants.teardown(db_connection, self.TENANTS)
+
+    def test_tenants_isolated_with_shared_statements(self, db_connection, tenant_conns):
+        """Тест: данные арендаторов разделены, тексты запросов совпадают"""
+        a, b = (StationsTable(c) for c in tenant_conns)
+        a.insert_one(['Арбатская', 1, 1, True])
+        b.insert_many([['Киевская', 1, 1, True], ['Смоленская', 1, 2, True]])
+
+        assert [r[1] for r in a.all()] == ['Арбатская']
+        assert b.count() == 2
+        assert a.table_name() == b.table_name() == "station"
+        qa, qb = a.select("name").where("station_id", 1), b.select("name").where("station_id", 1)
+        assert qa.rendered(tenant_conns[0].conn) == qb.rendered(tenant_conns[1].conn)
+        assert set(self.TENANTS) <= set(tenants.list_tenants(db_connection))
+
+    def test_provision_is_atomic_and_teardown_drops_schema(self, db_connection, tenant_conns):
+        """Тест: повторное создание ничего не создаёт, удаление убирает схему целиком"""
+        with pytest.raises(errors.DuplicateSchema):
+            tenants.provision(db_connection, ["test_tenant_c", self.TENANTS[0]])
+        assert "test_tenant_c" not in tenants.list_tenants(db_connection)
+
+        tenants.teardown(db_connection, self.TENANTS[:1])
+        assert tenants.list_tenants(db_connection).count(self.TENANTS[0]) == 0
+        with pytest.raises(ValueError):
+            db_connection.for_tenant("Bad-Name")
+
+    def test_tenant_never_sees_public_tables(self, db_connection, tenant_conns):
+        """Тест: без схемы арендатора запросы не уходят к одноимённым таблицам в public"""
+        cur = db_connection.conn.cursor()
+        cur.execute("CREATE TABLE public.station (station_id INTEGER)")
+        db_connection.conn.commit()
+        try:
+            tenants.teardown(db_connection, self.TENANTS[:1])  # соединение арендатора остаётся открытым
+            stations = StationsTable(tenant_conns[0])
+            with pytest.raises(errors.UndefinedTable):
+                stations.count()
+            tenant_conns[0].conn.rollback()
+            stations.drop()
+
+            cur.execute("SELECT to_regclass('public.station')")
+            assert cur.fetchone()[0] is not None
+        finally:
+            tenant_conns[0].conn.rollback()
+            cur.execute("DROP TABLE IF EXISTS public.station")
+            db_connection.conn.commit()
+
+
 class TestErrorHandling:
     """Тесты для обработки ошибок"""
 
@@ -0,0 +1,179 @@
+# tracing.py
+"""
+Спаны для действий Main и вызовов DbTable: имя, длительность, число запросов и строк.
+
+Включается переменными окружения (или configure()):
+    TRACE_FILE=trace.jsonl          каждый завершённый спан — строка JSON
+    TRACE_PROFILE=Main.route_add    спаны с этими именами (через запятую, * — все)
+                                    выполняются под cProfile, статистика — в <имя>-<время>.prof
+
+Пока трассировка выключена, обёртки сразу вызывают функцию.
+Свёртка для flame graph (flamegraph.pl, speedscope):
+    python tracing.py trace.jsonl > trace.folded
+"""
+from __future__ import annotations
+
+import cProfile
+import functools
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+
+@dataclass
+class Span:
+    name: str
+    path: str
+    parent_id: int | None
+    span_id: int = 0
+    attrs: dict = field(default_factory=dict)
+    start: float = 0.0
+    duration: float = 0.0
+    children_time: float = 0.0
+    queries: int = 0
+    rows: int = 0
+    error: str | None = None
+
+    def record(self) -> dict:
+        return {
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "path": self.path,
+            "thread": threading.current_thread().name,
+            "start": self.start,
+            "duration_ms": round(self.duration * 1000, 3),
+            "self_ms": round((self.duration - self.children_time) * 1000, 3),
+            "queries": self.queries,
+            "rows": self.rows,
+            "error": self.error,
+            "attrs": self.attrs,
+        }
+
+
+_enabled = False
+_profile: set[str] = set()
+_out = None
+_out_lock = threading.Lock()
+_ids = itertools.count(1)
+_local = threading.local()
+
+
+def configure(trace_file: str | None = None, profile: str | None = None) -> None:
+    """Включить запись спанов в trace_file и/или профилирование спанов из списка profile."""
+    global _enabled, _out, _profile
+    with _out_lock:
+        if _out is not None:
+            _out.close()
+        _out = open(trace_file, "a", encoding="utf-8") if trace_file else None
+    _profile = {p.strip() for p in (profile or "").split(",") if p.strip()}
+    _enabled = _out is not None or bool(_profile)
+
+
+def _stack() -> list[Span]:
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+@contextmanager
+def span(name: str, **attrs):
+    if not _enabled:
+        yield None
+        return
+
+    stack = _stack()
+    parent = stack[-1] if stack else None
+    s = Span(
+        name=name,
+        path=f"{parent.path};{name}" if parent else name,
+        parent_id=parent.span_id if parent else None,
+        span_id=next(_ids),
+        attrs=attrs,
+    )
+    profiler = None
+    if ("*" in _profile or name in _profile) and not getattr(_local, "profiling", False):
+        profiler = cProfile.Profile()
+        _local.profiling = True
+
+    stack.append(s)
+    s.start = time.time()
+    started = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield s
+    except BaseException as e:
+        s.error = type(e).__name__
+        raise
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            _local.profiling = False
+            profiler.dump_stats(f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{s.span_id}.prof")
+        s.duration = time.perf_counter() - started
+        stack.pop()
+        if parent is not None:
+            parent.children_time += s.duration
+            parent.queries += s.queries
+            parent.rows += s.rows
+        _emit(s)
+
+
+def _emit(s: Span) -> None:
+    if _out is None:
+        return
+    line = json.dumps(s.record(), ensure_ascii=False, default=str)
+    with _out_lock:
+        _out.write(line + "\n")
+        _out.flush()
+
+
+def traced(fn):
+    """Выполнить функцию в спане с именем Класс.метод."""
+    name = fn.__qualname__
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return fn(*args, **kwargs)
+        with span(name):
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def record_query(rows: int) -> None:
+    """Учесть выполненный запрос в текущем спане; вызывается курсором DbConnection."""
+    if not _enabled:
+        return
+    stack = getattr(_local, "stack", None)
+    if stack:
+        stack[-1].queries += 1
+        stack[-1].rows += max(rows, 0)
+
+
+def folded(lines) -> Counter:
+    """Свёртка спанов из JSONL: путь стека -> собственное время, мкс."""
+    totals = Counter()
+    for line in lines:
+        if line.strip():
+            rec = json.loads(line)
+            totals[rec["path"]] += int(rec["self_ms"] * 1000)
+    return totals
+
+
+configure(os.environ.get("TRACE_FILE"), os.environ.get("TRACE_PROFILE"))
+
+
+if __name__ == "__main__":
+    with open(sys.argv[1], encoding="utf-8") as f:
+        for path, micros in folded(f).items():
+            print(f"{path} {micros}")
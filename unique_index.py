@@ -0,0 +1,184 @@
+# unique_index.py
+from __future__ import annotations
+
+import threading
+import time
+
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INTRANS
+
+import tracing
+from dberrors import DuplicateKeyError
+
+
+class UniqueIndex:
+    """
+    Копия UNIQUE-ключей таблицы в памяти: явные дубликаты отклоняются до отправки
+    INSERT/UPDATE, без ошибки в БД и отката транзакции.
+
+    Ключи берутся из DbTable.unique_keys(). Индекс обновляется записями этой же
+    таблицы и догоняет чужие изменения через changes_since(), если с прошлой
+    синхронизации прошло больше max_age секунд. Main держит транзакцию чтения открытой,
+    поэтому синхронизация идёт и внутри неё — под savepoint, чтобы сбой не прервал
+    транзакцию вызывающего. Тогда в индекс могут попасть собственные незафиксированные
+    строки; после их отката такой ключ снимет проверка попадания (см. ниже).
+
+    Индекс может отставать в обе стороны. Промах пропускает запрос — дубликат
+    отклонит ограничение в БД. Попадание подтверждается точечным SELECT по колонкам
+    ключа в транзакции вызывающего: если ключ уже свободен, устаревшая запись
+    удаляется из индекса и запрос выполняется. Ключ, в котором есть NULL,
+    не проверяется — как и в Postgres.
+    """
+
+    def __init__(self, table, max_age: float = 5.0):
+        self.table = table
+        self.max_age = max_age
+        self.keys = table.unique_keys()
+        self._columns = sorted({c for cols in self.keys.values() for c in cols})
+        self._pk = table.primary_key()[0]
+        self._rows: dict[object, dict] = {}  # PK -> значения колонок из ключей
+        self._index: dict[str, dict[tuple, object]] = {name: {} for name in self.keys}
+        self._watermark: int | None = None
+        self._synced_at = 0.0
+        self._lock = threading.Lock()
+
+    # синхронизация
+    @tracing.traced
+    def refresh(self) -> None:
+        """Догнать изменения в БД; первый вызов загружает все ключи. В прерванной транзакции ничего не делает."""
+        conn = self.table.dbconn.conn
+        status = conn.get_transaction_status()
+        if status == TRANSACTION_STATUS_IDLE:
+            changed, deleted, watermark = self.table.changes_since(self._watermark or 0)
+            conn.commit()  # не оставляем открытой транзакцию чтения
+        elif status == TRANSACTION_STATUS_INTRANS:
+            cur = conn.cursor()
+            cur.execute("SAVEPOINT unique_index_sync")
+            try:
+                changed, deleted, watermark = self.table.changes_since(self._watermark or 0)
+            except psycopg2.Error:
+                cur.execute("ROLLBACK TO SAVEPOINT unique_index_sync")
+                return  # индекс остаётся прежним: попадания всё равно подтверждаются в БД
+            finally:
+                cur.execute("RELEASE SAVEPOINT unique_index_sync")
+        else:
+            return
+        names = self.table.column_names()
+        pk_index = names.index(self._pk)
+        with self._lock:
+            for row in changed:
+                self._put(row[pk_index], dict(zip(names, row)))
+            for (pk,) in deleted:
+                self._discard(pk)
+            self._watermark = watermark
+            self._synced_at = time.monotonic()
+
+    def reset(self) -> None:
+        """Забыть все ключи (таблицу пересоздали); следующая проверка загрузит их заново."""
+        with self._lock:
+            self._rows.clear()
+            for keys in self._index.values():
+                keys.clear()
+            self._watermark = None
+
+    def _ensure_fresh(self) -> None:
+        if self._watermark is None or time.monotonic() - self._synced_at > self.max_age:
+            self.refresh()
+
+    # проверки
+    def check(self, vals: dict, pk=None) -> None:
+        """Бросить DuplicateKeyError, если значения vals уже заняты другой строкой (не pk)."""
+        self._ensure_fresh()
+        hits = []
+        with self._lock:
+            merged = {**self._rows.get(pk, {}), **vals} if pk is not None else vals
+            for name, cols in self.keys.items():
+                if pk is not None and not any(c in vals for c in cols):
+                    continue  # изменение не затрагивает этот ключ
+                key = self._key(merged, cols)
+                if key is None:
+                    continue
+                owner = self._index[name].get(key)
+                if owner is not None and owner != pk:
+                    hits.append((name, key))
+        for name, key in hits:
+            if self._confirm(name, key, pk):
+                raise DuplicateKeyError(name)
+
+    def check_many(self, rows: list[dict]) -> list[DuplicateKeyError | None]:
+        """Проверить новые строки против индекса и друг друга: ошибка или None для каждой."""
+        self._ensure_fresh()
+        result: list[DuplicateKeyError | None] = []
+        seen: dict[str, set] = {name: set() for name in self.keys}
+        for vals in rows:
+            error = None
+            keys = {name: self._key(vals, cols) for name, cols in self.keys.items()}
+            for name, key in keys.items():
+                if key is None:
+                    continue
+                with self._lock:
+                    hit = key in self._index[name]
+                if key in seen[name] or hit and self._confirm(name, key, None):
+                    error = DuplicateKeyError(name)
+                    break
+            if error is None:
+                for name, key in keys.items():
+                    if key is not None:
+                        seen[name].add(key)
+            result.append(error)
+        return result
+
+    @tracing.traced
+    def _confirm(self, name: str, key: tuple, pk) -> bool:
+        """Занят ли ключ в БД строкой, отличной от pk; индекс поправляется по ответу."""
+        cols = self.keys[name]
+        q = sql.SQL("SELECT {} FROM {} WHERE {} LIMIT 1").format(
+            sql.SQL(", ").join(sql.Identifier(c) for c in [self._pk, *self._columns]),
+            sql.Identifier(self.table.table_name()),
+            sql.SQL(" AND ").join(sql.SQL("{} = %s").format(sql.Identifier(c)) for c in cols),
+        )
+        cur = self.table.dbconn.conn.cursor()
+        cur.execute(q, key)
+        row = cur.fetchone()
+        owner = row[0] if row else None
+        with self._lock:
+            stale = self._index[name].get(key)
+            if stale is not None and stale != owner:
+                self._discard(stale)  # строку удалили или изменили мимо индекса
+            if owner is not None:
+                self._put(owner, dict(zip(self._columns, row[1:])))
+        return owner is not None and owner != pk
+
+    # обновление по записям этой таблицы
+    def put(self, pk, vals: dict) -> None:
+        with self._lock:
+            self._put(pk, vals)
+
+    def discard(self, pk) -> None:
+        with self._lock:
+            self._discard(pk)
+
+    def _put(self, pk, vals: dict) -> None:
+        self._discard(pk, keep_row=True)
+        row = {**self._rows.get(pk, {}), **{c: vals[c] for c in self._columns if c in vals}}
+        self._rows[pk] = row
+        for name, cols in self.keys.items():
+            key = self._key(row, cols)
+            if key is not None:
+                self._index[name][key] = pk
+
+    def _discard(self, pk, keep_row: bool = False) -> None:
+        row = self._rows.get(pk) if keep_row else self._rows.pop(pk, None)
+        if row is None:
+            return
+        for name, cols in self.keys.items():
+            key = self._key(row, cols)
+            if key is not None and self._index[name].get(key) == pk:
+                del self._index[name][key]
+
+    @staticmethod
+    def _key(vals: dict, cols: list[str]) -> tuple | None:
+        if any(vals.get(c) is None for c in cols):
+            return None
+        return tuple(vals[c] for c in cols)
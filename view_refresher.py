@@ -0,0 +1,63 @@
+# view_refresher.py
+from __future__ import annotations
+
+import threading
+import traceback
+
+import psycopg2
+
+
+class ViewRefresher:
+    """
+    Фоновый REFRESH MATERIALIZED VIEW CONCURRENTLY для DbTable.materialized_views().
+
+    Раз в interval секунд проверяет data_version() каждой таблицы и пересчитывает
+    представления только тех, что изменились с прошлого раза. Чтение представлений
+    во время пересчёта не блокируется.
+
+    Нужен DbConnection(threadsafe=True): у фонового потока своё соединение.
+    """
+
+    def __init__(self, tables: list, interval: float = 60.0):
+        for table in tables:
+            if not getattr(table.dbconn, "threadsafe", False):
+                raise ValueError("ViewRefresher требует DbConnection(threadsafe=True)")
+
+        self.tables = [t for t in tables if t.materialized_views()]
+        self.interval = interval
+        self._versions: dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="view-refresher", daemon=True)
+        self._thread.start()
+
+    def refresh_now(self) -> int:
+        """Пересчитать представления изменившихся таблиц; вернуть число таблиц."""
+        refreshed = 0
+        with self._lock:
+            for table in self.tables:
+                try:
+                    version = table.data_version()
+                    if self._versions.get(table.table_name()) == version:
+                        # не держим открытой транзакцию чтения до следующей проверки
+                        table.dbconn.conn.commit()
+                        continue
+                    table.refresh_views(concurrently=True)
+                except psycopg2.Error:
+                    table.dbconn.conn.rollback()
+                    raise
+                self._versions[table.table_name()] = version
+                refreshed += 1
+        return refreshed
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.refresh_now()
+            except Exception:
+                # поток должен пережить сбой (таблицу пересоздают, БД недоступна) и попробовать снова
+                traceback.print_exc()
@@ -0,0 +1,140 @@
+# write_behind.py
+from __future__ import annotations
+
+import atexit
+import queue
+import threading
+import time
+import traceback
+
+import psycopg2
+
+
+class WriteBehindBuffer:
+    """
+    Отложенная запись в DbTable: insert()/update() только ставят операцию в очередь,
+    фоновый поток пишет их пачками — по max_batch операций или раз в flush_interval секунд.
+
+    - Очередь ограничена max_pending: при заполнении insert()/update() ждут (backpressure),
+      а с put_timeout — бросают queue.Full.
+    - insert()/update() сразу проверяют состав операции (DbTable.check_op) — ValueError
+      получает вызывающий, а не фоновый поток.
+    - Пачка пишется через DbTable.apply_batch: сбойные операции отсеиваются делением под
+      savepoint, on_error(op, args, exc) вызывается только для них; остальные записываются.
+      Если соединение потеряно, пачка повторяется один раз на новом; если пачка всё же
+      не записана целиком, on_error вызывается для каждой её операции.
+    - При выходе из процесса оставшиеся операции дописываются (atexit).
+
+    Нужен DbConnection(threadsafe=True): у фонового потока своё соединение.
+    """
+
+    _STOP = object()
+
+    def __init__(
+        self,
+        table,
+        max_batch: int = 500,
+        flush_interval: float = 1.0,
+        max_pending: int = 10_000,
+        on_error=None,
+        put_timeout: float | None = None,
+    ):
+        if not getattr(table.dbconn, "threadsafe", False):
+            raise ValueError("WriteBehindBuffer требует DbConnection(threadsafe=True)")
+
+        self.table = table
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.on_error = on_error
+        self.put_timeout = put_timeout
+
+        self._queue: queue.Queue = queue.Queue(maxsize=max_pending)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # постановка в очередь
+    def insert(self, vals: list | tuple) -> None:
+        self.table.check_op("insert", vals)
+        self._put(("insert", tuple(vals)))
+
+    def update(self, pk_value, vals_dict: dict) -> None:
+        self.table.check_op("update", (pk_value, vals_dict))
+        self._put(("update", (pk_value, dict(vals_dict))))
+
+    def _put(self, item) -> None:
+        if self._closed:
+            raise RuntimeError("WriteBehindBuffer закрыт")
+        self._queue.put(item, timeout=self.put_timeout)
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def flush(self) -> None:
+        """Дождаться записи всего, что уже поставлено в очередь."""
+        self._queue.join()
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        self._queue.put(self._STOP)
+        self._thread.join()
+
+    # фоновый поток
+    def _run(self) -> None:
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            batch = []
+            if item is self._STOP:
+                stop = True
+            else:
+                batch.append(item)
+
+            deadline = time.monotonic() + self.flush_interval
+            while not stop and len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stop = True
+                else:
+                    batch.append(item)
+
+            try:
+                if batch:
+                    self._write(batch)
+            except Exception:
+                # поток должен пережить ошибку в on_error, иначе flush()/close() зависнут
+                traceback.print_exc()
+            finally:
+                for _ in range(len(batch) + (1 if stop else 0)):
+                    self._queue.task_done()
+
+    def _write(self, batch: list) -> None:
+        try:
+            failed = [(err.op, err.args, err.error) for err in self._apply(batch).errors]
+        except Exception as e:
+            if self.on_error is None:
+                raise
+            failed = [(op, args, e) for op, args in batch]  # пачка откатилась целиком
+        if self.on_error is not None:
+            for op, args, exc in failed:
+                self.on_error(op, args, exc)
+
+    def _apply(self, batch: list):
+        conn = self.table.dbconn.conn
+        try:
+            return self.table.apply_batch(batch, chunk_size=self.max_batch)
+        except psycopg2.Error:
+            if not conn.closed:
+                raise
+        # соединение потеряно (рестарт сервера, разрыв сети): dbconn.conn откроет новое
+        return self.table.apply_batch(batch, chunk_size=self.max_batch)